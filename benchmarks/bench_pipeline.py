@@ -0,0 +1,171 @@
+"""
+Benchmarks of every stage of poll -> parse -> serialize -> publish pipeline.
+SMB and MQTT broker are replaced with local stand-ins, so it runs offline.
+
+Run with: python -m benchmarks.bench_pipeline
+"""
+import json
+import logging
+import tempfile
+import timeit
+from datetime import timedelta
+from types import SimpleNamespace
+from typing import Callable, Dict
+
+from iqair2mqtt import iqair, iqair_parser
+from iqair2mqtt.archive import DeviceArchive
+from iqair2mqtt.iqair_parser import parse_measurements
+from iqair2mqtt.models.iqair_measurement import IQAirMeasurement, IQAirMeasurements
+from iqair2mqtt.mqtt import MQTTPublisher
+
+from benchmarks.fake_broker import FakeBroker
+from benchmarks.fake_smb import FakeSMBConnection
+from benchmarks.payloads import REALISTIC_PAYLOAD, encode, oversized_payload
+
+NUMBER = 2000
+PUBLISH_NUMBER = 2000
+
+CONFIG = SimpleNamespace(get_placement='benchmark_placement', get_location='benchmark_location')
+
+
+def _per_call(function: Callable, number: int) -> float:
+    """
+    Best of 3 runs, in microseconds per call
+    """
+    return min(timeit.repeat(function, number=number, repeat=3)) / number * 1e6
+
+
+def bench_parse(number: int) -> Dict[str, float]:
+    oversized = oversized_payload()
+    return {
+        'parse_realistic': _per_call(lambda: parse_measurements(CONFIG, REALISTIC_PAYLOAD), number),
+        'parse_oversized': _per_call(lambda: parse_measurements(CONFIG, oversized), max(number // 20, 1)),
+    }
+
+
+def bench_parse_throughput(number: int) -> Dict[str, float]:
+    """
+    Parse time per measurement, with debug logging off and on, like it's on with '--debug'
+    """
+    payloads = {'realistic': REALISTIC_PAYLOAD, 'oversized': oversized_payload()}
+    results = {}
+    for name, payload in payloads.items():
+        keys = len(payload['measurements'][0])
+        calls = number if name == 'realistic' else max(number // 20, 1)
+        results[f'parse_per_measurement_{name}'] = _per_call(lambda: parse_measurements(CONFIG, payload), calls) / keys
+
+    parser_logger = logging.getLogger(iqair_parser.__name__)
+    handler = logging.NullHandler()
+    level, propagate = parser_logger.level, parser_logger.propagate
+    parser_logger.addHandler(handler)
+    parser_logger.setLevel(logging.DEBUG)
+    parser_logger.propagate = False
+    try:
+        results['parse_realistic_debug_logging'] = _per_call(
+            lambda: parse_measurements(CONFIG, REALISTIC_PAYLOAD), number)
+    finally:
+        parser_logger.removeHandler(handler)
+        parser_logger.setLevel(level)
+        parser_logger.propagate = propagate
+    return results
+
+
+def bench_serialize(number: int) -> Dict[str, float]:
+    realistic = parse_measurements(CONFIG, REALISTIC_PAYLOAD)
+    oversized = parse_measurements(CONFIG, oversized_payload())
+    return {
+        'to_json_realistic': _per_call(realistic.to_json, number),
+        'to_json_oversized': _per_call(oversized.to_json, max(number // 20, 1)),
+        'to_json_bytes_realistic': _per_call(realistic.to_json_bytes, number),
+        'to_json_bytes_oversized': _per_call(oversized.to_json_bytes, max(number // 20, 1)),
+    }
+
+
+def bench_fetch(number: int) -> Dict[str, float]:
+    original_connection = iqair.SMBConnection
+    iqair.SMBConnection = FakeSMBConnection
+    try:
+        results = {}
+        for payload_name, payload in (('realistic', REALISTIC_PAYLOAD), ('oversized', oversized_payload(5000))):
+            FakeSMBConnection.set_file(iqair.MEASUREMENTS_FILE, encode(payload))
+            for mode, in_memory in (('in_memory', True), ('temp_file', False)):
+                device = iqair.IQAir('127.0.0.1', 'login', 'password', in_memory=in_memory)
+                results[f'fetch_{mode}_{payload_name}'] = _per_call(
+                    lambda: json.loads(device._fetch_file(iqair.MEASUREMENTS_FILE)), number
+                )
+            device = iqair.IQAir('127.0.0.1', 'login', 'password')
+            results[f'fetch_unchanged_{payload_name}'] = _per_call(device.get_changed_measurements, number)
+        return results
+    finally:
+        iqair.SMBConnection = original_connection
+        FakeSMBConnection.files.clear()
+
+
+def bench_publish(number: int) -> Dict[str, float]:
+    broker = FakeBroker()
+    broker.start()
+    publisher = MQTTPublisher('127.0.0.1', 'login', 'password', 'benchmark', port=broker.port)
+    try:
+        publisher.connect()
+        publisher.wait_for_connection(10)
+        payload = parse_measurements(CONFIG, REALISTIC_PAYLOAD).to_json()
+
+        def publish_all():
+            expected = broker.published + number
+            for _ in range(number):
+                publisher.publish(payload)
+            if not broker.wait_for_published(expected):
+                raise RuntimeError("Broker stand-in didn't get all messages")
+
+        return {'publish_qos2': min(timeit.repeat(publish_all, number=1, repeat=3)) / number * 1e6}
+    finally:
+        publisher.disconnect()
+        broker.stop()
+
+
+def bench_archive(number: int) -> Dict[str, float]:
+    realistic = parse_measurements(CONFIG, REALISTIC_PAYLOAD)
+    measured_at = realistic.measurements[0].measured_at
+    # a day of polls every 15 seconds
+    samples = [
+        IQAirMeasurements(revision, realistic.device, [
+            IQAirMeasurement(measured_at + timedelta(seconds=15 * revision), m.name, m.value, m.unit)
+            for m in realistic.measurements
+        ])
+        for revision in range(24 * 60 * 4)
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        archive = DeviceArchive(directory)
+        appended = iter(samples)
+        results = {'archive_append': _per_call(lambda: archive.append(next(appended)), min(number, len(samples)))}
+        for sample in appended:
+            archive.append(sample)
+        # the last hour of the day
+        start, end = measured_at + timedelta(hours=23), measured_at + timedelta(hours=24)
+        results['archive_query_hour_of_day'] = _per_call(
+            lambda: sum(1 for _ in archive.query(start, end)), max(number // 100, 1))
+        archive.close()
+    return results
+
+
+def run(number: int = NUMBER) -> Dict[str, float]:
+    """
+    Returns per-call time in microseconds for every stage
+    """
+    results = {}
+    results.update(bench_parse(number))
+    results.update(bench_parse_throughput(number))
+    results.update(bench_serialize(number))
+    results.update(bench_fetch(number))
+    results.update(bench_archive(number))
+    results.update(bench_publish(max(number * PUBLISH_NUMBER // NUMBER, 1)))
+    return results
+
+
+def main():
+    for name, per_call in run().items():
+        print(f"{name:<32} {per_call:10.2f} us/call")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Compares IQAir timestamp conversion in 'iqair_parser' with the previous
+implementation based on generic 'dateutil.parser.parse'.
+
+Run with: python -m benchmarks.bench_timestamp
+"""
+import timeit
+
+from dateutil import parser
+from dateutil.tz import gettz
+
+from iqair2mqtt.iqair_parser import convert_to_utc_datetime
+
+NUMBER = 20000
+LOCAL_DATE = '2020/12/27'
+LOCAL_TIME = '15:55:01'
+LOCAL_TIMEZONE = 'America/New_York'
+LOCAL_TIMESTAMP = 1609084501
+
+
+def legacy_convert_to_utc_datetime(local_date, local_time, local_timezone):
+    local_tz = gettz(local_timezone)
+    local_datetime = parser.parse(" ".join([local_date, local_time, "TZ"]), tzinfos={'TZ': local_tz})
+    return local_datetime.astimezone(gettz('UTC'))
+
+
+def run(number: int = NUMBER) -> dict:
+    """
+    Returns per-call time in microseconds for every implementation
+    """
+    cases = {
+        'legacy_dateutil_parse': lambda: legacy_convert_to_utc_datetime(LOCAL_DATE, LOCAL_TIME, LOCAL_TIMEZONE),
+        'date_and_time': lambda: convert_to_utc_datetime(LOCAL_DATE, LOCAL_TIME, LOCAL_TIMEZONE),
+        'timestamp': lambda: convert_to_utc_datetime(LOCAL_DATE, LOCAL_TIME, LOCAL_TIMEZONE, LOCAL_TIMESTAMP),
+    }
+    assert len({case() for case in cases.values()}) == 1, "implementations disagree"
+    return {
+        name: min(timeit.repeat(case, number=number, repeat=3)) / number * 1e6
+        for name, case in cases.items()
+    }
+
+
+def main():
+    results = run()
+    legacy = results['legacy_dateutil_parse']
+    for name, per_call in results.items():
+        print(f"{name:<24} {per_call:8.2f} us/call  x{legacy / per_call:5.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Minimal MQTT 3.1.1 broker stand-in. It accepts connections, acknowledges
+publishes with every QoS and counts them, but doesn't route messages to subscribers.
+"""
+import socket
+import socketserver
+import struct
+import threading
+from typing import Dict
+
+CONNECT = 1
+PUBLISH = 3
+PUBREL = 6
+SUBSCRIBE = 8
+PINGREQ = 12
+DISCONNECT = 14
+
+CONNACK = b'\x20\x02\x00\x00'
+PINGRESP = b'\xd0\x00'
+
+
+class FakeBroker(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        super().__init__((host, port), _ClientHandler)
+        self.published = 0
+        self.published_bytes = 0
+        self.retained: Dict[str, bytes] = {}
+        self._published_changed = threading.Condition()
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-broker', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def wait_for_published(self, count: int, timeout: float = 30) -> bool:
+        """
+        Waits until broker got 'count' publishes in total
+        """
+        with self._published_changed:
+            return self._published_changed.wait_for(lambda: self.published >= count, timeout=timeout)
+
+    def on_publish(self, topic: str, payload: bytes, retain: bool):
+        with self._published_changed:
+            self.published += 1
+            self.published_bytes += len(payload)
+            if retain:
+                self.retained[topic] = payload
+            self._published_changed.notify_all()
+
+
+class _ClientHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = self.request.makefile('rb')
+        while True:
+            first_byte = reader.read(1)
+            if not first_byte:
+                return
+            packet_type, flags = first_byte[0] >> 4, first_byte[0] & 0x0f
+            body = reader.read(self._read_remaining_length(reader))
+
+            if packet_type == CONNECT:
+                self.request.sendall(CONNACK)
+            elif packet_type == PUBLISH:
+                self._handle_publish(flags, body)
+            elif packet_type == PUBREL:
+                self.request.sendall(b'\x70\x02' + body[:2])  # PUBCOMP
+            elif packet_type == SUBSCRIBE:
+                self.request.sendall(b'\x90\x03' + body[:2] + b'\x00')  # SUBACK, QoS 0 granted
+            elif packet_type == PINGREQ:
+                self.request.sendall(PINGRESP)
+            elif packet_type == DISCONNECT:
+                return
+
+    def _handle_publish(self, flags: int, body: bytes):
+        qos = (flags >> 1) & 0x03
+        (topic_length,) = struct.unpack_from('!H', body)
+        topic = body[2:2 + topic_length].decode()
+        position = 2 + topic_length
+        packet_id = body[position:position + 2] if qos else b''
+        if qos:
+            position += 2
+        self.server.on_publish(topic, body[position:], bool(flags & 0x01))
+        if qos == 1:
+            self.request.sendall(b'\x40\x02' + packet_id)  # PUBACK
+        elif qos == 2:
+            self.request.sendall(b'\x50\x02' + packet_id)  # PUBREC
+
+    @staticmethod
+    def _read_remaining_length(reader) -> int:
+        multiplier = 1
+        length = 0
+        while True:
+            byte = reader.read(1)[0]
+            length += (byte & 0x7f) * multiplier
+            if not byte & 0x80:
+                return length
+            multiplier *= 128
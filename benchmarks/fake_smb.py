@@ -0,0 +1,69 @@
+"""
+Stand-in for 'smb.SMBConnection.SMBConnection' serving files from memory,
+so 'IQAir' can be benchmarked without a device
+"""
+import time
+from typing import Dict, NamedTuple
+
+from smb.base import SharedFile
+from smb.smb2_structs import SMB2Message
+from smb.smb_structs import OperationFailure
+
+STATUS_OBJECT_NAME_NOT_FOUND = 0xC0000034
+
+
+class FakeFile(NamedTuple):
+    content: bytes
+    last_write_time: float
+
+
+class FakeSMBConnection:
+
+    # files served by all connections, path -> file
+    files: Dict[str, FakeFile] = {}
+    # chunk size used to write a file to the file object, like pysmb does
+    chunk_size = 64 * 1024
+
+    def __init__(self, username, password, my_name, remote_name, *args, **kwargs):
+        self.connected = False
+
+    @classmethod
+    def set_file(cls, path: str, content: bytes):
+        cls.files[path] = FakeFile(content, time.time())
+
+    def connect(self, ip, port=139, sock_family=None, timeout=60) -> bool:
+        self.connected = True
+        return True
+
+    def close(self):
+        self.connected = False
+
+    def echo(self, data, timeout=10):
+        return data
+
+    def _get_file(self, path: str) -> FakeFile:
+        try:
+            return self.files[path]
+        except KeyError:
+            # like a real device, failed request has status of missing file
+            message = SMB2Message()
+            message.status = STATUS_OBJECT_NAME_NOT_FOUND
+            raise OperationFailure(f'Failed to retrieve {path} on airvisual: Unable to open file', [message])
+
+    def retrieveFile(self, service_name, path, file_obj, timeout=30, **kwargs):
+        return self.retrieveFileFromOffset(service_name, path, file_obj)
+
+    def retrieveFileFromOffset(self, service_name, path, file_obj, offset=0, max_length=-1, timeout=30, **kwargs):
+        content = self._get_file(path).content
+        end = len(content) if max_length < 0 else min(len(content), offset + max_length)
+        for chunk_start in range(offset, end, self.chunk_size):
+            file_obj.write(content[chunk_start:min(chunk_start + self.chunk_size, end)])
+        return 0, max(end - offset, 0)
+
+    def getAttributes(self, service_name, path, timeout=30) -> SharedFile:
+        fake_file = self._get_file(path)
+        size = len(fake_file.content)
+        return SharedFile(
+            fake_file.last_write_time, fake_file.last_write_time, fake_file.last_write_time,
+            fake_file.last_write_time, size, size, 0, path, path
+        )
@@ -0,0 +1,192 @@
+"""
+Load test of the whole poll -> parse -> publish pipeline with a fleet of simulated
+devices and a local MQTT broker stand-in. For every combination of number of devices
+and poll interval it runs 'FleetPoller' for '--duration' seconds and reports
+end-to-end throughput, latency percentiles of every stage and memory use.
+
+Run with: python -m benchmarks.load_test --devices 10,100,500 --interval 15,5 --duration 60
+"""
+import json
+import resource
+import threading
+import tracemalloc
+from time import perf_counter
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+import click
+
+from iqair2mqtt import poller
+from iqair2mqtt.config import DeviceConfig
+from iqair2mqtt.fleet import FleetPoller
+from iqair2mqtt.iqair import IQAir
+from iqair2mqtt.mqtt import MQTTPublisher
+
+from benchmarks.fake_broker import FakeBroker
+from benchmarks.simulator import SimulatedFleet
+
+STAGES = ('fetch', 'parse', 'publish', 'poll')
+PERCENTILES = (50, 95, 99)
+TOPIC = 'load_test'
+
+CONFIG = SimpleNamespace(
+    mqtt_publish_mode='json',
+    json_encoder='auto',
+    deadbands=None,
+    deadband_heartbeat=300,
+    aggregation_windows=[],
+    aggregation_publish_interval=60,
+)
+
+
+class StageTimings:
+    """
+    Durations of calls of every stage, collected from all poll threads
+    """
+
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def timed(self, stage: str, function: Callable) -> Callable:
+        durations = self.durations[stage]
+
+        def wrapper(*args, **kwargs):
+            started_at = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                with self._lock:
+                    self.errors += 1
+                raise
+            finally:
+                duration = perf_counter() - started_at
+                with self._lock:
+                    durations.append(duration)
+        return wrapper
+
+    def percentiles(self, stage: str) -> Dict[str, float]:
+        """
+        Latency percentiles of the stage in milliseconds
+        """
+        durations = sorted(self.durations[stage])
+        if not durations:
+            return {f'{stage}_p{percentile}_ms': 0.0 for percentile in PERCENTILES}
+        return {
+            f'{stage}_p{percentile}_ms': durations[min(len(durations) * percentile // 100, len(durations) - 1)] * 1e3
+            for percentile in PERCENTILES
+        }
+
+
+def max_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_scenario(devices: int, interval: float, duration: float, concurrency: int, latency: float,
+                 trace_memory: bool) -> Dict[str, float]:
+    broker = FakeBroker()
+    broker.start()
+    publisher = MQTTPublisher('127.0.0.1', 'login', 'password', TOPIC, port=broker.port)
+    original_parse = poller.parse_measurements
+    timings = StageTimings()
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        publisher.connect()
+        if not publisher.wait_for_connection(10):
+            raise RuntimeError("Can't connect to broker stand-in")
+        publisher.publish = timings.timed('publish', publisher.publish)
+        poller.parse_measurements = timings.timed('parse', original_parse)
+
+        fleet = SimulatedFleet(devices, interval, latency)
+        pollers = []
+        for ip in fleet.ips:
+            device = IQAir(ip, 'login', 'password', connection_factory=fleet.connection_factory)
+            device.get_changed_measurements = timings.timed('fetch', device.get_changed_measurements)
+            device_config = DeviceConfig(ip, 'login', 'password', interval, TOPIC, 'load_test', 'load_test')
+            device_poller = poller.DevicePoller(CONFIG, device, publisher, ip, device_config=device_config)
+            device_poller.poll = timings.timed('poll', device_poller.poll)
+            pollers.append(device_poller)
+
+        fleet_poller = FleetPoller(pollers, concurrency)
+        stop_timer = threading.Timer(duration, fleet_poller.stop)
+        started_at = perf_counter()
+        stop_timer.start()
+        fleet_poller.run()
+        publisher.flush()
+        elapsed = perf_counter() - started_at
+
+        result = {
+            'devices': devices,
+            'interval': interval,
+            'elapsed_s': elapsed,
+            'device_updates': fleet.updates,
+            'polls': len(timings.durations['poll']),
+            'errors': timings.errors,
+            'published': broker.published,
+            'published_per_s': broker.published / elapsed,
+            # how many of device updates reached the broker
+            'delivered_ratio': broker.published / fleet.updates if fleet.updates else 0.0,
+        }
+        for stage in STAGES:
+            result.update(timings.percentiles(stage))
+        if trace_memory:
+            result['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        result['max_rss_mb'] = max_rss_mb()
+        return result
+    finally:
+        poller.parse_measurements = original_parse
+        if trace_memory:
+            tracemalloc.stop()
+        publisher.disconnect()
+        broker.stop()
+
+
+def _parse_list(value: str, item_type: Callable) -> List:
+    return [item_type(item) for item in value.split(',') if item.strip()]
+
+
+def print_result(result: Dict[str, float]):
+    print(
+        f"devices={result['devices']:<6} interval={result['interval']:<5g} "
+        f"published={result['published']:<7} {result['published_per_s']:9.1f} msg/s  "
+        f"delivered={result['delivered_ratio']:6.1%}  errors={result['errors']}  "
+        f"rss={result['max_rss_mb']:.0f}MB"
+        + (f"  traced_peak={result['traced_peak_mb']:.1f}MB" if 'traced_peak_mb' in result else '')
+    )
+    for stage in STAGES:
+        percentiles = '  '.join(
+            f"p{percentile}={result[f'{stage}_p{percentile}_ms']:8.2f}ms" for percentile in PERCENTILES
+        )
+        print(f"    {stage:<8} {percentiles}")
+
+
+@click.command()
+@click.option('--devices', 'devices_spec', type=str, default='10,100',
+              help="Numbers of simulated devices, comma separated")
+@click.option('--interval', 'interval_spec', type=str, default='15',
+              help="Device update and poll intervals in seconds, comma separated")
+@click.option('--duration', type=float, default=60, help="How long every scenario runs, in seconds")
+@click.option('--concurrency', type=int, default=16, help="Devices polled at the same time")
+@click.option('--latency', type=float, default=0.0, help="Simulated latency of every SMB call, in seconds")
+@click.option('--trace-memory', is_flag=True, default=False,
+              help="Report peak of Python allocations, makes the run slower")
+@click.option('-o', '--output', type=str, default=None, help="Save results to a JSON file")
+def main(devices_spec: str, interval_spec: str, duration: float, concurrency: int, latency: float,
+         trace_memory: bool, output: Optional[str]):
+    results = []
+    for interval in _parse_list(interval_spec, float):
+        for devices in _parse_list(devices_spec, int):
+            result = run_scenario(devices, interval, duration, concurrency, latency, trace_memory)
+            print_result(result)
+            results.append(result)
+    if output is not None:
+        with open(output, 'w') as output_fh:
+            json.dump(results, output_fh, indent=2)
+        print(f"Results saved to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Realistic and oversized 'latest_config_measurements.json' payloads for benchmarks
+"""
+import copy
+import json
+from typing import Dict
+
+REALISTIC_PAYLOAD: Dict = {
+    'date_and_time': {
+        'date': '2020/12/27',
+        'time': '15:55:01',
+        'timestamp': '1609084501',
+    },
+    'measurements': [
+        {
+            'co2_ppm': '429',
+            'humidity_RH': '22',
+            'pm01_ugm3': '2.0',
+            'pm10_ugm3': '2',
+            'pm25_AQICN': '3',
+            'pm25_AQIUS': '8',
+            'pm25_ugm3': '2.0',
+            'temperature_C': '20.6',
+            'temperature_F': '69.0',
+            'voc_ppb': '-1',
+        }
+    ],
+    'serial_number': 'XXXXXXXXXX',
+    'settings': {
+        'follow_mode': 'station',
+        'followed_station': '00000',
+        'is_aqi_usa': True,
+        'is_concentration_showed': False,
+        'is_indoor': True,
+        'is_lcd_on': True,
+        'is_network_time': True,
+        'is_temperature_celsius': True,
+        'language': 'en-US',
+        'lcd_brightness': 0,
+        'node_name': 'benchmark',
+        'power_saving': {
+            '2slots': [{'hour_off': 9, 'hour_on': 7}, {'hour_off': 22, 'hour_on': 18}],
+            'mode': 'yes',
+            'running_time': 99,
+            'yes': [{'hour': 8, 'minute': 45}, {'hour': 22, 'minute': 0}],
+        },
+        'sensor_mode': {'custom_mode_interval': 3, 'mode': 1},
+        'speed_unit': 'mph',
+        'timezone': 'America/New_York',
+        'tvoc_unit': 'ppm',
+    },
+    'status': {
+        'app_version': '1.0000',
+        'battery': 100,
+        'datetime': 1609084501,
+        'device_name': 'AIRVISUAL-XXXXXXXXXX',
+        'ip_address': '127.0.0.1',
+        'mac_address': 'aaaaaaaaaaaa',
+        'model': 30,
+        'sensor_life': {'pm25': 28800000},
+        'sensor_pm25_serial': 'XXXXXXXXXXXX',
+        'sync_time': 250000,
+        'system_version': 'XXXXXXXXX',
+        'used_memory': 2,
+        'wifi_strength': 5,
+    },
+}
+
+
+def oversized_payload(extra_measurements: int = 500) -> Dict:
+    """
+    Payload with 'extra_measurements' additional measurement keys, like a future
+    firmware with many more sensors would produce
+    """
+    payload = copy.deepcopy(REALISTIC_PAYLOAD)
+    measurements = payload['measurements'][0]
+    for i in range(extra_measurements):
+        measurements[f'sensor{i:04d}_ugm3'] = f'{i % 97}.{i % 10}' if i % 2 else str(i % 500)
+    return payload
+
+
+def encode(payload: Dict) -> bytes:
+    return json.dumps(payload).encode()
@@ -0,0 +1,109 @@
+"""
+Runs all benchmarks, saves results to a JSON file and optionally compares them
+with results of a previous run, e.g. of the previous release.
+
+Run with: python -m benchmarks.run [--compare benchmarks/results/0.1.json]
+Exits with code 1 if any benchmark got slower than '--threshold'.
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Dict
+
+import click
+
+from benchmarks import bench_pipeline, bench_timestamp
+
+BENCHMARKS = {
+    'timestamp': bench_timestamp,
+    'pipeline': bench_pipeline,
+}
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def package_version() -> str:
+    try:
+        from importlib.metadata import PackageNotFoundError, version
+        return version('iqair2mqtt')
+    except (ImportError, PackageNotFoundError):
+        return 'dev'
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_all(scale: float) -> Dict[str, float]:
+    results = {}
+    for benchmark_name, benchmark in BENCHMARKS.items():
+        number = max(int(benchmark.NUMBER * scale), 1)
+        for case, per_call in benchmark.run(number).items():
+            results[f'{benchmark_name}.{case}'] = per_call
+    return results
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], threshold: float) -> bool:
+    """
+    Prints comparison with baseline, returns False if there are regressions
+    """
+    ok = True
+    for case, per_call in results.items():
+        if case not in baseline:
+            print(f"{case:<48} {per_call:10.2f} us/call  (new)")
+            continue
+        change = per_call / baseline[case] - 1
+        regression = change > threshold
+        ok = ok and not regression
+        mark = '  REGRESSION' if regression else ''
+        print(f"{case:<48} {per_call:10.2f} us/call  {change:+7.1%}{mark}")
+    return ok
+
+
+@click.command()
+@click.option('-o', '--output', type=str, default=None,
+              help="Where to save results, default is benchmarks/results/<version>-<git revision>.json")
+@click.option('--compare', 'baseline_path', type=str, default=None, help="Results file to compare with")
+@click.option('--threshold', type=float, default=0.25, help="Allowed slowdown compared to baseline")
+@click.option('--scale', type=float, default=1.0, help="Scale number of iterations, use <1 for a quick run")
+def main(output: str, baseline_path: str, threshold: float, scale: float):
+    results = run_all(scale)
+    report = {
+        'meta': {
+            'version': package_version(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'results': results,
+    }
+
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{report['meta']['version']}-{report['meta']['git_revision']}.json")
+    with open(output, 'w') as output_fh:
+        json.dump(report, output_fh, indent=2, sort_keys=True)
+    print(f"Results saved to {output}")
+
+    if baseline_path is None:
+        for case, per_call in results.items():
+            print(f"{case:<48} {per_call:10.2f} us/call")
+        return
+    with open(baseline_path) as baseline_fh:
+        baseline = json.load(baseline_fh)['results']
+    if not compare(results, baseline, threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Fleet of simulated AirVisual devices for load tests. Every device writes a new
+'latest_config_measurements.json' every 'update_interval' seconds with slowly
+drifting values. Devices are served by 'SimulatedSMBConnection', which 'IQAir'
+uses instead of a real SMB connection when it's passed as 'connection_factory'.
+"""
+import copy
+import math
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from dateutil.tz import UTC, gettz
+
+from iqair2mqtt.iqair import MEASUREMENTS_FILE
+
+from benchmarks.fake_smb import FakeFile, FakeSMBConnection
+from benchmarks.payloads import REALISTIC_PAYLOAD, encode
+
+EPOCH = datetime(1970, 1, 1)
+TIMEZONES = ('America/New_York', 'Europe/Berlin', 'Asia/Tokyo', 'UTC')
+# measurement key -> start value, random walk step, min, max
+SENSORS = {
+    'co2_ppm': (450.0, 15.0, 400.0, 2500.0),
+    'humidity_RH': (40.0, 0.5, 10.0, 90.0),
+    'pm01_ugm3': (3.0, 0.5, 0.0, 300.0),
+    'pm10_ugm3': (8.0, 1.0, 0.0, 500.0),
+    'pm25_ugm3': (5.0, 0.8, 0.0, 500.0),
+    'temperature_C': (21.0, 0.1, 5.0, 35.0),
+    'voc_ppb': (120.0, 10.0, 0.0, 1000.0),
+}
+# keys of integer values, like the device writes them
+INTEGER_KEYS = {'co2_ppm', 'humidity_RH', 'pm10_ugm3', 'voc_ppb'}
+
+
+def _aqi_us(pm25: float) -> int:
+    # piecewise linear US AQI for the lower breakpoints, good enough for a simulation
+    for low, high, low_aqi, high_aqi in ((0.0, 12.0, 0, 50), (12.1, 35.4, 51, 100),
+                                         (35.5, 55.4, 101, 150), (55.5, 150.4, 151, 200)):
+        if pm25 <= high:
+            return round(low_aqi + (high_aqi - low_aqi) * max(pm25 - low, 0) / (high - low))
+    return 300
+
+
+class SimulatedDevice:
+    """
+    One AirVisual device, file is regenerated lazily when it's read after an update time
+    """
+
+    def __init__(self, index: int, ip: str, update_interval: float, rng: random.Random,
+                 clock: Callable[[], float] = time.time):
+        self.ip = ip
+        self._update_interval = update_interval
+        self._phase = rng.uniform(0, update_interval)  # devices don't update at the same time
+        self._rng = rng
+        self._clock = clock
+        timezone = rng.choice(TIMEZONES)
+        self._timezone = gettz(timezone)
+        self._values = {key: start for key, (start, _, _, _) in SENSORS.items()}
+        self._payload = copy.deepcopy(REALISTIC_PAYLOAD)
+        self._payload['settings']['node_name'] = f'simulated-{index:05d}'
+        self._payload['settings']['timezone'] = timezone
+        self._payload['status']['ip_address'] = ip
+        self._update = None
+        self._file: Optional[FakeFile] = None
+        self._lock = threading.Lock()
+        self.updates = 0
+
+    def current_file(self) -> FakeFile:
+        now = self._clock()
+        update = math.floor((now - self._phase) / self._update_interval)
+        with self._lock:
+            if update != self._update:
+                self._update = update
+                self._file = self._write(self._phase + update * self._update_interval)
+            return self._file
+
+    def _write(self, updated_at: float) -> FakeFile:
+        for key, (_, step, minimum, maximum) in SENSORS.items():
+            self._values[key] = min(max(self._values[key] + self._rng.gauss(0, step), minimum), maximum)
+        measurements = {
+            key: str(round(value)) if key in INTEGER_KEYS else f'{value:.1f}'
+            for key, value in self._values.items()
+        }
+        measurements['temperature_F'] = f"{self._values['temperature_C'] * 9 / 5 + 32:.1f}"
+        aqi = _aqi_us(self._values['pm25_ugm3'])
+        measurements['pm25_AQIUS'] = str(aqi)
+        measurements['pm25_AQICN'] = str(aqi)
+        self._payload['measurements'] = [measurements]
+
+        # device writes its local wall clock time
+        local = datetime.fromtimestamp(int(updated_at), UTC).astimezone(self._timezone).replace(tzinfo=None)
+        self._payload['date_and_time'] = {
+            'date': local.strftime('%Y/%m/%d'),
+            'time': local.strftime('%H:%M:%S'),
+            'timestamp': str((local - EPOCH) // timedelta(seconds=1)),
+        }
+        self.updates += 1
+        return FakeFile(encode(self._payload), updated_at)
+
+
+class SimulatedFleet:
+    """
+    'devices' simulated devices with IPs like '10.0.0.1', every one updates its
+    file every 'update_interval' seconds. Every SMB call takes 'latency' seconds,
+    like a call over Wi-Fi does.
+    """
+
+    def __init__(self, devices: int, update_interval: float, latency: float = 0.0, seed: int = 0,
+                 clock: Callable[[], float] = time.time):
+        if update_interval < 1:
+            raise ValueError("Devices write time in seconds, update interval must be at least 1 second")
+        rng = random.Random(seed)
+        self.latency = latency
+        self.devices: Dict[str, SimulatedDevice] = {}
+        for index in range(devices):
+            ip = f'10.0.{index // 250}.{index % 250 + 1}'
+            self.devices[ip] = SimulatedDevice(index, ip, update_interval, random.Random(rng.random()), clock)
+
+    @property
+    def ips(self) -> List[str]:
+        return list(self.devices)
+
+    @property
+    def updates(self) -> int:
+        """
+        How many times devices wrote a new file, which was read
+        """
+        return sum(device.updates for device in self.devices.values())
+
+    def connection_factory(self, username, password, my_name, remote_name,
+                           *args, **kwargs) -> 'SimulatedSMBConnection':
+        return SimulatedSMBConnection(self, username, password, my_name, remote_name)
+
+
+class SimulatedSMBConnection(FakeSMBConnection):
+    """
+    SMB connection to a device of the simulated fleet
+    """
+
+    def __init__(self, fleet: SimulatedFleet, username, password, my_name, remote_name, *args, **kwargs):
+        super().__init__(username, password, my_name, remote_name)
+        self._fleet = fleet
+        self._device: Optional[SimulatedDevice] = None
+
+    def connect(self, ip, port=139, sock_family=None, timeout=60) -> bool:
+        self._wait()
+        self._device = self._fleet.devices.get(ip)
+        if self._device is None:
+            raise ConnectionRefusedError(f"No simulated device on {ip}")
+        return super().connect(ip, port, sock_family, timeout)
+
+    def echo(self, data, timeout=10):
+        self._wait()
+        return super().echo(data, timeout)
+
+    def retrieveFileFromOffset(self, service_name, path, file_obj, offset=0, max_length=-1, timeout=30, **kwargs):
+        self._wait()
+        return super().retrieveFileFromOffset(service_name, path, file_obj, offset, max_length, timeout)
+
+    def getAttributes(self, service_name, path, timeout=30):
+        self._wait()
+        return super().getAttributes(service_name, path, timeout)
+
+    def _get_file(self, path: str) -> FakeFile:
+        if path == MEASUREMENTS_FILE and self._device is not None:
+            return self._device.current_file()
+        return super()._get_file(path)
+
+    def _wait(self):
+        if self._fleet.latency:
+            time.sleep(self._fleet.latency)
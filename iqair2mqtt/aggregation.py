@@ -0,0 +1,199 @@
+import logging
+import math
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from iqair2mqtt.models.iqair_measurement import IQAirMeasurements
+
+logger = logging.getLogger(__name__)
+
+# every window is split into this many buckets, window slides by one bucket
+WINDOW_BUCKETS = 12
+PUBLISH_INTERVAL = 60.0
+
+
+class Aggregate(NamedTuple):
+    window: int  # seconds
+    count: int
+    min: float
+    max: float
+    mean: float
+    ema: float
+
+
+def parse_windows(spec: str) -> List[int]:
+    """
+    Parses windows like '1m,5m,1h' or '60,300', returns them in seconds.
+    Raises ValueError if spec is wrong.
+    """
+    multipliers = {'s': 1, 'm': 60, 'h': 3600}
+    windows = []
+    for item in spec.split(','):
+        item = item.strip().lower()
+        if not item:
+            continue
+        if item[-1] in multipliers:
+            seconds = int(item[:-1]) * multipliers[item[-1]]
+        else:
+            seconds = int(item)
+        if seconds <= 0:
+            raise ValueError(f"Window should be positive, got '{item}'")
+        windows.append(seconds)
+    return sorted(set(windows))
+
+
+def format_window(seconds: int) -> str:
+    """
+    Formats window for topic, like '5m' or '1h'
+    """
+    if seconds % 3600 == 0:
+        return f'{seconds // 3600}h'
+    if seconds % 60 == 0:
+        return f'{seconds // 60}m'
+    return f'{seconds}s'
+
+
+class WindowStats:
+    """
+    Min, max and mean of values for the last 'window' seconds.
+
+    Window is split into a ring of WINDOW_BUCKETS buckets, each one keeps count, sum,
+    min and max of its values. Adding a value is O(1), reading stats is O(buckets),
+    and memory doesn't depend on how often values come. Window slides by one bucket,
+    so the oldest values drop out a bucket at a time.
+    """
+
+    __slots__ = ('_bucket_width', '_bucket_ids', '_counts', '_sums', '_mins', '_maxs')
+
+    def __init__(self, window: float, buckets: int = WINDOW_BUCKETS):
+        self._bucket_width = window / buckets
+        self._bucket_ids = [-1] * buckets
+        self._counts = [0] * buckets
+        self._sums = [0.0] * buckets
+        self._mins = [math.inf] * buckets
+        self._maxs = [-math.inf] * buckets
+
+    def add(self, now: float, value: float):
+        bucket_id = int(now // self._bucket_width)
+        slot = bucket_id % len(self._bucket_ids)
+        if self._bucket_ids[slot] != bucket_id:
+            self._bucket_ids[slot] = bucket_id
+            self._counts[slot] = 0
+            self._sums[slot] = 0.0
+            self._mins[slot] = math.inf
+            self._maxs[slot] = -math.inf
+        self._counts[slot] += 1
+        self._sums[slot] += value
+        if value < self._mins[slot]:
+            self._mins[slot] = value
+        if value > self._maxs[slot]:
+            self._maxs[slot] = value
+
+    def stats(self, now: float) -> Optional[Tuple[int, float, float, float]]:
+        """
+        Returns count, min, max and mean, None if there were no values in the window
+        """
+        current_bucket_id = int(now // self._bucket_width)
+        buckets = len(self._bucket_ids)
+        count, total, minimum, maximum = 0, 0.0, math.inf, -math.inf
+        for slot, bucket_id in enumerate(self._bucket_ids):
+            if not 0 <= current_bucket_id - bucket_id < buckets:
+                continue
+            count += self._counts[slot]
+            total += self._sums[slot]
+            minimum = min(minimum, self._mins[slot])
+            maximum = max(maximum, self._maxs[slot])
+        if not count:
+            return None
+        return count, minimum, maximum, total / count
+
+
+class EMA:
+    """
+    Exponential moving average with time constant 'window' seconds,
+    values are weighted by time passed since the previous one
+    """
+
+    __slots__ = ('_window', '_value', '_updated_at')
+
+    def __init__(self, window: float):
+        self._window = window
+        self._value: Optional[float] = None
+        self._updated_at = 0.0
+
+    def add(self, now: float, value: float):
+        if self._value is None:
+            self._value = value
+        else:
+            alpha = 1 - math.exp(-max(now - self._updated_at, 0) / self._window)
+            self._value += alpha * (value - self._value)
+        self._updated_at = now
+
+    @property
+    def value(self) -> Optional[float]:
+        return self._value
+
+
+class DeviceAggregator:
+    """
+    Rolling aggregates of measurements of one device, for every measurement type
+    and window. State per measurement type is fixed size, so memory is bounded
+    by number of devices, measurement types and windows.
+    """
+
+    def __init__(self, windows: Sequence[int], publish_interval: float = PUBLISH_INTERVAL,
+                 clock: Callable[[], float] = time.monotonic):
+        self._windows = list(windows)
+        self._publish_interval = publish_interval
+        self._clock = clock
+        self._stats: Dict[Tuple[str, str], List[Tuple[WindowStats, EMA]]] = {}
+        self._published_at: Optional[float] = None
+
+    def add(self, iqair_measurements: IQAirMeasurements):
+        now = self._clock()
+        for measurement in iqair_measurements.measurements:
+            key = (measurement.name, measurement.unit)
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = [(WindowStats(window), EMA(window)) for window in self._windows]
+            for window_stats, ema in stats:
+                window_stats.add(now, measurement.value)
+                ema.add(now, measurement.value)
+
+    def is_due(self) -> bool:
+        """
+        Returns True if aggregates should be published now
+        """
+        return self.due_in() == 0
+
+    def due_in(self) -> float:
+        """
+        Seconds until aggregates should be published, 0 if they should be published now
+        """
+        if self._published_at is None:
+            return 0.0
+        return max(self._published_at + self._publish_interval - self._clock(), 0.0)
+
+    def mark_published(self):
+        """
+        Next aggregates are due after publish interval, called after they were published
+        """
+        self._published_at = self._clock()
+
+    def collect(self) -> Dict[Tuple[str, str], List[Aggregate]]:
+        """
+        Returns aggregates for every measurement type
+        """
+        now = self._clock()
+        result = {}
+        for key, stats in self._stats.items():
+            aggregates = []
+            for window, (window_stats, ema) in zip(self._windows, stats):
+                window_result = window_stats.stats(now)
+                if window_result is None:
+                    continue
+                count, minimum, maximum, mean = window_result
+                aggregates.append(Aggregate(window, count, minimum, maximum, mean, ema.value))
+            if aggregates:
+                result[key] = aggregates
+        return result
@@ -0,0 +1,471 @@
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from dateutil.tz import UTC
+
+from iqair2mqtt.config import Config
+from iqair2mqtt.json_encoder import get_encoder
+from iqair2mqtt.models.device import IQAirDevice
+from iqair2mqtt.models.iqair_measurement import IQAirMeasurement, IQAirMeasurements
+from iqair2mqtt.mqtt import MQTTPublisher
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+SEGMENT_SIZE = 4 * 1024 * 1024
+SEGMENT_DURATION = 24 * 60 * 60
+RETENTION = 30 * 24 * 60 * 60
+# every N-th sample of a segment gets an index entry
+INDEX_INTERVAL = 32
+
+EPOCH = datetime(1970, 1, 1, tzinfo=UTC)
+# record type, body length
+RECORD_HEADER = struct.Struct('<BI')
+RECORD_CRC = struct.Struct('<I')
+RECORD_DEVICE = 1  # device JSON
+RECORD_KEY = 2  # id of a (name, unit) pair
+RECORD_SAMPLE = 3
+# key id, name length, unit length
+KEY_HEADER = struct.Struct('<HBB')
+# measured at in microseconds since epoch, revision, number of measurements
+SAMPLE_HEADER = struct.Struct('<qqH')
+# key id, value type, value
+SAMPLE_VALUE = struct.Struct('<Hbd')
+# measured at of a sample, offset of its record
+INDEX_ENTRY = struct.Struct('<qQ')
+# values are stored as doubles, ints are marked to be restored as ints
+VALUE_FLOAT = 0
+VALUE_INT = 1
+
+
+def _to_timestamp(value: datetime) -> int:
+    """
+    Microseconds since epoch, naive datetime is considered UTC
+    """
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=UTC)
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def _pack_record(record_type: int, body: bytes) -> bytes:
+    record = RECORD_HEADER.pack(record_type, len(body)) + body
+    return record + RECORD_CRC.pack(zlib.crc32(record))
+
+
+def _read_records(data, offset: int) -> Iterator[Tuple[int, int, int, int]]:
+    """
+    Yields type, body start, body end and record end of valid records from 'offset',
+    stops on a torn or corrupted record
+    """
+    size = len(data)
+    while offset + RECORD_HEADER.size <= size:
+        record_type, body_length = RECORD_HEADER.unpack_from(data, offset)
+        body_start = offset + RECORD_HEADER.size
+        body_end = body_start + body_length
+        if body_end + RECORD_CRC.size > size:
+            return
+        (crc,) = RECORD_CRC.unpack_from(data, body_end)
+        if crc != zlib.crc32(data[offset:body_end]):
+            return
+        record_end = body_end + RECORD_CRC.size
+        yield record_type, body_start, body_end, record_end
+        offset = record_end
+
+
+class _SegmentHeader(NamedTuple):
+    device: IQAirDevice
+    keys: Dict[int, Tuple[str, str]]
+    end: int  # offset of the first sample
+
+
+def _read_header(data) -> Optional[_SegmentHeader]:
+    """
+    Reads device and keys records from the segment start, None if segment has no device
+    """
+    device = None
+    keys = {}
+    end = 0
+    for record_type, body_start, body_end, record_end in _read_records(data, 0):
+        if record_type == RECORD_DEVICE:
+            device = IQAirDevice(**json.loads(bytes(data[body_start:body_end])))
+        elif record_type == RECORD_KEY:
+            key_id, name_length, unit_length = KEY_HEADER.unpack_from(data, body_start)
+            name_start = body_start + KEY_HEADER.size
+            unit_start = name_start + name_length
+            keys[key_id] = (bytes(data[name_start:unit_start]).decode(),
+                            bytes(data[unit_start:unit_start + unit_length]).decode())
+        else:
+            break
+        end = record_end
+    if device is None:
+        return None
+    return _SegmentHeader(device, keys, end)
+
+
+class DeviceArchive:
+    """
+    Measurements of one device in a directory of append-only segment files.
+
+    Segment starts with the device and ids of its (name, unit) pairs, then
+    samples follow, 11 bytes per measurement. Every record has a checksum,
+    a record torn by crash is dropped on next start. A new segment is started
+    when the current one is too big or too old, or when device or set of
+    measurement types change, so segment header describes all its samples.
+    Samples are kept in time order, so segments are named by time of their
+    first sample, and every INDEX_INTERVAL-th sample is written to a sparse
+    index file next to the segment. Reads map segments into memory and use
+    the index to jump close to the start of the queried range.
+    Segments older than 'retention' seconds are deleted when a new segment is started.
+    """
+
+    def __init__(self, directory: str, retention: Optional[float] = None, segment_size: int = SEGMENT_SIZE,
+                 segment_duration: float = SEGMENT_DURATION, index_interval: int = INDEX_INTERVAL,
+                 clock: Callable[[], float] = time.time):
+        self._directory = directory
+        self._retention = retention
+        self._clock = clock
+        self._segment_size = segment_size
+        self._segment_duration = int(segment_duration * 1_000_000)
+        self._index_interval = index_interval
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._segments: List[int] = sorted(
+            int(file_name[:-len(SEGMENT_SUFFIX)])
+            for file_name in os.listdir(directory)
+            if file_name.endswith(SEGMENT_SUFFIX)
+        )
+        self._write_fh = None
+        self._index_fh = None
+        self._device: Optional[IQAirDevice] = None
+        self._keys: Dict[Tuple[str, str], int] = {}
+        self._samples = 0  # in the current segment
+        self._last_timestamp: Optional[int] = None
+        if self._segments:
+            self._recover_last_segment()
+
+    def append(self, iqair_measurements: IQAirMeasurements) -> bool:
+        """
+        Appends measurements, returns False if they are older than already archived ones
+        """
+        measurements = iqair_measurements.measurements
+        if not measurements:
+            return False
+        timestamp = _to_timestamp(measurements[0].measured_at)
+        with self._lock:
+            if self._last_timestamp is not None and timestamp <= self._last_timestamp:
+                return False
+            if self._needs_new_segment(iqair_measurements, timestamp):
+                self._start_segment(iqair_measurements, timestamp)
+            keys = self._keys
+            body = SAMPLE_HEADER.pack(timestamp, iqair_measurements.revision, len(measurements)) + b''.join(
+                SAMPLE_VALUE.pack(
+                    keys[(measurement.name, measurement.unit)],
+                    VALUE_INT if isinstance(measurement.value, int) else VALUE_FLOAT,
+                    measurement.value,
+                )
+                for measurement in measurements
+            )
+            offset = self._write_fh.tell()
+            self._write_fh.write(_pack_record(RECORD_SAMPLE, body))
+            self._write_fh.flush()
+            if self._samples % self._index_interval == 0:
+                self._index_fh.write(INDEX_ENTRY.pack(timestamp, offset))
+                self._index_fh.flush()
+            self._samples += 1
+            self._last_timestamp = timestamp
+        return True
+
+    def query(self, start: datetime, end: datetime) -> Iterator[IQAirMeasurements]:
+        """
+        Yields archived measurements taken from 'start' inclusive to 'end' exclusive, in time order
+        """
+        start_timestamp, end_timestamp = _to_timestamp(start), _to_timestamp(end)
+        with self._lock:
+            if self._write_fh is not None:
+                self._write_fh.flush()
+            # segments and their sizes now, what is appended while reading isn't returned
+            segments = [(segment, os.path.getsize(self._segment_path(segment))) for segment in self._segments]
+        for position, (segment, size) in enumerate(segments):
+            if segment >= end_timestamp:
+                return
+            if position + 1 < len(segments) and segments[position + 1][0] <= start_timestamp:
+                continue  # the whole segment is before the range
+            yield from self._query_segment(segment, size, start_timestamp, end_timestamp)
+
+    def apply_retention(self) -> int:
+        """
+        Deletes segments which have only samples older than retention, returns number of them.
+        The current segment is never deleted.
+        """
+        with self._lock:
+            return self._apply_retention()
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
+
+    def _apply_retention(self) -> int:
+        if self._retention is None:
+            return 0
+        oldest_allowed = int((self._clock() - self._retention) * 1_000_000)
+        deleted = 0
+        while len(self._segments) > 1 and self._segments[1] <= oldest_allowed:
+            self._remove_segment(self._segments.pop(0))
+            deleted += 1
+        if deleted:
+            logger.info("Deleted %d expired segments of archive %s", deleted, self._directory)
+        return deleted
+
+    def _remove_segment(self, segment: int):
+        for path in (self._segment_path(segment), self._index_path(segment)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _query_segment(self, segment: int, size: int, start: int, end: int) -> Iterator[IQAirMeasurements]:
+        if not size:
+            return
+        try:
+            with open(self._segment_path(segment), 'rb') as segment_fh:
+                data = mmap.mmap(segment_fh.fileno(), size, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return  # deleted by retention meanwhile
+        with data:
+            header = _read_header(data)
+            if header is None:
+                return
+            offset = header.end
+            index = self._read_index(segment)
+            # the last indexed sample before the range, all samples before it are older
+            position = bisect.bisect_left(index, (start,)) - 1
+            if position >= 0:
+                offset = index[position][1]
+            device, keys = header.device, header.keys
+            for record_type, body_start, _, _ in _read_records(data, offset):
+                if record_type != RECORD_SAMPLE:
+                    continue
+                timestamp, revision, count = SAMPLE_HEADER.unpack_from(data, body_start)
+                if timestamp >= end:
+                    return
+                if timestamp < start:
+                    continue
+                measured_at = EPOCH + timedelta(microseconds=timestamp)
+                values_start = body_start + SAMPLE_HEADER.size
+                measurements = []
+                for key_id, value_type, value in SAMPLE_VALUE.iter_unpack(
+                        data[values_start:values_start + count * SAMPLE_VALUE.size]):
+                    name, unit = keys[key_id]
+                    if value_type == VALUE_INT:
+                        value = int(value)
+                    measurements.append(IQAirMeasurement(measured_at=measured_at, name=name, value=value, unit=unit))
+                yield IQAirMeasurements(revision, device, measurements)
+
+    def _read_index(self, segment: int) -> List[Tuple[int, int]]:
+        try:
+            with open(self._index_path(segment), 'rb') as index_fh:
+                data = index_fh.read()
+        except FileNotFoundError:
+            return []
+        return list(INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]))
+
+    def _needs_new_segment(self, iqair_measurements: IQAirMeasurements, timestamp: int) -> bool:
+        if self._write_fh is None or iqair_measurements.device != self._device:
+            return True
+        if self._write_fh.tell() >= self._segment_size or timestamp - self._segments[-1] >= self._segment_duration:
+            return True
+        return any((measurement.name, measurement.unit) not in self._keys
+                   for measurement in iqair_measurements.measurements)
+
+    def _start_segment(self, iqair_measurements: IQAirMeasurements, timestamp: int):
+        self._close_segment()
+        # keys of the previous segment are kept, usually all samples have the same ones
+        keys = dict(self._keys) if iqair_measurements.device == self._device else {}
+        for measurement in iqair_measurements.measurements:
+            keys.setdefault((measurement.name, measurement.unit), len(keys))
+        self._segments.append(timestamp)
+        self._write_fh = open(self._segment_path(timestamp), 'wb')
+        self._index_fh = open(self._index_path(timestamp), 'wb')
+        self._write_fh.write(_pack_record(RECORD_DEVICE, json.dumps(iqair_measurements.device._asdict()).encode()))
+        for (name, unit), key_id in keys.items():
+            name_bytes, unit_bytes = name.encode(), unit.encode()
+            self._write_fh.write(_pack_record(
+                RECORD_KEY, KEY_HEADER.pack(key_id, len(name_bytes), len(unit_bytes)) + name_bytes + unit_bytes))
+        self._device = iqair_measurements.device
+        self._keys = keys
+        self._samples = 0
+        logger.debug("Started archive segment %d in %s", timestamp, self._directory)
+        self._apply_retention()
+
+    def _close_segment(self):
+        if self._write_fh is not None:
+            self._write_fh.close()
+            self._index_fh.close()
+            self._write_fh = self._index_fh = None
+
+    def _recover_last_segment(self):
+        """
+        Continues the last segment after restart, a torn record at its end is dropped
+        """
+        segment = self._segments[-1]
+        path = self._segment_path(segment)
+        with open(path, 'rb') as segment_fh:
+            data = segment_fh.read()
+        header = _read_header(data)
+        valid_end = header.end if header is not None else 0
+        samples = 0
+        last_timestamp = None
+        if header is not None:
+            for record_type, body_start, _, record_end in _read_records(data, header.end):
+                if record_type == RECORD_SAMPLE:
+                    last_timestamp = SAMPLE_HEADER.unpack_from(data, body_start)[0]
+                    samples += 1
+                valid_end = record_end
+        if not samples:
+            # crashed right after the segment was started
+            logger.warning("Archive segment %s has no samples, removing it", path)
+            self._remove_segment(self._segments.pop())
+            if self._segments:
+                self._recover_last_segment()
+            return
+        self._write_fh = open(path, 'r+b')
+        if valid_end < len(data):
+            logger.warning("Dropping torn record at the end of archive segment %s", path)
+            self._write_fh.truncate(valid_end)
+        self._write_fh.seek(valid_end)
+        # index entries of dropped samples are dropped too
+        index = [entry for entry in self._read_index(segment) if entry[1] < valid_end]
+        self._index_fh = open(self._index_path(segment), 'wb')
+        self._index_fh.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in index))
+        self._index_fh.flush()
+        self._device = header.device
+        self._keys = {key: key_id for key_id, key in header.keys.items()}
+        self._samples = samples
+        self._last_timestamp = last_timestamp
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self._directory, f'{segment:020d}{SEGMENT_SUFFIX}')
+
+    def _index_path(self, segment: int) -> str:
+        return os.path.join(self._directory, f'{segment:020d}{INDEX_SUFFIX}')
+
+
+def _directory_name(name: str) -> str:
+    return ''.join(char if char.isalnum() or char in '._-' else '_' for char in name)
+
+
+class MeasurementArchive:
+    """
+    Local archive of parsed measurements, a 'DeviceArchive' per device in
+    'directory', so downstream stores can be recovered without polling devices again.
+    Archive is thread safe.
+    """
+
+    def __init__(self, directory: str, retention: float = RETENTION, segment_size: int = SEGMENT_SIZE,
+                 segment_duration: float = SEGMENT_DURATION, clock: Callable[[], float] = time.time):
+        self._directory = directory
+        self._retention = retention
+        self._segment_size = segment_size
+        self._segment_duration = segment_duration
+        self._clock = clock
+        self._devices: Dict[str, DeviceArchive] = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, name: str, iqair_measurements: IQAirMeasurements) -> bool:
+        """
+        Archives measurements of device 'name', returns False if they are older than archived ones
+        """
+        return self._get(name).append(iqair_measurements)
+
+    def query(self, name: str, start: datetime, end: datetime) -> Iterator[IQAirMeasurements]:
+        """
+        Yields measurements of device 'name' taken from 'start' to 'end', naive datetimes are UTC
+        """
+        return self._get(name).query(start, end)
+
+    def names(self) -> List[str]:
+        """
+        Names of devices which have archives
+        """
+        return sorted(
+            entry.name for entry in os.scandir(self._directory) if entry.is_dir()
+        )
+
+    def apply_retention(self) -> int:
+        """
+        Deletes expired segments of all devices, returns number of them
+        """
+        return sum(self._get(name).apply_retention() for name in self.names())
+
+    def release(self, name: str):
+        """
+        Closes archive of device 'name' and forgets its state, it's read from disk again on the next use.
+        For when another process might write the archive.
+        """
+        with self._lock:
+            device_archive = self._devices.pop(_directory_name(name), None)
+        if device_archive is not None:
+            device_archive.close()
+
+    def close(self):
+        with self._lock:
+            for device_archive in self._devices.values():
+                device_archive.close()
+            self._devices.clear()
+
+    def _get(self, name: str) -> DeviceArchive:
+        directory_name = _directory_name(name)
+        with self._lock:
+            device_archive = self._devices.get(directory_name)
+            if device_archive is None:
+                device_archive = self._devices[directory_name] = DeviceArchive(
+                    os.path.join(self._directory, directory_name),
+                    self._retention,
+                    self._segment_size,
+                    self._segment_duration,
+                    clock=self._clock,
+                )
+            return device_archive
+
+
+def open_archive(directory: Optional[str], retention: float) -> Optional[MeasurementArchive]:
+    """
+    Opens measurements archive in 'directory', if it's set
+    """
+    if not directory:
+        return None
+    return MeasurementArchive(directory, retention)
+
+
+def replay(archive: MeasurementArchive, publisher: MQTTPublisher, config: Config, start: datetime, end: datetime,
+           names: Optional[List[str]] = None) -> int:
+    """
+    Publishes archived measurements from 'start' to 'end' again as JSON documents to
+    topics of their devices, returns number of published documents. Per measurement
+    topics are retained, so old values aren't replayed to them.
+    Documents are published in batches like in backfill, so the broker isn't flooded.
+    """
+    encoder = get_encoder(config.json_encoder)
+    published = 0
+    for name in names if names is not None else archive.names():
+        topic = config.device(name).topic
+        device_published = 0
+        for iqair_measurements in archive.query(name, start, end):
+            publisher.publish(iqair_measurements.to_json_bytes(encoder), topic=topic)
+            device_published += 1
+            if device_published % config.backfill_batch_size == 0:
+                time.sleep(config.backfill_batch_interval)
+        logger.info("Replayed %d archived measurements of IQAir %s", device_published, name)
+        published += device_published
+    return published
@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import time
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from iqair2mqtt.config import Config
+from iqair2mqtt.errors import IQAirDataCorrupted
+from iqair2mqtt.iqair_parser import (
+    EPOCH, convert_to_utc_datetime, parse_local_datetime, parse_measurements, parse_number,
+)
+from iqair2mqtt.json_encoder import get_encoder
+from iqair2mqtt.models.device import IQAirDevice
+from iqair2mqtt.models.iqair_measurement import IQAirMeasurements, IQAirMeasurement
+from iqair2mqtt.models.measurements_batch import IQAirMeasurementsBatch
+from iqair2mqtt.mqtt import MQTTPublisher
+from iqair2mqtt.source import MeasurementSource
+
+logger = logging.getLogger(__name__)
+
+# monthly history files, like '202012_AirVisual_values.txt'
+HISTORY_FILE_SUFFIX = '_AirVisual_values.txt'
+HISTORY_DELIMITER = ';'
+DATE_COLUMN = 'Date'
+TIME_COLUMN = 'Time'
+TIMESTAMP_COLUMN = 'Timestamp'
+# history file column -> measurement name and unit, like they are in latest measurements
+HISTORY_COLUMNS = {
+    'PM1(ug/m3)': ('pm01', 'ugm3'),
+    'PM2_5(ug/m3)': ('pm25', 'ugm3'),
+    'AQI(US)': ('pm25', 'aqius'),
+    'AQI(CN)': ('pm25', 'aqicn'),
+    'PM10(ug/m3)': ('pm10', 'ugm3'),
+    'Temperature(C)': ('temperature', 'c'),
+    'Temperature(F)': ('temperature', 'f'),
+    'Humidity(%RH)': ('humidity', 'rh'),
+    'CO2(ppm)': ('co2', 'ppm'),
+    'VOC(ppb)': ('voc', 'ppb'),
+}
+
+
+class HistoryParser:
+    """
+    Incremental parser of IQAir history file. File is fed by chunks, only the last
+    not finished line is kept between chunks, so memory doesn't depend on file size.
+    """
+
+    def __init__(self, device: IQAirDevice, timezone: str, offset: int = 0, header: Optional[List[str]] = None):
+        self._device = device
+        self._timezone = timezone
+        self._pending = b''
+        self._offset = offset  # offset in file of the first byte of pending data
+        self.header: Optional[List[str]] = None
+        self._columns: List[Tuple[int, str, str]] = []
+        self._date_index = self._time_index = self._timestamp_index = -1
+        if header is not None:
+            self._set_header(header)
+
+    def feed(self, chunk: bytes) -> Iterator[Tuple[int, IQAirMeasurements]]:
+        """
+        Yields measurements from complete lines of the chunk, with offset in file right after the line
+        """
+        lines = (self._pending + chunk).split(b'\n')
+        self._pending = lines.pop()
+        for line in lines:
+            self._offset += len(line) + 1
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                fields = [field.strip() for field in line.decode().split(HISTORY_DELIMITER)]
+                if self.header is None:
+                    self._set_header(fields)
+                    continue
+                measurements = self._parse_row(fields)
+            except (IndexError, ValueError) as exc:
+                logger.warning("Can't parse history line '%s', will skip it. Error: %s", line, exc)
+                continue
+            yield self._offset, measurements
+
+    def _set_header(self, header: List[str]):
+        self.header = header
+        try:
+            self._date_index = header.index(DATE_COLUMN)
+            self._time_index = header.index(TIME_COLUMN)
+        except ValueError as exc:
+            raise IQAirDataCorrupted(f"History file has no date or time column, header is {header}") from exc
+        self._timestamp_index = header.index(TIMESTAMP_COLUMN) if TIMESTAMP_COLUMN in header else -1
+        self._columns = [
+            (index, *HISTORY_COLUMNS[column])
+            for index, column in enumerate(header)
+            if column in HISTORY_COLUMNS
+        ]
+
+    def _parse_row(self, fields: List[str]) -> IQAirMeasurements:
+        local_date = fields[self._date_index]
+        local_time = fields[self._time_index]
+        if self._timestamp_index != -1:
+            timestamp = int(fields[self._timestamp_index])
+        else:
+            # same as device 'timestamp', local time in seconds since epoch
+            timestamp = int((parse_local_datetime(local_date, local_time) - EPOCH).total_seconds())
+        measured_at = convert_to_utc_datetime(local_date, local_time, self._timezone, timestamp)
+        measurements = []
+        for index, name, unit in self._columns:
+            raw_value = fields[index] if index < len(fields) else ''
+            if not raw_value:
+                continue
+            measurements.append(IQAirMeasurement(measured_at, name, parse_number(raw_value), unit))
+        return IQAirMeasurements(timestamp, self._device, measurements)
+
+
+class BackfillMark(NamedTuple):
+    """
+    What was already published from history of a device
+    """
+    timestamp: int  # the latest published measurements timestamp
+    file: str  # file and offset in it to continue from
+    offset: int
+    header: List[str]
+
+
+class BackfillState:
+    """
+    High-water marks of backfill per device, stored in a JSON file
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._marks: Dict[str, BackfillMark] = {}
+        try:
+            with open(path) as state_fh:
+                self._marks = {device: BackfillMark(**mark) for device, mark in json.load(state_fh).items()}
+        except FileNotFoundError:
+            pass
+
+    def get(self, device: str) -> Optional[BackfillMark]:
+        return self._marks.get(device)
+
+    def set(self, device: str, mark: BackfillMark):
+        self._marks[device] = mark
+        # write and rename, to never have half written state
+        with open(self._path + '.tmp', 'w') as state_fh:
+            json.dump({name: mark._asdict() for name, mark in self._marks.items()}, state_fh)
+        os.replace(self._path + '.tmp', self._path)
+
+
+class Backfill:
+    """
+    Publishes measurements from IQAir history files, which weren't published yet.
+    Files are streamed and parsed by chunks, measurements are published in batches
+    of 'batch_size' with 'batch_interval' seconds between batches, so the broker
+    isn't flooded. After every batch high-water mark is saved, so reruns only
+    publish new data, even if previous run was interrupted.
+    """
+
+    def __init__(self, config: Config, publisher: MQTTPublisher, state: BackfillState,
+                 batch_size: int, batch_interval: float):
+        self._config = config
+        self._publisher = publisher
+        self._encoder = get_encoder(config.json_encoder)
+        self._state = state
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+
+    def run(self, iqair: MeasurementSource, name: str) -> int:
+        """
+        Backfills history of one device, returns number of published measurements
+        """
+        device_config = self._config.device(name)
+        raw_measurements = iqair.get_latest_measurements()
+        device = parse_measurements(device_config, raw_measurements).device
+        try:
+            timezone = raw_measurements['settings']['timezone']
+        except KeyError as exc:
+            raise IQAirDataCorrupted(f"Can't fine key '{str(exc)}' in iqair data")
+
+        mark = self._state.get(name)
+        published = 0
+        for history_file in iqair.list_files(HISTORY_FILE_SUFFIX):
+            if mark is not None and history_file < mark.file:
+                continue  # file was published completely
+            if mark is not None and history_file == mark.file:
+                parser = HistoryParser(device, timezone, mark.offset, mark.header)
+                offset = mark.offset
+            else:
+                parser = HistoryParser(device, timezone)
+                offset = 0
+            logger.info("Backfilling IQAir %s from %s, offset %d", name, history_file, offset)
+
+            # up to 'batch_size' samples are kept until they are published, in compact form
+            batch = IQAirMeasurementsBatch(device)
+            for chunk in iqair.stream_file(history_file, offset):
+                for end_offset, measurements in parser.feed(chunk):
+                    if mark is not None and measurements.revision <= mark.timestamp:
+                        continue
+                    batch.append(measurements)
+                    if len(batch) >= self._batch_size:
+                        mark = self._publish_batch(name, device_config.topic, batch, history_file, end_offset,
+                                                   parser.header)
+                        published += len(batch)
+                        batch = IQAirMeasurementsBatch(device)
+                        time.sleep(self._batch_interval)
+            if len(batch):
+                mark = self._publish_batch(name, device_config.topic, batch, history_file, end_offset, parser.header)
+                published += len(batch)
+
+        logger.info("Backfilled %d measurements of IQAir %s", published, name)
+        return published
+
+    def _publish_batch(self, name: str, topic: str, batch: IQAirMeasurementsBatch, history_file: str,
+                       offset: int, header: List[str]) -> BackfillMark:
+        for measurements in batch:
+            self._publisher.publish(measurements.to_json_bytes(self._encoder), topic=topic)
+        mark = BackfillMark(batch[-1].revision, history_file, offset, header)
+        self._state.set(name, mark)
+        return mark
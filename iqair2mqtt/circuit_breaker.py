@@ -0,0 +1,109 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional, Union
+
+from iqair2mqtt import errors, metrics
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+
+FAILURE_THRESHOLD = 3
+OPEN_TIMEOUT = 30.0
+MAX_OPEN_TIMEOUT = 600.0
+
+
+class CircuitBreaker:
+    """
+    Stops connection attempts to a device which is offline.
+
+    After 'failure_threshold' failures in a row the breaker opens, and calls fail
+    right away with 'IQAirCircuitOpen' for 'open_timeout' seconds. Then it's half
+    open: one probe call is let through, if it succeeds the breaker closes, if it
+    fails the breaker opens again for twice longer, up to 'max_open_timeout'.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = FAILURE_THRESHOLD, open_timeout: float = OPEN_TIMEOUT,
+                 max_open_timeout: float = MAX_OPEN_TIMEOUT, clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self._failure_threshold = failure_threshold
+        self._open_timeout = open_timeout
+        self._max_open_timeout = max_open_timeout
+        self._clock = clock
+        self._opened = metrics.IQAIR_CIRCUIT_OPENED.labels(name)
+        self._lock = threading.Lock()
+        self.state = STATE_CLOSED
+        self.failures = 0  # in a row
+        self._current_open_timeout = open_timeout
+        self._retry_at = 0.0
+        self._last_success_at: Optional[float] = None  # seconds since epoch
+        self._last_failure_at: Optional[float] = None
+        self._last_error = ''
+
+    def before_call(self):
+        """
+        Raises 'IQAirCircuitOpen' if call shouldn't be done now
+        """
+        with self._lock:
+            if self.state == STATE_CLOSED:
+                return
+            retry_in = self._retry_at - self._clock()
+            if self.state == STATE_OPEN and retry_in <= 0:
+                self._set_state(STATE_HALF_OPEN)
+                return  # this call is the probe
+            raise errors.IQAirCircuitOpen(self.name, max(retry_in, 0))
+
+    def on_success(self):
+        with self._lock:
+            self.failures = 0
+            self._current_open_timeout = self._open_timeout
+            self._last_success_at = time.time()
+            if self.state != STATE_CLOSED:
+                self._set_state(STATE_CLOSED)
+
+    def on_failure(self, error: Union[Exception, str] = ''):
+        with self._lock:
+            self.failures += 1
+            self._last_failure_at = time.time()
+            self._last_error = str(error)
+            if self.state == STATE_HALF_OPEN:
+                # probe failed, wait longer before next one
+                self._current_open_timeout = min(self._current_open_timeout * 2, self._max_open_timeout)
+                self._open()
+            elif self.state == STATE_CLOSED and self.failures >= self._failure_threshold:
+                self._open()
+
+    def retry_in(self) -> float:
+        """
+        Seconds until calls are allowed again, 0 if they are allowed now
+        """
+        with self._lock:
+            if self.state != STATE_OPEN:
+                return 0.0
+            return max(self._retry_at - self._clock(), 0.0)
+
+    def health(self) -> Dict:
+        with self._lock:
+            retry_in = max(self._retry_at - self._clock(), 0.0) if self.state == STATE_OPEN else 0.0
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'retry_in': retry_in,
+                'last_success_at': self._last_success_at,
+                'last_failure_at': self._last_failure_at,
+                'last_error': self._last_error,
+            }
+
+    def _open(self):
+        self._retry_at = self._clock() + self._current_open_timeout
+        logger.warning("IQAir %s failed %d times in a row, will not connect to it for %.0f seconds",
+                       self.name, self.failures, self._current_open_timeout)
+        self._opened.inc()
+        self._set_state(STATE_OPEN)
+
+    def _set_state(self, state: str):
+        logger.info("Circuit breaker of IQAir %s is %s", self.name, state)
+        self.state = state
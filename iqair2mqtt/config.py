@@ -1,10 +1,20 @@
+import json
 import logging
 from os import environ
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
-from iqair2mqtt.errors import ConfigVariableMissing
+from iqair2mqtt.aggregation import parse_windows
+from iqair2mqtt.deadband import Deadband, parse_deadbands
+from iqair2mqtt.errors import ConfigFileWrong, ConfigVariableMissing, ConfigVariableWrong
+from iqair2mqtt.json_encoder import ENCODERS
 
 logger = logging.getLogger(__name__)
 
+PUBLISH_MODE_JSON = 'json'
+PUBLISH_MODE_PER_MEASUREMENT = 'per_measurement'
+PUBLISH_MODE_BOTH = 'both'
+PUBLISH_MODES = (PUBLISH_MODE_JSON, PUBLISH_MODE_PER_MEASUREMENT, PUBLISH_MODE_BOTH)
+
 
 class Config:
 
@@ -17,18 +27,140 @@ class Config:
         'MQTT_PASSWORD',
     ]
 
-    def __init__(self, config_file_path: str):
+    # variables which can be omitted, with their default values
+    optional_variables = {
+        'IQAIR_CONCURRENCY': '4',
+        'POLL_WORKERS': '0',
+        'AGGREGATION_WINDOWS': '',
+        'AGGREGATION_PUBLISH_INTERVAL': '60',
+        'ARCHIVE_DIR': '',
+        'ARCHIVE_RETENTION': str(30 * 24 * 60 * 60),
+        'BREAKER_FAILURE_THRESHOLD': '3',
+        'BREAKER_OPEN_TIMEOUT': '30',
+        'BREAKER_MAX_OPEN_TIMEOUT': '600',
+        'BACKFILL_STATE_FILE': 'iqair2mqtt_backfill.json',
+        'BACKFILL_BATCH_SIZE': '100',
+        'BACKFILL_BATCH_INTERVAL': '1',
+        'DEADBAND': '',
+        'HA_DISCOVERY_PREFIX': '',
+        'HA_DISCOVERY_STATE_FILE': 'iqair2mqtt_discovery.json',
+        'DEADBAND_HEARTBEAT': '300',
+        'JSON_ENCODER': 'auto',
+        'METRICS_PORT': '',
+        'API_PORT': '',
+        'UPDATE_INTERVAL': '15',
+        'LOCATION': 'some_location',
+        'PLACEMENT': 'some_placement',
+        'MQTT_TOPIC': 'iqair2mqtt',
+        'CONFIG_RELOAD_INTERVAL': '5',
+        'MQTT_PORT': '1883',
+        'MQTT_PUBLISH_MODE': 'json',
+        'MQTT_QUEUE_DIR': '',
+        'MQTT_QUEUE_MAX_BYTES': str(50 * 1024 * 1024),
+        'MQTT_QUEUE_MAX_AGE': str(7 * 24 * 60 * 60),
+    }
+
+    # optional variables which are numbers, with their type and minimal value.
+    # Ones which are empty by default can be left empty
+    numeric_variables = {
+        'IQAIR_CONCURRENCY': (int, 1),
+        'POLL_WORKERS': (int, 0),
+        'AGGREGATION_PUBLISH_INTERVAL': (float, 0),
+        'ARCHIVE_RETENTION': (float, 0),
+        'BREAKER_FAILURE_THRESHOLD': (int, 1),
+        'BREAKER_OPEN_TIMEOUT': (float, 0),
+        'BREAKER_MAX_OPEN_TIMEOUT': (float, 0),
+        'BACKFILL_BATCH_SIZE': (int, 1),
+        'BACKFILL_BATCH_INTERVAL': (float, 0),
+        'DEADBAND_HEARTBEAT': (float, 0),
+        'METRICS_PORT': (int, 0),
+        'API_PORT': (int, 0),
+        'UPDATE_INTERVAL': (int, 1),
+        'CONFIG_RELOAD_INTERVAL': (float, 0),
+        'MQTT_PORT': (int, 1),
+        'MQTT_QUEUE_MAX_BYTES': (int, 0),
+        'MQTT_QUEUE_MAX_AGE': (int, 0),
+    }
+
+    # variables which can be omitted if config file describes devices
+    device_variables = ('IQAIR_IP', 'IQAIR_LOGIN', 'IQAIR_PASSWORD')
+
+    def __init__(self, config_file_path: Optional[str] = None):
+        """
+        Variables are taken from environment, then from 'settings' of the config file,
+        if it's set. Config file can also describe devices with own settings.
+        """
+        self.config_file_path = config_file_path
+        file_settings, file_devices = self._load_file(config_file_path) if config_file_path else ({}, None)
+
         for required_variable in self.required_variables:
-            if required_variable not in environ:
-                raise ConfigVariableMissing(required_variable)
             attr_name = f'_{required_variable.lower()}'
-            setattr(self, attr_name, environ[required_variable])
+            if required_variable in environ:
+                value = environ[required_variable]
+            elif required_variable in file_settings:
+                value = file_settings[required_variable]
+            elif file_devices is not None and required_variable in self.device_variables:
+                value = ''  # every device has to set it
+            else:
+                raise ConfigVariableMissing(required_variable)
+            setattr(self, attr_name, value)
             logger.debug("Saved variable '%s' to attribute 'self.%s'", required_variable, attr_name)
+        for optional_variable, default in self.optional_variables.items():
+            attr_name = f'_{optional_variable.lower()}'
+            setattr(self, attr_name, environ.get(optional_variable, file_settings.get(optional_variable, default)))
+            logger.debug("Saved variable '%s' to attribute 'self.%s'", optional_variable, attr_name)
+        for numeric_variable, (number_type, minimum) in self.numeric_variables.items():
+            value = getattr(self, f'_{numeric_variable.lower()}')
+            if value == '' and self.optional_variables[numeric_variable] == '':
+                continue
+            try:
+                number = number_type(value)
+            except ValueError as exc:
+                raise ConfigVariableWrong(numeric_variable, value) from exc
+            if number < minimum:
+                raise ConfigVariableWrong(numeric_variable, value)
+
+        self.devices = self._build_devices(file_devices)
+
+        if self._mqtt_publish_mode not in PUBLISH_MODES:
+            raise ConfigVariableWrong('MQTT_PUBLISH_MODE', self._mqtt_publish_mode)
+        if self._json_encoder not in ENCODERS:
+            raise ConfigVariableWrong('JSON_ENCODER', self._json_encoder)
+        try:
+            parse_deadbands(self._deadband)
+        except ValueError as exc:
+            raise ConfigVariableWrong('DEADBAND', self._deadband) from exc
+        try:
+            parse_windows(self._aggregation_windows)
+        except ValueError as exc:
+            raise ConfigVariableWrong('AGGREGATION_WINDOWS', self._aggregation_windows) from exc
 
     @property
     def iqair_ip(self) -> str:
         return self._iqair_ip
 
+    @property
+    def iqair_ips(self) -> List[str]:
+        """
+        IPs of all IQAir devices, 'IQAIR_IP' can contain few of them separated by comma
+        """
+        return [ip.strip() for ip in self._iqair_ip.split(',') if ip.strip()]
+
+    @property
+    def iqair_concurrency(self) -> int:
+        """
+        How many IQAir devices can be polled at the same time
+        """
+        return int(self._iqair_concurrency)
+
+    @property
+    def poll_workers(self) -> int:
+        """
+        How many processes poll devices, devices are split between them.
+        With 0 or 1 devices are polled in the main process.
+        """
+        return int(self._poll_workers)
+
     @property
     def iqair_login(self) -> str:
         return self._iqair_login
@@ -41,6 +173,10 @@ class Config:
     def mqtt_hostname(self) -> str:
         return self._mqtt_hostname
 
+    @property
+    def mqtt_port(self) -> int:
+        return int(self._mqtt_port)
+
     @property
     def mqtt_login(self) -> str:
         return self._mqtt_login
@@ -49,18 +185,262 @@ class Config:
     def mqtt_password(self) -> str:
         return self._mqtt_password
 
+    @property
+    def mqtt_publish_mode(self) -> str:
+        """
+        How measurements are published: 'json' - one document to the topic,
+        'per_measurement' - every measurement to own retained topic, 'both' - both of them
+        """
+        return self._mqtt_publish_mode
+
+    @property
+    def mqtt_queue_dir(self) -> str:
+        """
+        Directory for messages which couldn't be sent to MQTT broker, empty means no queue
+        """
+        return self._mqtt_queue_dir
+
+    @property
+    def mqtt_queue_max_bytes(self) -> int:
+        return int(self._mqtt_queue_max_bytes)
+
+    @property
+    def mqtt_queue_max_age(self) -> int:
+        """
+        Max age of queued messages in seconds, older ones are dropped
+        """
+        return int(self._mqtt_queue_max_age)
+
+    @property
+    def backfill_state_file(self) -> str:
+        """
+        File where backfill keeps what was already published from IQAir history
+        """
+        return self._backfill_state_file
+
+    @property
+    def backfill_batch_size(self) -> int:
+        return int(self._backfill_batch_size)
+
+    @property
+    def backfill_batch_interval(self) -> float:
+        """
+        Pause in seconds between backfill batches
+        """
+        return float(self._backfill_batch_interval)
+
+    @property
+    def archive_dir(self) -> str:
+        """
+        Directory for local archive of measurements, empty means no archive
+        """
+        return self._archive_dir
+
+    @property
+    def archive_retention(self) -> float:
+        """
+        How long measurements are kept in the archive, in seconds
+        """
+        return float(self._archive_retention)
+
+    @property
+    def breaker_failure_threshold(self) -> int:
+        """
+        Failed connections to IQAir in a row after which device is considered offline
+        """
+        return int(self._breaker_failure_threshold)
+
+    @property
+    def breaker_open_timeout(self) -> float:
+        """
+        Seconds after which offline device is tried again, doubled after every failed try
+        """
+        return float(self._breaker_open_timeout)
+
+    @property
+    def breaker_max_open_timeout(self) -> float:
+        return float(self._breaker_max_open_timeout)
+
+    @property
+    def deadbands(self) -> Optional[Dict[str, Deadband]]:
+        """
+        Measurements changed less than deadband aren't published, like '*=1%,pm25=2,temperature_c=0.2'.
+        None means all measurements are published.
+        """
+        return parse_deadbands(self._deadband) if self._deadband else None
+
+    @property
+    def deadband_heartbeat(self) -> float:
+        """
+        Max seconds a measurement isn't published because of deadband
+        """
+        return float(self._deadband_heartbeat)
+
+    @property
+    def aggregation_windows(self) -> List[int]:
+        """
+        Windows in seconds for rolling aggregates, like '1m,5m,1h'. Empty means no aggregates.
+        """
+        return parse_windows(self._aggregation_windows)
+
+    @property
+    def aggregation_publish_interval(self) -> float:
+        """
+        How often aggregates are published, in seconds
+        """
+        return float(self._aggregation_publish_interval)
+
+    @property
+    def ha_discovery_prefix(self) -> str:
+        """
+        Home Assistant MQTT discovery prefix, usually 'homeassistant'. Empty means no discovery.
+        """
+        return self._ha_discovery_prefix
+
+    @property
+    def ha_discovery_state_file(self) -> str:
+        """
+        File where measurement types already announced to Home Assistant are kept
+        """
+        return self._ha_discovery_state_file
+
+    @property
+    def json_encoder(self) -> str:
+        """
+        JSON library for published documents: 'orjson', 'json' or 'auto' - orjson if it's installed
+        """
+        return self._json_encoder
+
+    @property
+    def metrics_port(self) -> Optional[int]:
+        """
+        Port for Prometheus metrics endpoint, None means endpoint is disabled
+        """
+        return int(self._metrics_port) if self._metrics_port else None
+
+    @property
+    def api_port(self) -> Optional[int]:
+        """
+        Port for HTTP API with the latest measurements, None means API is disabled
+        """
+        return int(self._api_port) if self._api_port else None
+
+    @property
+    def config_reload_interval(self) -> float:
+        """
+        How often config file is checked for changes, in seconds, 0 means it isn't reloaded
+        """
+        return float(self._config_reload_interval)
+
+    @property
+    def update_interal(self) -> int:
+        return int(self._update_interval)
+
+    @property
+    def get_location(self) -> str:
+        return self._location
+
+    @property
+    def get_placement(self) -> str:
+        return self._placement
+
+    @property
+    def get_topic(self) -> str:
+        return self._mqtt_topic
+
+    def device(self, ip: str) -> 'DeviceConfig':
+        """
+        Returns config of device, devices which aren't in config get default settings
+        """
+        for device in self.devices:
+            if device.ip == ip:
+                return device
+        return self._default_device(ip)
+
+    def _default_device(self, ip: str) -> 'DeviceConfig':
+        return DeviceConfig(
+            ip=ip,
+            login=self._iqair_login,
+            password=self._iqair_password,
+            interval=self.update_interal,
+            topic=self.get_topic,
+            location=self.get_location,
+            placement=self.get_placement,
+        )
+
+    def _build_devices(self, file_devices: Optional[List[Dict]]) -> List['DeviceConfig']:
+        if file_devices is None:
+            return [self._default_device(ip) for ip in self.iqair_ips]
+        devices = []
+        for file_device in file_devices:
+            if not isinstance(file_device, dict) or 'ip' not in file_device:
+                raise ConfigFileWrong(self.config_file_path, f"device {file_device} has no 'ip'")
+            unknown = set(file_device) - set(DeviceConfig._fields)
+            if unknown:
+                raise ConfigFileWrong(self.config_file_path, f"device {file_device['ip']} has unknown keys {unknown}")
+            device = self._default_device(str(file_device['ip']))._replace(**file_device)
+            # devices read from a local directory don't need credentials
+            if not device.login and not device.directory:
+                raise ConfigVariableMissing('IQAIR_LOGIN')
+            if not device.password and not device.directory:
+                raise ConfigVariableMissing('IQAIR_PASSWORD')
+            try:
+                interval = int(device.interval)
+            except (TypeError, ValueError) as exc:
+                raise ConfigFileWrong(self.config_file_path, f"device {device.ip} has wrong interval") from exc
+            if interval < 1:
+                raise ConfigFileWrong(self.config_file_path, f"device {device.ip} has wrong interval")
+            devices.append(device._replace(interval=interval))
+        if len({device.ip for device in devices}) != len(devices):
+            raise ConfigFileWrong(self.config_file_path, "devices have duplicated IPs")
+        return devices
+
+    @staticmethod
+    def _load_file(path: str) -> Tuple[Dict[str, str], Optional[List[Dict]]]:
+        """
+        Returns settings and devices from JSON config file, devices are None if file doesn't have them
+        """
+        try:
+            with open(path) as config_fh:
+                content = json.load(config_fh)
+        except (OSError, ValueError) as exc:
+            raise ConfigFileWrong(path, str(exc)) from exc
+        if not isinstance(content, dict):
+            raise ConfigFileWrong(path, "it should be a JSON object")
+        settings = content.get('settings', {})
+        devices = content.get('devices')
+        if not isinstance(settings, dict) or (devices is not None and not isinstance(devices, list)):
+            raise ConfigFileWrong(path, "'settings' should be an object and 'devices' a list")
+        return {name: str(value) for name, value in settings.items()}, devices
+
+
+class DeviceConfig(NamedTuple):
+    """
+    Settings of one IQAir device. Has the same properties as 'Config' which
+    are used for parsing, so it can be used instead of it.
+    """
+    ip: str
+    login: str
+    password: str
+    interval: int
+    topic: str
+    location: str
+    placement: str
+    # local directory with device files, like a mounted share, it's read instead of SMB
+    directory: str = ''
+
     @property
     def update_interal(self) -> int:
-        return 15
+        return self.interval
 
     @property
     def get_location(self) -> str:
-        return "some_location"
+        return self.location
 
     @property
     def get_placement(self) -> str:
-        return "some_placement"
+        return self.placement
 
     @property
     def get_topic(self) -> str:
-        return "iqair2mqtt"
+        return self.topic
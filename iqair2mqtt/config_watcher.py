@@ -0,0 +1,66 @@
+import logging
+import os
+import threading
+from typing import Callable, Optional, Tuple
+
+from iqair2mqtt.config import Config
+from iqair2mqtt.errors import ConfigFileWrong, ConfigVariableMissing, ConfigVariableWrong
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigWatcher:
+    """
+    Checks config file every 'interval' seconds in a background thread, when
+    it's changed, it's loaded and passed to 'on_change'. Config with errors is
+    logged and ignored, so a typo doesn't stop the running process.
+    """
+
+    def __init__(self, path: str, on_change: Callable[[Config], None], interval: float):
+        self._path = path
+        self._on_change = on_change
+        self._interval = interval
+        self._signature = self._get_signature()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._watch, name='config-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def check(self) -> bool:
+        """
+        Reloads config if file was changed since the last check, returns True if new config was applied
+        """
+        signature = self._get_signature()
+        if signature == self._signature:
+            return False
+        self._signature = signature
+        try:
+            config = Config(self._path)
+        except (ConfigFileWrong, ConfigVariableMissing, ConfigVariableWrong) as exc:
+            logger.error("Config file %s was changed, but can't be loaded, keeping old config. Err %s",
+                         self._path, exc)
+            return False
+        logger.info("Config file %s was changed, applying it", self._path)
+        self._on_change(config)
+        return True
+
+    def _watch(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self.check()
+            except Exception:
+                logger.error("Can't apply changed config file %s", self._path, exc_info=True)
+
+    def _get_signature(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self._path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
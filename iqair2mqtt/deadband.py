@@ -0,0 +1,104 @@
+import logging
+import time
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+from iqair2mqtt.models.iqair_measurement import IQAirMeasurement, IQAirMeasurements
+
+logger = logging.getLogger(__name__)
+
+# key of deadband, which is used for measurements without own one
+DEFAULT_KEY = '*'
+HEARTBEAT = 300.0
+
+
+class Deadband(NamedTuple):
+    """
+    Change of a value smaller than 'absolute' and smaller than 'relative' part
+    of the last published value isn't published
+    """
+    absolute: float = 0.0
+    relative: float = 0.0
+
+    def exceeded(self, last_value: float, value: float) -> bool:
+        return abs(value - last_value) > max(self.absolute, self.relative * abs(last_value))
+
+
+def parse_deadbands(spec: str) -> Dict[str, Deadband]:
+    """
+    Parses deadbands like '*=1%,pm25=2,temperature_c=0.2', key is measurement name,
+    or name and unit, '*' is for all other measurements. Value with '%' is relative.
+    Raises ValueError if spec is wrong.
+    """
+    deadbands: Dict[str, Deadband] = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        key, separator, value = item.partition('=')
+        key, value = key.strip(), value.strip()
+        if not separator or not key or not value:
+            raise ValueError(f"Deadband should look like 'name=value', got '{item}'")
+        if value.endswith('%'):
+            deadband = Deadband(relative=float(value[:-1]) / 100)
+        else:
+            deadband = Deadband(absolute=float(value))
+        if deadband.absolute < 0 or deadband.relative < 0:
+            raise ValueError(f"Deadband can't be negative, got '{item}'")
+        deadbands[key] = deadband
+    return deadbands
+
+
+class DeadbandFilter:
+    """
+    Drops measurements of one device which didn't change meaningfully since
+    they were published last time. Every measurement is published at least every
+    'heartbeat' seconds, so consumers can tell a steady value from a dead device.
+    Values are compared with the last published value, not with the last seen one,
+    so a slow drift is published once it's over the deadband.
+    """
+
+    def __init__(self, deadbands: Dict[str, Deadband], heartbeat: float = HEARTBEAT,
+                 clock: Callable[[], float] = time.monotonic):
+        self._deadbands = deadbands
+        self._default = deadbands.get(DEFAULT_KEY, Deadband())
+        self._heartbeat = heartbeat
+        self._clock = clock
+        # (name, unit) -> last published value and when it was published
+        self._published: Dict[Tuple[str, str], Tuple[float, float]] = {}
+        self._deadband_cache: Dict[Tuple[str, str], Deadband] = {}
+
+    def filter(self, iqair_measurements: IQAirMeasurements) -> Optional[IQAirMeasurements]:
+        """
+        Returns measurements which should be published, None if there are no such.
+        'mark_published' should be called after they are published.
+        """
+        now = self._clock()
+        changed = [
+            measurement
+            for measurement in iqair_measurements.measurements
+            if self._should_publish(measurement, now)
+        ]
+        if not changed:
+            return None
+        if len(changed) == len(iqair_measurements.measurements):
+            return iqair_measurements
+        return IQAirMeasurements(iqair_measurements.revision, iqair_measurements.device, changed)
+
+    def mark_published(self, iqair_measurements: IQAirMeasurements):
+        now = self._clock()
+        for measurement in iqair_measurements.measurements:
+            self._published[(measurement.name, measurement.unit)] = (measurement.value, now)
+
+    def _should_publish(self, measurement: IQAirMeasurement, now: float) -> bool:
+        key = (measurement.name, measurement.unit)
+        published = self._published.get(key)
+        if published is None or now - published[1] >= self._heartbeat:
+            return True
+        return self._get_deadband(key).exceeded(published[0], measurement.value)
+
+    def _get_deadband(self, key: Tuple[str, str]) -> Deadband:
+        deadband = self._deadband_cache.get(key)
+        if deadband is None:
+            name, unit = key
+            deadband = self._deadbands.get(f'{name}_{unit}') or self._deadbands.get(name) or self._default
+            self._deadband_cache[key] = deadband
+        return deadband
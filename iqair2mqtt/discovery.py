@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+import threading
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from iqair2mqtt.json_encoder import JSONEncoder
+from iqair2mqtt.models.device import IQAirDevice
+from iqair2mqtt.models.iqair_measurement import IQAirMeasurements
+from iqair2mqtt.mqtt import MQTTPublisher
+from iqair2mqtt.topics import MeasurementTopics
+
+logger = logging.getLogger(__name__)
+
+DISCOVERY_COMPONENT = 'sensor'
+# (measurement name, unit) -> Home Assistant device class and unit of measurement
+SENSOR_CLASSES: Dict[Tuple[str, str], Tuple[Optional[str], Optional[str]]] = {
+    ('pm01', 'ugm3'): ('pm1', 'µg/m³'),
+    ('pm25', 'ugm3'): ('pm25', 'µg/m³'),
+    ('pm10', 'ugm3'): ('pm10', 'µg/m³'),
+    ('pm25', 'aqius'): ('aqi', None),
+    ('pm25', 'aqicn'): ('aqi', None),
+    ('co2', 'ppm'): ('carbon_dioxide', 'ppm'),
+    ('temperature', 'c'): ('temperature', '°C'),
+    ('temperature', 'f'): ('temperature', '°F'),
+    ('humidity', 'rh'): ('humidity', '%'),
+    ('voc', 'ppb'): ('volatile_organic_compounds_parts', 'ppb'),
+}
+
+# device key, measurement name, unit
+Announcement = Tuple[str, str, str]
+
+
+def _object_id(value: str) -> str:
+    """
+    Home Assistant allows only letters, digits, '_' and '-' in discovery topic ids
+    """
+    return ''.join(char if char.isalnum() or char in '_-' else '_' for char in value)
+
+
+class AnnouncedState:
+    """
+    Measurement types which were already announced to Home Assistant, stored in a JSON file
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self.announced: Set[Announcement] = set()
+        try:
+            with open(path) as state_fh:
+                self.announced = {tuple(announcement) for announcement in json.load(state_fh)}
+        except FileNotFoundError:
+            pass
+
+    def add(self, announcements: Iterable[Announcement]):
+        self.announced.update(announcements)
+        # write and rename, to never have half written state
+        with open(self._path + '.tmp', 'w') as state_fh:
+            json.dump(sorted(self.announced), state_fh)
+        os.replace(self._path + '.tmp', self._path)
+
+
+class HomeAssistantDiscovery:
+    """
+    Publishes retained Home Assistant MQTT discovery configs, one sensor for
+    every device and measurement type, so they appear in Home Assistant without
+    manual configuration.
+    Announced measurement types are kept in memory and in a state file, so configs
+    are only published when a new device or measurement type appears.
+    """
+
+    def __init__(self, publisher: MQTTPublisher, encoder: JSONEncoder, discovery_prefix: str, topic: str,
+                 per_measurement: bool, state: AnnouncedState):
+        self._publisher = publisher
+        self._encoder = encoder
+        self._discovery_prefix = discovery_prefix
+        self._topic = topic
+        self._measurement_topics: Dict[str, MeasurementTopics] = {}
+        # state is read from per measurement topics, otherwise from the JSON document
+        self._per_measurement = per_measurement
+        self._state = state
+        self._lock = threading.Lock()
+
+    def announce(self, iqair_measurements: IQAirMeasurements, topic: Optional[str] = None,
+                 availability_topic: Optional[str] = None) -> int:
+        """
+        Publishes discovery configs of measurement types which weren't announced yet,
+        returns number of published configs. 'topic' is where device publishes,
+        by default it's the common topic. Sensors are unavailable in Home Assistant
+        when 'availability_topic' says device is offline.
+        """
+        device = iqair_measurements.device
+        device_key = self._device_key(device)
+        with self._lock:
+            new = [
+                (device_key, measurement.name, measurement.unit)
+                for measurement in iqair_measurements.measurements
+                if (device_key, measurement.name, measurement.unit) not in self._state.announced
+            ]
+        if not new:
+            return 0
+
+        for _, name, unit in new:
+            object_id = _object_id(f'{name}_{unit}')
+            self._publisher.publish(
+                self._encoder.dumps(self._sensor_config(
+                    device, device_key, name, unit, topic or self._topic, availability_topic)),
+                topic=f'{self._discovery_prefix}/{DISCOVERY_COMPONENT}/{device_key}/{object_id}/config',
+                retain=True,
+            )
+        logger.info("Announced %d new measurement types of %s to Home Assistant", len(new), device.name)
+        with self._lock:
+            self._state.add(new)
+        return len(new)
+
+    def _device_key(self, device: IQAirDevice) -> str:
+        return _object_id(f'iqair2mqtt_{device.location}_{device.name}')
+
+    def _sensor_config(self, device: IQAirDevice, device_key: str, name: str, unit: str, topic: str,
+                       availability_topic: Optional[str] = None) -> Dict:
+        device_class, unit_of_measurement = SENSOR_CLASSES.get((name, unit), (None, unit))
+        config = {
+            'name': f'{name} {unit}',
+            'unique_id': _object_id(f'{device_key}_{name}_{unit}'),
+            'state_class': 'measurement',
+            'device': {
+                'identifiers': [device_key],
+                'name': device.name,
+                'manufacturer': 'IQAir',
+                'model': 'AirVisual',
+                'suggested_area': device.placement,
+            },
+        }
+        if device_class is not None:
+            config['device_class'] = device_class
+        if unit_of_measurement is not None:
+            config['unit_of_measurement'] = unit_of_measurement
+        if availability_topic is not None:
+            config['availability_topic'] = availability_topic
+        if self._per_measurement:
+            measurement_topics = self._measurement_topics.get(topic)
+            if measurement_topics is None:
+                measurement_topics = self._measurement_topics[topic] = MeasurementTopics(topic)
+            config['state_topic'] = measurement_topics.get_by_type(device, name, unit)
+        else:
+            config['state_topic'] = topic
+            config['value_template'] = self._value_template(device, name, unit)
+        return config
+
+    def _value_template(self, device: IQAirDevice, name: str, unit: str) -> str:
+        # all devices publish to one topic, sensor keeps its state on documents of other devices.
+        # Values are JSON strings, which are valid Jinja string literals with quotes escaped
+        return (
+            f"{{% if value_json.device_name == {json.dumps(device.name)} %}}"
+            f"{{% for m in value_json.measurements if m.type == {json.dumps(name)} and m.unit == {json.dumps(unit)} %}}"
+            "{{ m.value }}{% else %}{{ this.state }}{% endfor %}"
+            "{% else %}{{ this.state }}{% endif %}"
+        )
+
@@ -6,6 +6,23 @@ class ConfigVariableMissing(Exception):
         super().__init__(message)
 
 
+class ConfigVariableWrong(Exception):
+
+    def __init__(self, variable, value):
+        self.variable = variable
+        self.value = value
+        message = f"Config variable '{self.variable}' has wrong value '{self.value}'"
+        super().__init__(message)
+
+
+class ConfigFileWrong(Exception):
+
+    def __init__(self, path, reason):
+        self.path = path
+        message = f"Config file '{path}' is wrong: {reason}"
+        super().__init__(message)
+
+
 class WrongIQAirLoginOrPassword(Exception):
 
     def __init__(self, iqair_ip):
@@ -26,6 +43,15 @@ class IQAirConnectionError(Exception):
         return message
 
 
+class IQAirCircuitOpen(Exception):
+
+    def __init__(self, iqair_ip, retry_in):
+        self.iqair_ip = iqair_ip
+        self.retry_in = retry_in
+        message = f"IQAir on '{self.iqair_ip}' is offline, next connection attempt in {retry_in:.0f} seconds"
+        super().__init__(message)
+
+
 class IQAirMeasurementsFileNotFoundOrWrong(Exception):
 
     def __init__(self, iqair_ip):
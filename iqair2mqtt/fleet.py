@@ -0,0 +1,268 @@
+import asyncio
+import logging
+import signal
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set, Tuple, TypeVar
+
+from iqair2mqtt import errors
+from iqair2mqtt.config import DeviceConfig
+from iqair2mqtt.poller import DevicePoller
+
+logger = logging.getLogger(__name__)
+
+# errors which are expected from a poll and don't need a traceback in logs
+POLL_ERRORS = (
+    errors.IQAirConnectionError,
+    errors.IQAirCircuitOpen,
+    errors.WrongIQAirLoginOrPassword,
+    errors.IQAirMeasurementsFileNotFoundOrWrong,
+    errors.IQAirDataCorrupted,
+    errors.MQTTBrokerNotConnected,
+)
+# how long running polls can take after termination signal
+SHUTDOWN_TIMEOUT = 30
+
+T = TypeVar('T')
+
+
+class FleetPoller:
+    """
+    Polls many IQAir devices concurrently. Every device is polled by its own
+    asyncio task on its own schedule, blocking SMB I/O runs in a thread pool
+    of 'concurrency' workers, so a slow or dead device only occupies one worker
+    and doesn't delay polls of other devices. All devices publish through the same publisher.
+    Devices can be added and removed while polling, pollers are identified by name.
+    Sources which can notify about new measurements are polled right after they do.
+
+    On SIGTERM or SIGINT polling stops: sleeping devices stop right away, running
+    polls are given 'shutdown_timeout' seconds to finish and publish. Sources of polls
+    which miss it are closed when the polls finish in their threads.
+    """
+
+    def __init__(self, pollers: List[DevicePoller], concurrency: int, shutdown_timeout: float = SHUTDOWN_TIMEOUT):
+        if concurrency < 1:
+            raise ValueError("Concurrency must be at least 1")
+        self._pollers: Dict[str, DevicePoller] = {poller.name: poller for poller in pollers}
+        self._concurrency = concurrency
+        self._shutdown_timeout = shutdown_timeout
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._stop_event: Optional[asyncio.Event] = None
+        self._stopped = False
+        # poller name -> its task and event which stops it
+        self._tasks: Dict[str, Tuple[asyncio.Task, asyncio.Event]] = {}
+        # tasks of removed pollers which still finish their poll
+        self._stopping_tasks: Set[asyncio.Task] = set()
+
+    @property
+    def pollers(self) -> Dict[str, DevicePoller]:
+        return dict(self._pollers)
+
+    def run(self):
+        """
+        Polls devices until 'stop' is called or the process is asked to terminate
+        """
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        """
+        Polls devices in the running event loop until 'stop' is called. Next poll of a device
+        is scheduled after previous one finishes, with delay decided by the device poller.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        if self._stopped:
+            self._stop_event.set()
+        self._executor = ThreadPoolExecutor(max_workers=self._concurrency, thread_name_prefix='iqair-poller')
+        signals = self._add_signal_handlers()
+        try:
+            for poller in self._pollers.values():
+                self._start_poller(poller)
+            await self._stop_event.wait()
+            for name in list(self._tasks):
+                self._stop_poller(name)
+            tasks = list(self._stopping_tasks)
+            if tasks:
+                _, not_finished = await asyncio.wait(tasks, timeout=self._shutdown_timeout)
+                if not_finished:
+                    logger.warning("%d polls didn't finish in %s seconds, abandoning them",
+                                   len(not_finished), self._shutdown_timeout)
+                    for task in not_finished:
+                        task.cancel()
+                    await asyncio.wait(not_finished)
+        finally:
+            for signal_number in signals:
+                self._loop.remove_signal_handler(signal_number)
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stop(self):
+        """
+        Stops polling, can be called from any thread
+        """
+        self._stopped = True
+        self._call_in_loop(self._stop_event.set if self._stop_event is not None else None)
+
+    def add_poller(self, poller: DevicePoller):
+        """
+        Starts polling a device, if a poller with the same name exists it's replaced.
+        Can be called from any thread.
+        """
+        if self._loop is None:
+            self._pollers[poller.name] = poller
+            return
+        self._call_in_loop(lambda: self._replace_poller(poller))
+
+    def remove_poller(self, name: str):
+        """
+        Stops polling a device, running poll is finished first. Can be called from any thread.
+        """
+        if self._loop is None:
+            poller = self._pollers.pop(name, None)
+            if poller is not None:
+                poller.close()
+            return
+        self._call_in_loop(lambda: self._stop_poller(name))
+
+    def _call_in_loop(self, callback: Optional[Callable[[], object]]):
+        if self._loop is None or callback is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(callback)
+        except RuntimeError:
+            pass  # loop is already closed
+
+    def _start_poller(self, poller: DevicePoller):
+        if self._stop_event.is_set():
+            poller.close()
+            return
+        poller_stop_event = asyncio.Event()
+        task = self._loop.create_task(self._poll_forever(poller, poller_stop_event), name=f'poll-{poller.name}')
+        self._pollers[poller.name] = poller
+        self._tasks[poller.name] = (task, poller_stop_event)
+        logger.debug("Started polling IQAir %s", poller.name)
+
+    def _replace_poller(self, poller: DevicePoller):
+        self._stop_poller(poller.name)
+        self._start_poller(poller)
+
+    def _stop_poller(self, name: str):
+        entry = self._tasks.pop(name, None)
+        self._pollers.pop(name, None)
+        if entry is not None:
+            task, poller_stop_event = entry
+            poller_stop_event.set()
+            self._stopping_tasks.add(task)
+            task.add_done_callback(self._stopping_tasks.discard)
+            logger.debug("Stopped polling IQAir %s", name)
+
+    async def _poll_forever(self, poller: DevicePoller, stop_event: asyncio.Event):
+        # set by source when device writes new measurements, to poll right away
+        changed_event = asyncio.Event()
+        # executor future of the last poll or publish of the device
+        in_flight: List[Future] = []
+        loop = self._loop
+        try:
+            if poller.watch(lambda: loop.call_soon_threadsafe(changed_event.set)):
+                logger.info("Watching IQAir %s for changes", poller.name)
+            while not stop_event.is_set():
+                changed_event.clear()
+                try:
+                    await self._run_in_executor(in_flight, poller.poll)
+                except POLL_ERRORS as exc:
+                    logger.warning("Can't get latest data from IQAir %s. Err %s", poller.name, exc)
+                except Exception:
+                    logger.error("Unexpected error on poll of IQAir %s", poller.name, exc_info=True)
+
+                delay = poller.next_poll_delay()
+                logger.debug("Next poll of IQAir %s in %.1f seconds", poller.name, delay)
+                await self._wait_for_next_poll(poller, (stop_event, changed_event), delay, in_flight)
+        finally:
+            if in_flight:
+                # cancelled task doesn't stop its poll in executor thread, source is closed after
+                # the poll finishes, right away if it already has
+                in_flight[0].add_done_callback(lambda _: poller.close())
+            else:
+                poller.close()
+
+    async def _run_in_executor(self, in_flight: List[Future], function: Callable[[], T]) -> T:
+        """
+        Runs blocking 'function' in the executor, its future replaces one in 'in_flight'
+        """
+        future = self._executor.submit(function)
+        in_flight[:] = [future]
+        return await asyncio.wrap_future(future)
+
+    async def _wait_for_next_poll(self, poller: DevicePoller, events: Tuple[asyncio.Event, ...], delay: float,
+                                  in_flight: List[Future]):
+        """
+        Waits 'delay' seconds or until one of events is set, meanwhile publishes
+        aggregates of the device when they are due, even if device is silent
+        """
+        poll_at = self._loop.time() + delay
+        # after failed publish aggregates are tried again after the next poll
+        aggregates_failed = False
+        while True:
+            delay = max(poll_at - self._loop.time(), 0)
+            aggregates_delay = None if aggregates_failed else poller.aggregates_delay()
+            if aggregates_delay is None or aggregates_delay >= delay:
+                await self._wait_for_any(events, delay)
+                return
+            await self._wait_for_any(events, aggregates_delay)
+            if any(event.is_set() for event in events):
+                return
+            try:
+                await self._run_in_executor(in_flight, poller.publish_aggregates)
+            except POLL_ERRORS as exc:
+                logger.warning("Can't publish aggregates of IQAir %s. Err %s", poller.name, exc)
+                aggregates_failed = True
+            except Exception:
+                logger.error("Unexpected error on publish of aggregates of IQAir %s", poller.name, exc_info=True)
+                aggregates_failed = True
+
+    @staticmethod
+    async def _wait_for_any(events: Tuple[asyncio.Event, ...], timeout: float):
+        waiters = [asyncio.ensure_future(event.wait()) for event in events]
+        try:
+            await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+    def _add_signal_handlers(self) -> List[int]:
+        """
+        Stops polling on termination signals, returns signals which are handled.
+        Signals can be handled only in the main thread.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return []
+        signals = []
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            try:
+                self._loop.add_signal_handler(signal_number, self._on_signal, signal_number)
+            except (NotImplementedError, RuntimeError):
+                continue  # not supported on this platform
+            signals.append(signal_number)
+        return signals
+
+    def _on_signal(self, signal_number: int):
+        logger.info("Got signal %s, stopping", signal.Signals(signal_number).name)
+        self._stop_event.set()
+
+
+def sync_pollers(fleet_poller: FleetPoller, old_devices: List[DeviceConfig], new_devices: List[DeviceConfig],
+                 make_poller: Callable[[DeviceConfig], DevicePoller]):
+    """
+    Applies changed list of devices to running fleet: removed devices aren't polled
+    anymore, new and changed devices get new pollers, not changed ones keep polling
+    """
+    old = {device.ip: device for device in old_devices}
+    new = {device.ip: device for device in new_devices}
+    for ip in old.keys() - new.keys():
+        logger.info("IQAir %s was removed from config", ip)
+        fleet_poller.remove_poller(ip)
+    for ip, device in new.items():
+        if old.get(ip) == device:
+            continue
+        logger.info("IQAir %s was %s config", ip, 'changed in' if ip in old else 'added to')
+        fleet_poller.add_poller(make_poller(device))
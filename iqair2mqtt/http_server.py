@@ -0,0 +1,16 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Type
+
+
+def start_http_server(handler_class: Type[BaseHTTPRequestHandler], port: int, address: str, thread_name: str,
+                      **handler_attributes) -> ThreadingHTTPServer:
+    """
+    Serves requests with 'handler_class' on 'http://<address>:<port>' in a background thread.
+    'handler_attributes' are set on a subclass of the handler, like what it serves.
+    """
+    handler = type(handler_class.__name__.lstrip('_'), (handler_class,), handler_attributes)
+    server = ThreadingHTTPServer((address, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name=thread_name, daemon=True).start()
+    return server
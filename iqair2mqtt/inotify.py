@@ -0,0 +1,119 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+from typing import Callable, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+# watch descriptor, mask, cookie, length of name which follows
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        library = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(library, use_errno=True) if library else None
+        if libc is None or not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify isn't available on this system")
+        _libc = libc
+    return _libc
+
+
+def is_available() -> bool:
+    try:
+        _get_libc()
+    except OSError:
+        return False
+    return True
+
+
+class DirectoryWatcher:
+    """
+    Watches files in a directory with Linux inotify, in a background thread.
+    'on_change' is called with a file name every time one of 'file_names' is written
+    and closed, or moved into the directory, like sync tools replace files.
+    Changes made on another machine aren't seen on most network file systems,
+    so watching doesn't replace polling there.
+    """
+
+    def __init__(self, directory: str, file_names: Iterable[str], on_change: Callable[[str], None]):
+        self._directory = directory
+        self._file_names = {file_name.encode() for file_name in file_names}
+        self._on_change = on_change
+        self._fd: Optional[int] = None
+        self._wake_read, self._wake_write = -1, -1
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """
+        Starts watching, raises 'OSError' if inotify isn't available or directory can't be watched
+        """
+        libc = _get_libc()
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "Can't init inotify")
+        if libc.inotify_add_watch(fd, os.fsencode(self._directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            error = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(error, f"Can't watch {self._directory}: {os.strerror(error)}")
+        self._fd = fd
+        # to wake the thread up on stop
+        self._wake_read, self._wake_write = os.pipe()
+        self._thread = threading.Thread(target=self._watch, name=f'inotify-{self._directory}', daemon=True)
+        self._thread.start()
+        logger.debug("Watching %s for changes", self._directory)
+
+    def stop(self):
+        if self._thread is None:
+            return
+        os.write(self._wake_write, b'\0')
+        self._thread.join()
+        self._thread = None
+        for fd in (self._fd, self._wake_read, self._wake_write):
+            os.close(fd)
+
+    def _watch(self):
+        while True:
+            ready, _, _ = select.select([self._fd, self._wake_read], [], [])
+            if self._wake_read in ready:
+                return
+            try:
+                data = os.read(self._fd, READ_SIZE)
+            except BlockingIOError:
+                continue
+            changed = set()
+            for mask, name in self._parse_events(data):
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, any of files could change
+                    changed.update(self._file_names)
+                elif name in self._file_names:
+                    changed.add(name)
+            for name in changed:
+                try:
+                    self._on_change(name.decode())
+                except Exception:
+                    logger.error("Can't handle change of %s in %s", name, self._directory, exc_info=True)
+
+    @staticmethod
+    def _parse_events(data: bytes):
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+            name_start = offset + EVENT_HEADER.size
+            yield mask, data[name_start:name_start + name_length].rstrip(b'\0')
+            offset = name_start + name_length
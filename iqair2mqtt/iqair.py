@@ -1,29 +1,81 @@
 import json
 import logging
 import tempfile
-from socket import timeout
-from typing import Dict
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, TypeVar
 
+from smb.base import NotConnectedError, SMBTimeout
 from smb.SMBConnection import SMBConnection
 from smb.smb_structs import OperationFailure
 
-from iqair2mqtt import errors
+from iqair2mqtt import errors, metrics
+from iqair2mqtt.circuit_breaker import CircuitBreaker
+from iqair2mqtt.source import MEASUREMENTS_FILE, STREAM_CHUNK_SIZE, MeasurementSource
 
 logger = logging.getLogger()
 
 CONNECTION_TIMEOUT = 3
 CONNECTION_ATTEMPTS = 3
+SESSION_ECHO_DATA = b'iqair2mqtt'
+FILE_BUFFER_SIZE = 16 * 1024  # latest_config_measurements.json is a few KB
 
+# network errors of SMB connection to IQAir, like a refused connection, unknown host name
+# or timeout. Failed connection attempt is retried, broken session is re-established
+CONNECTION_ERRORS = (NotConnectedError, SMBTimeout, OSError)
+# NT statuses of failed SMB requests, which mean there is no such file
+MISSING_FILE_STATUSES = frozenset((
+    0xC000000F,  # STATUS_NO_SUCH_FILE
+    0xC0000034,  # STATUS_OBJECT_NAME_NOT_FOUND
+    0xC000003A,  # STATUS_OBJECT_PATH_NOT_FOUND
+))
 
-class IQAir:
+T = TypeVar('T')
+
+
+class FileVersion(NamedTuple):
+    last_write_time: float
+    size: int
+
+
+class IQAir(MeasurementSource):
     """
-    Class responsible for communication with IQAIR device.
+    Class responsible for communication with IQAIR device over SMB.
     """
 
-    def __init__(self, ip: str, login: str, password: str):
+    def __init__(self, ip: str, login: str, password: str, keep_session: bool = True, in_memory: bool = True,
+                 breaker: Optional[CircuitBreaker] = None,
+                 connection_factory: Optional[Callable[..., SMBConnection]] = None):
         self._ip = ip
         self._login = login
         self._password = password
+        # when enabled, one SMB session is reused between fetches instead
+        # of doing the full negotiate/auth handshake on every poll
+        self._keep_session = keep_session
+        self._session: Optional[SMBConnection] = None
+        self._session_opened_before = False
+        self.session_reuses = 0
+        self.session_reconnects = 0
+        # files are downloaded to a reusable memory buffer, or to temporary files if it's disabled
+        self._buffer: Optional[FileBuffer] = FileBuffer() if in_memory else None
+        self._measurements_file_version: Optional[FileVersion] = None
+        self.fetches_skipped = 0
+        # when set, connections to an offline device aren't attempted on every poll
+        self._breaker = breaker
+        # creates connections with the same interface as 'SMBConnection', like a simulated device
+        self._connection_factory = connection_factory
+
+        self._connect_seconds = metrics.IQAIR_CONNECT_SECONDS.labels(ip)
+        self._connect_retries = metrics.IQAIR_CONNECT_RETRIES.labels(ip)
+        self._connect_failures = metrics.IQAIR_CONNECT_FAILURES.labels(ip)
+        self._session_reuses_metric = metrics.IQAIR_SESSION_REUSES.labels(ip)
+        self._session_reconnects_metric = metrics.IQAIR_SESSION_RECONNECTS.labels(ip)
+        self._fetch_seconds = metrics.IQAIR_FETCH_SECONDS.labels(ip)
+        self._fetch_bytes = metrics.IQAIR_FETCH_BYTES.labels(ip)
+        self._fetches_skipped_metric = metrics.IQAIR_FETCHES_SKIPPED.labels(ip)
+
+    @property
+    def breaker(self) -> Optional[CircuitBreaker]:
+        return self._breaker
 
     def noop(self):
         """
@@ -40,6 +92,16 @@ class IQAir:
         if connection:
             connection.close()
 
+    def close(self):
+        """
+        Closes persistent SMB session to IQAIR, if there is one.
+        Next fetch will open a new session.
+        """
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+            logger.debug("Closed SMB session to IQAir on %s", self._ip)
+
     def get_latest_measurements(self) -> Dict:
         """
         Returns dict which is parsed `latest_config_measurements.json`.
@@ -54,13 +116,82 @@ class IQAir:
         file_data = {}
         logger.debug("Going to fetch last measurements from IQAir")
         try:
-            raw_file_content = self._fetch_file('/latest_config_measurements.json')
+            raw_file_content = self._fetch_file(MEASUREMENTS_FILE)
             file_data = json.loads(raw_file_content)
-        except (FileNotFoundError, json.JSONDecodeError) as exc:
+        except (FileNotFoundError, UnicodeDecodeError, json.JSONDecodeError) as exc:
             raise errors.IQAirMeasurementsFileNotFoundOrWrong(self._ip) from exc
-        logger.debug("Fetched the following IQAir last measurements file content: %s", file_data)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Fetched the following IQAir last measurements file content: %s", file_data)
         return file_data
 
+    def get_changed_measurements(self) -> Optional[Dict]:
+        """
+        Same as 'get_latest_measurements', but first checks last write time and size
+        of measurements file. If they are the same as on previous call, file isn't
+        downloaded and parsed, and None is returned.
+        Number of skipped downloads is available in 'fetches_skipped'.
+        """
+        try:
+            file_version = self._get_file_version(MEASUREMENTS_FILE)
+        except FileNotFoundError as exc:
+            raise errors.IQAirMeasurementsFileNotFoundOrWrong(self._ip) from exc
+
+        if file_version == self._measurements_file_version:
+            self.fetches_skipped += 1
+            self._fetches_skipped_metric.inc()
+            logger.debug(
+                "Measurements file on IQAir %s wasn't changed since last fetch, skipped %d fetches so far",
+                self._ip,
+                self.fetches_skipped
+            )
+            return None
+
+        file_data = self.get_latest_measurements()
+        # remember version only after successful fetch. If file is changed in between,
+        # we will just fetch it one more time on next call
+        self._measurements_file_version = file_version
+        return file_data
+
+    def forget_version(self):
+        self._measurements_file_version = None
+
+    def list_files(self, suffix: str = '') -> List[str]:
+        """
+        Returns sorted paths of files in root folder of airvisual shared drive,
+        which names end with 'suffix'
+        """
+        def list_path(connection: SMBConnection) -> List[str]:
+            return sorted(
+                f'/{shared_file.filename}'
+                for shared_file in connection.listPath('airvisual', '/')
+                if not shared_file.isDirectory and shared_file.filename.endswith(suffix)
+            )
+
+        return self._run_in_session(list_path)
+
+    def stream_file(self, file_path: str, offset: int = 0, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+        """
+        Yields content of a file on airvisual shared drive by chunks of 'chunk_size' bytes,
+        starting from 'offset', so big files are never kept in memory completely.
+        Will raise 'FileNotFoundError' if file wasn't found.
+        """
+        buffer = FileBuffer(chunk_size)
+        check_session = True
+        while True:
+            def retrieve(connection: SMBConnection) -> int:
+                buffer.clear()
+                return connection.retrieveFileFromOffset('airvisual', file_path, buffer, offset, chunk_size)[1]
+
+            # session is checked once per file, if it breaks in between the chunk is retried on a new one
+            read_bytes = self._retrieve_file(file_path, retrieve, check_session)
+            check_session = False
+            if read_bytes:
+                with buffer.view() as view:
+                    yield view.tobytes()
+                offset += read_bytes
+            if read_bytes < chunk_size:
+                return
+
     def _connect_to_iqair(self) -> SMBConnection:
         """
         Function connects to IQAIR. In case of network problems
@@ -69,11 +200,37 @@ class IQAir:
         'IQAirConnectionError' if after N attempts(where N is 'CONNECTION_ATTEMPTS')
         connection has failed.
 
-        function returns a connection which ALWAYS must be closed after usage
+        function returns a connection which ALWAYS must be closed after usage.
+        If device has a circuit breaker which is open, 'IQAirCircuitOpen' is raised right away.
         """
+        if self._breaker is not None:
+            self._breaker.before_call()
+        try:
+            connection = self._connect_with_retries()
+        except errors.IQAirConnectionError as exc:
+            if self._breaker is not None:
+                self._breaker.on_failure(exc.__cause__ or exc)
+            raise
+        except errors.WrongIQAirLoginOrPassword:
+            # device answered, so it's online
+            if self._breaker is not None:
+                self._breaker.on_success()
+            raise
+        except Exception as exc:
+            # unexpected error must end a half open probe too, otherwise breaker stays half open
+            if self._breaker is not None:
+                self._breaker.on_failure(exc)
+            raise
+        if self._breaker is not None:
+            self._breaker.on_success()
+        return connection
+
+    def _connect_with_retries(self) -> SMBConnection:
+        started_at = perf_counter()
         for connection_attempt in range(1, CONNECTION_ATTEMPTS + 1):
             try:
-                connection = SMBConnection(self._login, self._password, 'iqair2mqtt', 'airvisual')
+                connection_factory = self._connection_factory or SMBConnection
+                connection = connection_factory(self._login, self._password, 'iqair2mqtt', 'airvisual')
                 connected = connection.connect(self._ip, timeout=CONNECTION_TIMEOUT)
                 if not connected:
                     raise errors.WrongIQAirLoginOrPassword(self._ip)
@@ -82,15 +239,17 @@ class IQAir:
                     self._ip
                 )
                 break
-            except (ConnectionError, timeout) as exc:
+            except CONNECTION_ERRORS as exc:
                 # we will retry connection
                 if connection_attempt < CONNECTION_ATTEMPTS:
+                    self._connect_retries.inc()
                     logger.warning(
                         "Can't connect to '%s', error: %s, will retry",
                         self._ip,
                         exc
                     )
                 else:  # we've reached maximum number of retries, raise an exception
+                    self._connect_failures.inc()
                     raise errors.IQAirConnectionError(self._ip) from exc
             else:
                 if connection_attempt > 1:
@@ -98,8 +257,75 @@ class IQAir:
                         "Connected to IQAir after %d attemps, check for network problems",
                         connection_attempt
                     )
+        self._connect_seconds.observe(perf_counter() - started_at)
         return connection
 
+    def _get_session(self, check_session: bool = True) -> SMBConnection:
+        """
+        Returns persistent SMB session to IQAIR. Existing session is checked
+        with SMB echo before reuse, unless 'check_session' is False, if IQAIR has
+        dropped it, new session is opened.
+        Can raise the same exceptions as '_connect_to_iqair'
+        """
+        if self._session is not None:
+            try:
+                if check_session:
+                    self._session.echo(SESSION_ECHO_DATA, timeout=CONNECTION_TIMEOUT)
+            except CONNECTION_ERRORS as exc:
+                logger.info("SMB session to IQAir on %s is dead, error: %s, will reconnect", self._ip, exc)
+                self._drop_session()
+            else:
+                self.session_reuses += 1
+                self._session_reuses_metric.inc()
+                return self._session
+
+        self._session = self._connect_to_iqair()
+        if self._session_opened_before:
+            self.session_reconnects += 1
+            self._session_reconnects_metric.inc()
+        self._session_opened_before = True
+        return self._session
+
+    def _drop_session(self):
+        """
+        Forgets current session, ignoring errors on close, session is already broken
+        """
+        session, self._session = self._session, None
+        if session is not None:
+            try:
+                session.close()
+            except CONNECTION_ERRORS:
+                pass
+
+    def _run_in_session(self, operation: Callable[[SMBConnection], T], check_session: bool = True) -> T:
+        """
+        Runs 'operation' with SMB connection to IQAIR. If session keeping is enabled,
+        operation runs in persistent session and it's retried once on a fresh session
+        if IQAIR has dropped the old one in the middle of operation. Session isn't
+        checked before operation if 'check_session' is False, like when it was just used.
+        Otherwise operation runs in a new connection, which is closed right after.
+        """
+        if not self._keep_session:
+            connection = self._connect_to_iqair()
+            try:
+                return operation(connection)
+            finally:
+                connection.close()
+
+        session = self._get_session(check_session)
+        try:
+            return operation(session)
+        except CONNECTION_ERRORS as exc:
+            logger.info("SMB session to IQAir on %s broke, error: %s, will retry on new one", self._ip, exc)
+            self._drop_session()
+
+        session = self._get_session()
+        try:
+            return operation(session)
+        except CONNECTION_ERRORS as exc:
+            self._drop_session()
+            raise errors.IQAirConnectionError(self._ip) from exc
+
     def _fetch_file(self, file_path: str) -> str:
         """
         Return content of a file on airvisual shared drive.
@@ -109,26 +335,132 @@ class IQAir:
         Will raise an aexception if 'FileNotFoundError' if filed wasn't found.
         In caise of connection issues you might see exceptions from '_connect_to_iqair'
 
+        """
+        if self._buffer is None:
+            return self._fetch_file_via_temp_file(file_path)
+
+        buffer = self._buffer
+
+        def retrieve(connection: SMBConnection) -> int:
+            # start from scratch, in case previous attempt wrote something
+            buffer.clear()
+            return connection.retrieveFile('airvisual', file_path, buffer)[1]
+
+        self._retrieve_file(file_path, retrieve)
+        with buffer.view() as view:
+            # decode directly from the buffer, without intermediate bytes object
+            return str(view, 'utf-8')
+
+    def _fetch_file_via_temp_file(self, file_path: str) -> str:
+        """
+        Same as '_fetch_file', but file is downloaded to a temporary file on disk
         """
         temp_fh = tempfile.NamedTemporaryFile('w+b')
-        connection = None
-        result = ''
+
+        def retrieve(connection: SMBConnection) -> int:
+            # start from scratch, in case previous attempt wrote something
+            temp_fh.seek(0)
+            temp_fh.truncate()
+            return connection.retrieveFile('airvisual', file_path, temp_fh)[1]
+
         try:
-            connection = self._connect_to_iqair()
-            res = connection.retrieveFile('airvisual', file_path, temp_fh)
-            logger.debug(
-                "Read %d bytes from file '%s' on iqair",
-                res[1],
-                file_path
-            )
+            self._retrieve_file(file_path, retrieve)
             temp_fh.seek(0)
-            result = temp_fh.read().decode()
+            return temp_fh.read().decode()
+        finally:
+            temp_fh.close()
+
+    def _retrieve_file(self, file_path: str, retrieve: Callable[[SMBConnection], int],
+                       check_session: bool = True) -> int:
+        """
+        Runs 'retrieve' for file 'file_path' and returns number of read bytes
+        """
+        started_at = perf_counter()
+        read_bytes = self._run_file_operation(file_path, retrieve, check_session)
+        self._fetch_seconds.observe(perf_counter() - started_at)
+        self._fetch_bytes.inc(read_bytes)
+        logger.debug(
+            "Read %d bytes from file '%s' on iqair",
+            read_bytes,
+            file_path
+        )
+        return read_bytes
+
+    def _run_file_operation(self, file_path: str, operation: Callable[[SMBConnection], T],
+                            check_session: bool = True) -> T:
+        """
+        Runs 'operation' on file 'file_path' in SMB session.
+        Translates SMB error about missing file to 'FileNotFoundError'
+        """
+        try:
+            return self._run_in_session(operation, check_session)
         except OperationFailure as exc:
-            if exc.message.find('Unable to open file') != -1:
+            if exc.message.find('Unable to open') != -1:
                 raise FileNotFoundError(file_path) from exc
             raise  # if we have any other error
-        finally:
-            temp_fh.close()
-            if connection is not None:
-                connection.close()
-        return result
+
+    def _get_file_version(self, file_path: str) -> FileVersion:
+        """
+        Returns last write time and size of a file on airvisual shared drive,
+        without downloading it
+        """
+        def get_attributes(connection: SMBConnection) -> FileVersion:
+            attributes = connection.getAttributes('airvisual', file_path)
+            return FileVersion(attributes.last_write_time, attributes.file_size)
+
+        try:
+            return self._run_in_session(get_attributes)
+        except OperationFailure as exc:
+            # message about missing file differs between SMB1 and SMB2, status of the request doesn't
+            if _is_missing_file(exc):
+                raise FileNotFoundError(file_path) from exc
+            raise
+
+
+def _is_missing_file(exc: OperationFailure) -> bool:
+    """
+    Tells if SMB operation failed because there is no such file. Status of SMB2
+    messages is a number, of SMB1 messages 'SMBError' with the number in 'internal_value'
+    """
+    return any(
+        getattr(message.status, 'internal_value', message.status) in MISSING_FILE_STATUSES
+        for message in exc.smb_messages
+    )
+
+
+class FileBuffer:
+    """
+    Reusable in-memory file-like object for SMB downloads. Memory is preallocated
+    once and reused between downloads, it only grows if a file doesn't fit.
+    """
+
+    __slots__ = ('_data', '_size')
+
+    def __init__(self, capacity: int = FILE_BUFFER_SIZE):
+        self._data = bytearray(capacity)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def capacity(self) -> int:
+        return len(self._data)
+
+    def clear(self):
+        self._size = 0
+
+    def write(self, chunk: bytes) -> int:
+        end = self._size + len(chunk)
+        if end > len(self._data):
+            self._data.extend(bytes(max(end, 2 * len(self._data)) - len(self._data)))
+        self._data[self._size:end] = chunk
+        self._size = end
+        return len(chunk)
+
+    def view(self) -> memoryview:
+        """
+        Returns memoryview on written data, without copying it.
+        View must be released before next write, use it as a context manager
+        """
+        return memoryview(self._data)[:self._size]
@@ -1,9 +1,11 @@
 import logging
-from dateutil import parser
-from datetime import datetime
-from typing import Dict, List
-from dateutil.tz import gettz
+from datetime import datetime, timedelta, tzinfo
+from functools import lru_cache
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from dateutil.tz import UTC, gettz
 
+from iqair2mqtt import metrics
 from iqair2mqtt.config import Config
 from iqair2mqtt.errors import IQAirDataCorrupted
 from iqair2mqtt.models.device import IQAirDevice
@@ -12,8 +14,18 @@ from iqair2mqtt.models.iqair_measurement import IQAirMeasurements, IQAirMeasurem
 
 logger = logging.getLogger(__name__)
 
+EPOCH = datetime(1970, 1, 1)
+# how many layouts of measurement keys are kept, devices of one firmware share a layout
+KEY_TABLES = 64
+
+# type, unit and value parser of a raw measurement key
+MeasurementKey = Tuple[str, str, Callable[[str], Union[int, float]]]
+
+_parse_seconds = metrics.PARSE_SECONDS.labels()
+
 
 def parse_measurements(config: Config, raw_measurements: Dict) -> IQAirMeasurements:
+    started_at = perf_counter()
     try:
         settings_section = raw_measurements['settings']
         measurements_section = raw_measurements['measurements']
@@ -30,6 +42,8 @@ def parse_measurements(config: Config, raw_measurements: Dict) -> IQAirMeasureme
         timestamp = int(date_and_time_section['timestamp'])
     except KeyError as exc:
         raise IQAirDataCorrupted(f"Can't fine key '{str(exc)}' in iqair data")
+    except ValueError as exc:
+        raise IQAirDataCorrupted(f"Timestamp isn't an integer, {exc}")
 
     iqair_device = IQAirDevice(
         name=node_name,
@@ -38,47 +52,108 @@ def parse_measurements(config: Config, raw_measurements: Dict) -> IQAirMeasureme
         external=not is_indoor
     )
 
-    utc_datetime = _convert_to_utc_datetime(date, time, timezone)
+    try:
+        utc_datetime = convert_to_utc_datetime(date, time, timezone, timestamp)
+    except ValueError as exc:
+        raise IQAirDataCorrupted(f"Can't parse date and time of measurements, {exc}")
 
     measurements: List[IQAirMeasurement] = []
     if measurements_section:
-        logger.debug("Parsing %d measurements", len(measurements_section[0]))
-        for measurement_key, value in measurements_section[0].items():
+        raw_values = measurements_section[0]
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("Parsing %d measurements", len(raw_values))
+        key_table = _get_key_table(tuple(raw_values))
+        for (measurement_key, value), (data_type, unit, parse_value) in zip(raw_values.items(), key_table):
             try:
-                data_type, unit = measurement_key.split('_')
-                data_type = data_type.lower()
-                unit = unit.lower()
-                if value.find('.') == -1:  # value is integer
-                    value = int(value)
-                else:  # value is float
-                    value = float(value)
-                measurement = IQAirMeasurement(
-                    measured_at=utc_datetime,
-                    name=data_type,
-                    value=value,
-                    unit=unit,
+                value = parse_value(value)
+            except (ValueError, TypeError):
+                logger.warning(
+                    "Can't parse measurement key %s for device %s. Will skip it",
+                    measurement_key,
+                    node_name
                 )
-                measurements.append(measurement)
+                continue
+            measurements.append(IQAirMeasurement(utc_datetime, data_type, value, unit))
+            if debug:
                 logger.debug(
                     "Parsed measurement %s from device %s, measured_at %s",
                     data_type,
                     node_name,
                     utc_datetime.isoformat()
                 )
-
-            except ValueError:
-                logger.warning(
-                    "Can't parse measurement key %s for device %s. Will skip it",
-                    measurement_key,
-                    node_name
-                )
     else:
         logger.warning("Measurements section is empty")
 
-    return IQAirMeasurements(timestamp, iqair_device, measurements)
+    iqair_measurements = IQAirMeasurements(timestamp, iqair_device, measurements)
+    _parse_seconds.observe(perf_counter() - started_at)
+    return iqair_measurements
+
+
+def _parse_wrong_key(value: str) -> Union[int, float]:
+    raise ValueError("Measurement key isn't '<type>_<unit>'")
+
+
+def parse_number(value: str) -> Union[int, float]:
+    """
+    Parses measurement value, devices write integers without a dot
+    """
+    if '.' in value:
+        return float(value)
+    return int(value)
+
+
+@lru_cache(maxsize=KEY_TABLES)
+def _get_key_table(keys: Tuple[str, ...]) -> Tuple[MeasurementKey, ...]:
+    """
+    Returns type, unit and value parser for every raw measurement key like 'pm25_ugm3'.
+    Values of keys which can't be parsed are skipped. Firmware writes
+    the same keys every time, so the table is built once per layout of keys.
+    """
+    key_table = []
+    for key in keys:
+        parts = key.split('_')
+        if len(parts) == 2:
+            key_table.append((parts[0].lower(), parts[1].lower(), parse_number))
+        else:
+            key_table.append((key, '', _parse_wrong_key))
+    return tuple(key_table)
+
+
+def convert_to_utc_datetime(
+    local_date: str,
+    local_time: str,
+    local_timezone: str,
+    local_timestamp: Optional[int] = None
+) -> datetime:
+    """
+    Converts device local date and time to UTC datetime using device timezone.
+    IQAir 'timestamp' is local wall clock time in seconds since epoch, not UTC one,
+    when it's known, it's used instead of parsing date and time strings.
+    """
+    if local_timestamp is not None:
+        local_datetime = EPOCH + timedelta(seconds=local_timestamp)
+    else:
+        local_datetime = parse_local_datetime(local_date, local_time)
+    return local_datetime.replace(tzinfo=_get_timezone(local_timezone)).astimezone(UTC)
+
+
+def parse_local_datetime(local_date: str, local_time: str) -> datetime:
+    """
+    Parses IQAir date and time in fixed formats 'YYYY/MM/DD' and 'HH:MM:SS'
+    """
+    year, month, day = local_date.split('/')
+    hour, minute, second = local_time.split(':')
+    return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
 
 
-def _convert_to_utc_datetime(local_date: str, local_time: str, local_timezone: str) -> datetime:
-    local_tz = gettz('America/New_York')
-    local_datetime = parser.parse(" ".join([local_date, local_time, "TZ"]), tzinfos={'TZ': local_tz})
-    return local_datetime.astimezone(gettz('UTC'))
+@lru_cache(maxsize=None)
+def _get_timezone(name: str) -> tzinfo:
+    """
+    Returns tzinfo for timezone name, resolved once per name
+    """
+    timezone = gettz(name)
+    if timezone is None:
+        logger.warning("Unknown IQAir timezone '%s', will treat device time as UTC", name)
+        timezone = UTC
+    return timezone
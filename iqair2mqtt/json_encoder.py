@@ -0,0 +1,55 @@
+import json
+import logging
+from typing import Any, Callable, Dict
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, stdlib is used without it
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+ENCODER_AUTO = 'auto'
+ENCODER_ORJSON = 'orjson'
+ENCODER_STDLIB = 'json'
+ENCODERS = (ENCODER_AUTO, ENCODER_ORJSON, ENCODER_STDLIB)
+
+
+class JSONEncoder:
+    """
+    Serializes objects to JSON bytes with one of backends
+    """
+
+    def __init__(self, name: str, dumps: Callable[[Any], bytes]):
+        self.name = name
+        self.dumps = dumps
+
+    def __repr__(self) -> str:
+        return f'JSONEncoder({self.name})'
+
+
+def _stdlib_dumps(obj: Any) -> bytes:
+    return json.dumps(obj).encode()
+
+
+STDLIB_ENCODER = JSONEncoder(ENCODER_STDLIB, _stdlib_dumps)
+ORJSON_ENCODER = JSONEncoder(ENCODER_ORJSON, orjson.dumps) if orjson is not None else None
+
+_ENCODERS: Dict[str, JSONEncoder] = {ENCODER_STDLIB: STDLIB_ENCODER}
+if ORJSON_ENCODER is not None:
+    _ENCODERS[ENCODER_ORJSON] = ORJSON_ENCODER
+
+
+def get_encoder(name: str = ENCODER_AUTO) -> JSONEncoder:
+    """
+    Returns encoder by name, 'auto' is orjson if it's installed and stdlib json otherwise
+    """
+    if name == ENCODER_AUTO:
+        return ORJSON_ENCODER if ORJSON_ENCODER is not None else STDLIB_ENCODER
+    if name == ENCODER_ORJSON and ORJSON_ENCODER is None:
+        logger.warning("orjson isn't installed, will use stdlib json")
+        return STDLIB_ENCODER
+    try:
+        return _ENCODERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown JSON encoder '{name}', should be one of {ENCODERS}")
@@ -0,0 +1,148 @@
+import hashlib
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, NamedTuple, Optional, Tuple
+from urllib.parse import unquote
+
+from iqair2mqtt import http_server
+from iqair2mqtt.json_encoder import JSONEncoder, get_encoder
+from iqair2mqtt.models.iqair_measurement import IQAirMeasurements
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'application/json'
+PATH_PREFIX = '/measurements'
+HEALTH_PATH = '/health'
+
+
+class CachedMeasurements(NamedTuple):
+    measurements: IQAirMeasurements
+    body: bytes
+    etag: str
+
+
+def _make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+
+
+class LatestMeasurementsCache:
+    """
+    The latest measurements of every device, updated by pollers. Measurements are
+    encoded once on update, so serving them doesn't depend on number of requests.
+    Cache is thread safe.
+    """
+
+    def __init__(self, encoder: Optional[JSONEncoder] = None):
+        self._encoder = encoder if encoder is not None else get_encoder()
+        self._devices: Dict[str, CachedMeasurements] = {}
+        self._all: Optional[Tuple[bytes, str]] = None  # document with all devices, built on request
+        self._health: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def update(self, name: str, measurements: IQAirMeasurements):
+        body = measurements.to_json_bytes(self._encoder)
+        cached = CachedMeasurements(measurements, body, _make_etag(body))
+        with self._lock:
+            self._devices[name] = cached
+            self._all = None
+
+    def remove(self, name: str):
+        with self._lock:
+            self._health.pop(name, None)
+            if self._devices.pop(name, None) is not None:
+                self._all = None
+
+    def set_health(self, name: str, health: Dict):
+        """
+        Saves health state of the device, like its circuit breaker state
+        """
+        with self._lock:
+            self._health[name] = health
+
+    def get_health(self) -> bytes:
+        """
+        Returns document with health state of all devices by device name
+        """
+        with self._lock:
+            health = dict(sorted(self._health.items()))
+        return self._encoder.dumps(health)
+
+    def get(self, name: str) -> Optional[CachedMeasurements]:
+        with self._lock:
+            return self._devices.get(name)
+
+    def get_all(self) -> Tuple[bytes, str]:
+        """
+        Returns document with measurements of all devices by device name and its ETag
+        """
+        with self._lock:
+            if self._all is None:
+                devices = sorted(self._devices.items())
+                body = b'{' + b','.join(
+                    self._encoder.dumps(name) + b':' + cached.body for name, cached in devices
+                ) + b'}'
+                self._all = (body, _make_etag(body))
+            return self._all
+
+
+class _LatestMeasurementsHandler(BaseHTTPRequestHandler):
+
+    cache: LatestMeasurementsCache
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0].rstrip('/')
+        if path == HEALTH_PATH:
+            # health changes on every poll, there is no sense in ETag
+            self._send_body(self.cache.get_health(), {'Cache-Control': 'no-store'})
+            return
+        if path == PATH_PREFIX:
+            body, etag = self.cache.get_all()
+        elif path.startswith(PATH_PREFIX + '/'):
+            cached = self.cache.get(unquote(path[len(PATH_PREFIX) + 1:]))
+            if cached is None:
+                self.send_error(404, "Device is unknown or wasn't polled yet")
+                return
+            body, etag = cached.body, cached.etag
+        else:
+            self.send_error(404)
+            return
+
+        if self._etag_matches(etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self._send_body(body, {'ETag': etag, 'Cache-Control': 'no-cache'})
+
+    def _send_body(self, body: bytes, headers: Dict[str, str]):
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _etag_matches(self, etag: str) -> bool:
+        if_none_match = self.headers.get('If-None-Match')
+        if not if_none_match:
+            return False
+        candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+        # weak comparison, like RFC 7232 requires for If-None-Match
+        return '*' in candidates or etag in (candidate[2:] if candidate.startswith('W/') else candidate
+                                             for candidate in candidates)
+
+    def log_message(self, format, *args):
+        logger.debug("Latest measurements request: " + format, *args)
+
+
+def start_http_server(cache: LatestMeasurementsCache, port: int, address: str = '') -> ThreadingHTTPServer:
+    """
+    Serves the latest measurements on 'http://<address>:<port>/measurements' for all devices
+    and '/measurements/<device>' for one device, in a background thread.
+    '/health' has health state of all devices.
+    """
+    server = http_server.start_http_server(_LatestMeasurementsHandler, port, address, 'latest-http', cache=cache)
+    logger.info("Serving latest measurements on port %d", server.server_address[1])
+    return server
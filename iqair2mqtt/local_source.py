@@ -0,0 +1,107 @@
+import json
+import logging
+import os
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from iqair2mqtt import errors, metrics
+from iqair2mqtt.inotify import DirectoryWatcher
+from iqair2mqtt.source import MEASUREMENTS_FILE, STREAM_CHUNK_SIZE, MeasurementSource
+
+logger = logging.getLogger(__name__)
+
+
+class LocalDirectorySource(MeasurementSource):
+    """
+    Reads files of AirVisual device from a local directory, like the device share
+    mounted with the kernel CIFS client or synced to disk. There is no network round
+    trip, and with 'watch' new measurements are read as soon as the file is written.
+    'name' identifies the device in errors and metrics.
+    """
+
+    def __init__(self, directory: str, name: str):
+        self._directory = directory
+        self._name = name
+        self._measurements_file_version: Optional[Tuple[int, int]] = None
+        self.fetches_skipped = 0
+        self._watcher: Optional[DirectoryWatcher] = None
+
+        self._fetch_seconds = metrics.IQAIR_FETCH_SECONDS.labels(name)
+        self._fetch_bytes = metrics.IQAIR_FETCH_BYTES.labels(name)
+        self._fetches_skipped_metric = metrics.IQAIR_FETCHES_SKIPPED.labels(name)
+
+    def noop(self):
+        if not os.path.isdir(self._directory):
+            raise errors.IQAirConnectionError(self._name)
+
+    def get_latest_measurements(self) -> Dict:
+        started_at = perf_counter()
+        try:
+            with open(self._path(MEASUREMENTS_FILE), 'rb') as measurements_fh:
+                raw_file_content = measurements_fh.read()
+            file_data = json.loads(raw_file_content)
+        except (FileNotFoundError, UnicodeDecodeError, json.JSONDecodeError) as exc:
+            # file might be written right now, it's read again on next change
+            raise errors.IQAirMeasurementsFileNotFoundOrWrong(self._name) from exc
+        self._fetch_seconds.observe(perf_counter() - started_at)
+        self._fetch_bytes.inc(len(raw_file_content))
+        return file_data
+
+    def get_changed_measurements(self) -> Optional[Dict]:
+        try:
+            stat = os.stat(self._path(MEASUREMENTS_FILE))
+        except FileNotFoundError as exc:
+            raise errors.IQAirMeasurementsFileNotFoundOrWrong(self._name) from exc
+        file_version = (stat.st_mtime_ns, stat.st_size)
+        if file_version == self._measurements_file_version:
+            self.fetches_skipped += 1
+            self._fetches_skipped_metric.inc()
+            return None
+
+        file_data = self.get_latest_measurements()
+        self._measurements_file_version = file_version
+        return file_data
+
+    def forget_version(self):
+        self._measurements_file_version = None
+
+    def list_files(self, suffix: str = '') -> List[str]:
+        return sorted(
+            f'/{entry.name}' for entry in os.scandir(self._directory)
+            if entry.is_file() and entry.name.endswith(suffix)
+        )
+
+    def stream_file(self, file_path: str, offset: int = 0, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+        with open(self._path(file_path), 'rb') as file_fh:
+            file_fh.seek(offset)
+            while True:
+                chunk = file_fh.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def watch(self, on_change: Callable[[], None]) -> bool:
+        """
+        Calls 'on_change' when measurements file is written, using inotify.
+        Returns False if inotify isn't available, then directory has to be polled.
+        """
+        self._stop_watching()
+        watcher = DirectoryWatcher(self._directory, [os.path.basename(MEASUREMENTS_FILE)], lambda _: on_change())
+        try:
+            watcher.start()
+        except OSError as exc:
+            logger.info("Can't watch %s for changes, it will be polled. Err %s", self._directory, exc)
+            return False
+        self._watcher = watcher
+        return True
+
+    def close(self):
+        self._stop_watching()
+
+    def _stop_watching(self):
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+
+    def _path(self, file_path: str) -> str:
+        return os.path.join(self._directory, file_path.lstrip('/'))
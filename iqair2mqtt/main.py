@@ -1,74 +1,213 @@
 import logging
+from datetime import datetime
+from typing import Optional
 
-import time
 import click
+from smb.smb_structs import OperationFailure
 
-from iqair2mqtt import errors
-from iqair2mqtt.iqair import IQAir
-from iqair2mqtt.config import Config
+from iqair2mqtt import errors, latest_api, metrics
+from iqair2mqtt.archive import MeasurementArchive, open_archive, replay
+from iqair2mqtt.backfill import Backfill, BackfillState
+from iqair2mqtt.config import Config, DeviceConfig, PUBLISH_MODE_JSON
+from iqair2mqtt.config_watcher import ConfigWatcher
+from iqair2mqtt.discovery import AnnouncedState, HomeAssistantDiscovery
+from iqair2mqtt.fleet import FleetPoller, sync_pollers
+from iqair2mqtt.json_encoder import get_encoder
 from iqair2mqtt.mqtt import MQTTPublisher
-from iqair2mqtt.iqair_parser import parse_measurements
+from iqair2mqtt.mqtt_queue import open_queue
+from iqair2mqtt.poller import DevicePoller, make_source
+from iqair2mqtt.sharding import ShardedPoller
+from iqair2mqtt.source import MeasurementSource
 
 
 logger = logging.getLogger('iqair2mqtt')
 
+BROKER_CONNECTION_TIMEOUT = 30
+
+
+def make_publisher(config: Config) -> MQTTPublisher:
+    return MQTTPublisher(
+        config.mqtt_hostname,
+        config.mqtt_login,
+        config.mqtt_password,
+        config.get_topic,
+        queue=open_queue(config.mqtt_queue_dir, config.mqtt_queue_max_bytes, config.mqtt_queue_max_age),
+        port=config.mqtt_port,
+    )
+
 
 @click.command()
 @click.option('-d', '--debug', default=False, is_flag=True)
 @click.option('-c', '--config', 'config_path', type=str,
               prompt=False, help="Path to the config file")
-def main(config_path: str, debug: bool):
+@click.option('-b', '--backfill', 'backfill', default=False, is_flag=True,
+              help="Publish measurements from IQAir history, which weren't published yet, before polling")
+@click.option('--replay-since', 'replay_since', type=click.DateTime(), default=None,
+              help="Publish archived measurements taken since this UTC time again and exit")
+@click.option('--replay-until', 'replay_until', type=click.DateTime(), default=None,
+              help="End of replayed time range in UTC, by default now")
+def main(config_path: str, debug: bool, backfill: bool, replay_since: Optional[datetime],
+         replay_until: Optional[datetime]):
     if debug:
         logging.basicConfig(level=logging.DEBUG)
         # turn off logging for SMB
         logging.getLogger('SMB').setLevel(logging.WARNING)
 
     config = Config(config_path)
-    iqair_device = IQAir(config.iqair_ip, config.iqair_login, config.iqair_password)
-    try:
-        iqair_device.noop()  # test connection to IQAIR
-    except errors.IQAirConnectionError as exc:
-        logger.warning(
-            "Can't connect to IQAir. Check config. Err: %s",
-            exc
-        )
+    archive = open_archive(config.archive_dir, config.archive_retention)
+    if replay_since is not None:
+        if archive is None:
+            logger.error("Archive isn't configured, set ARCHIVE_DIR to replay measurements")
+            return
+        replay_archive(config, archive, replay_since, replay_until or datetime.utcnow())
         return
 
-    mqtt_publisher = MQTTPublisher(
-        config.mqtt_hostname,
-        config.mqtt_login,
-        config.mqtt_password,
-        config.get_topic,
-    )
-
-    mqtt_publisher.connect()
+    if config.metrics_port is not None:
+        metrics.start_http_server(config.metrics_port)
 
-    last_measurements = None
-    while True:
+    iqair_devices = {}
+    connected_devices = 0
+    for device_config in config.devices:
+        iqair_ip = device_config.ip
+        iqair_device = make_source(config, device_config)
+        iqair_devices[iqair_ip] = iqair_device
         try:
-            raw_iqair_measurements = iqair_device.get_latest_measurements()
+            iqair_device.noop()  # test connection to IQAIR
         except errors.IQAirConnectionError as exc:
             logger.warning(
-                "Can't get latest data from IQAir. Err %s",
+                "Can't connect to IQAir. Check config. Err: %s",
                 exc
             )
             continue
-        iqair_measurements = parse_measurements(config, raw_iqair_measurements)
-
-        # check measurements we got from IQAir are new compare to ones
-        # we published last time
-        if last_measurements is not None and last_measurements >= iqair_measurements:
-            logger.info(
-                "Measurements '%s' from IQAir were already published, will not publish",
-                iqair_measurements
-            )
-        else:
-            logger.debug(
-                "Got fresh IQAir measurements '%s', going to publish them",
-                iqair_measurements
-            )
+        connected_devices += 1
+
+    # unreachable devices are polled anyway, they might come back,
+    # but if none of them is reachable config is probably wrong
+    if not connected_devices:
+        return
+
+    mqtt_publisher = make_publisher(config)
+
+    mqtt_publisher.connect()
 
-            mqtt_publisher.publish(iqair_measurements.to_json())
-            last_measurements = iqair_measurements  # save last published measurements
-        logger.debug("Sleeping for %d seconds", config.update_interal)
-        time.sleep(config.update_interal)
+    if backfill:
+        if not mqtt_publisher.wait_for_connection(BROKER_CONNECTION_TIMEOUT):
+            logger.warning("MQTT broker isn't connected yet, backfill might fail")
+        history_backfill = Backfill(
+            config,
+            mqtt_publisher,
+            BackfillState(config.backfill_state_file),
+            config.backfill_batch_size,
+            config.backfill_batch_interval,
+        )
+        for iqair_ip, iqair_device in iqair_devices.items():
+            try:
+                history_backfill.run(iqair_device, iqair_ip)
+            except (errors.IQAirConnectionError, errors.IQAirCircuitOpen, errors.IQAirMeasurementsFileNotFoundOrWrong,
+                    errors.IQAirDataCorrupted, errors.MQTTBrokerNotConnected, FileNotFoundError,
+                    OperationFailure) as exc:
+                # history file is missing or can't be read
+                logger.warning("Can't backfill history of IQAir %s. Err %s", iqair_ip, exc)
+
+    if config.poll_workers > 1:
+        # workers open own connections and archive
+        for iqair_device in iqair_devices.values():
+            iqair_device.close()
+        if archive is not None:
+            archive.close()
+        run_sharded(config, config_path, mqtt_publisher)
+        return
+
+    discovery = None
+    if config.ha_discovery_prefix:
+        discovery = HomeAssistantDiscovery(
+            mqtt_publisher,
+            get_encoder(config.json_encoder),
+            config.ha_discovery_prefix,
+            config.get_topic,
+            per_measurement=config.mqtt_publish_mode != PUBLISH_MODE_JSON,
+            state=AnnouncedState(config.ha_discovery_state_file),
+        )
+
+    latest_cache = None
+    if config.api_port is not None:
+        latest_cache = latest_api.LatestMeasurementsCache(get_encoder(config.json_encoder))
+        latest_api.start_http_server(latest_cache, config.api_port)
+
+    def make_poller(device_config: DeviceConfig, iqair_device: Optional[MeasurementSource] = None) -> DevicePoller:
+        if iqair_device is None:
+            iqair_device = make_source(config, device_config)
+        return DevicePoller(config, iqair_device, mqtt_publisher, device_config.ip,
+                            discovery=discovery, device_config=device_config, latest_cache=latest_cache,
+                            breaker=iqair_device.breaker, archive=archive)
+
+    pollers = [
+        make_poller(config.device(iqair_ip), iqair_device)
+        for iqair_ip, iqair_device in iqair_devices.items()
+    ]
+    fleet_poller = FleetPoller(pollers, config.iqair_concurrency)
+
+    config_watcher = None
+    if config_path and config.config_reload_interval > 0:
+        running_devices = config.devices
+
+        def on_config_change(new_config: Config):
+            # only devices are reloaded, MQTT session and other settings are kept
+            nonlocal running_devices
+            sync_pollers(fleet_poller, running_devices, new_config.devices, make_poller)
+            if latest_cache is not None:
+                new_ips = {device.ip for device in new_config.devices}
+                for device in running_devices:
+                    if device.ip not in new_ips:
+                        latest_cache.remove(device.ip)
+            running_devices = new_config.devices
+
+        config_watcher = ConfigWatcher(config_path, on_config_change, config.config_reload_interval)
+        config_watcher.start()
+
+    try:
+        fleet_poller.run()
+    finally:
+        if config_watcher is not None:
+            config_watcher.stop()
+        # don't lose messages which are still in flight on restart
+        mqtt_publisher.close()
+        if archive is not None:
+            archive.close()
+
+
+def run_sharded(config: Config, config_path: Optional[str], mqtt_publisher: MQTTPublisher):
+    if config.api_port is not None:
+        logger.warning("Latest measurements API isn't supported with POLL_WORKERS, it isn't started")
+    sharded_poller = ShardedPoller(config, config.devices, mqtt_publisher, config.poll_workers)
+
+    config_watcher = None
+    if config_path and config.config_reload_interval > 0:
+        config_watcher = ConfigWatcher(
+            config_path,
+            lambda new_config: sharded_poller.sync_devices(new_config.devices),
+            config.config_reload_interval,
+        )
+        config_watcher.start()
+
+    try:
+        sharded_poller.run()
+    finally:
+        if config_watcher is not None:
+            config_watcher.stop()
+        mqtt_publisher.close()
+
+
+def replay_archive(config: Config, archive: MeasurementArchive, since: datetime, until: datetime):
+    mqtt_publisher = make_publisher(config)
+    mqtt_publisher.connect()
+    if not mqtt_publisher.wait_for_connection(BROKER_CONNECTION_TIMEOUT):
+        logger.warning("MQTT broker isn't connected yet, replayed measurements will be queued")
+    try:
+        published = replay(archive, mqtt_publisher, config, since, until)
+        logger.info("Replayed %d archived measurements from %s to %s", published, since, until)
+    except errors.MQTTBrokerNotConnected as exc:
+        logger.error("Can't replay archived measurements. Err %s", exc)
+    finally:
+        mqtt_publisher.close()
+        archive.close()
@@ -0,0 +1,249 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Sequence, Tuple
+
+from iqair2mqtt import http_server
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# latency buckets in seconds, from a fast local parse to a timed out SMB connection
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class CounterValue:
+    """
+    Value of a counter for one set of labels
+    """
+
+    __slots__ = ('_value', '_lock')
+
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+
+class HistogramValue:
+    """
+    Value of a histogram for one set of labels
+    """
+
+    __slots__ = ('_upper_bounds', '_buckets', '_sum', '_count', '_lock')
+
+    def __init__(self, upper_bounds: Sequence[float]):
+        self._upper_bounds = upper_bounds
+        self._buckets = [0] * (len(upper_bounds) + 1)  # the last one is +Inf
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self._upper_bounds, value)
+        with self._lock:
+            self._buckets[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        with self._lock:
+            return list(self._buckets), self._sum, self._count
+
+
+class Metric:
+
+    metric_type = ''
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *label_values: str):
+        """
+        Returns value for label values, it should be kept by caller, so the hot path
+        doesn't look it up on every update
+        """
+        if len(label_values) != len(self.label_names):
+            raise ValueError(f"Metric {self.name} expects labels {self.label_names}")
+        with self._lock:
+            value = self._values.get(label_values)
+            if value is None:
+                value = self._values[label_values] = self._new_value()
+            return value
+
+    def _new_value(self):
+        raise NotImplementedError
+
+    def _format_labels(self, label_values: Tuple[str, ...], extra: str = '') -> str:
+        labels = [
+            '{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in zip(self.label_names, label_values)
+        ]
+        if extra:
+            labels.append(extra)
+        return '{' + ','.join(labels) + '}' if labels else ''
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}']
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            lines.extend(self._render_value(label_values, value))
+        return lines
+
+    def _render_value(self, label_values: Tuple[str, ...], value) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+
+    metric_type = 'counter'
+
+    def _new_value(self) -> CounterValue:
+        return CounterValue()
+
+    def labels(self, *label_values: str) -> CounterValue:
+        return super().labels(*label_values)
+
+    def _render_value(self, label_values: Tuple[str, ...], value: CounterValue) -> List[str]:
+        return [f'{self.name}{self._format_labels(label_values)} {value.value}']
+
+
+class Histogram(Metric):
+
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_value(self) -> HistogramValue:
+        return HistogramValue(self.buckets)
+
+    def labels(self, *label_values: str) -> HistogramValue:
+        return super().labels(*label_values)
+
+    def _render_value(self, label_values: Tuple[str, ...], value: HistogramValue) -> List[str]:
+        buckets, total, count = value.snapshot()
+        lines = []
+        cumulative = 0
+        for upper_bound, bucket in zip((*self.buckets, '+Inf'), buckets):
+            cumulative += bucket
+            labels = self._format_labels(label_values, f'le="{upper_bound}"')
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = self._format_labels(label_values)
+        lines.append(f'{self.name}_sum{labels} {total}')
+        lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, label_names))
+
+    def histogram(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+IQAIR_CONNECT_SECONDS = REGISTRY.histogram(
+    'iqair_connect_seconds', "Time of SMB connection to IQAir, including retries", ['device'])
+IQAIR_CONNECT_RETRIES = REGISTRY.counter(
+    'iqair_connect_retries_total', "SMB connection attempts to IQAir which were retried", ['device'])
+IQAIR_CONNECT_FAILURES = REGISTRY.counter(
+    'iqair_connect_failures_total', "SMB connections to IQAir which failed after all attempts", ['device'])
+IQAIR_CIRCUIT_OPENED = REGISTRY.counter(
+    'iqair_circuit_opened_total', "Times connections to IQAir were stopped because it's offline", ['device'])
+IQAIR_SESSION_REUSES = REGISTRY.counter(
+    'iqair_session_reuses_total', "Fetches done in already opened SMB session", ['device'])
+IQAIR_SESSION_RECONNECTS = REGISTRY.counter(
+    'iqair_session_reconnects_total', "SMB sessions reopened because IQAir dropped them", ['device'])
+IQAIR_FETCH_SECONDS = REGISTRY.histogram(
+    'iqair_fetch_seconds', "Time of file download from IQAir", ['device'])
+IQAIR_FETCH_BYTES = REGISTRY.counter(
+    'iqair_fetch_bytes_total', "Bytes downloaded from IQAir", ['device'])
+IQAIR_FETCHES_SKIPPED = REGISTRY.counter(
+    'iqair_fetches_skipped_total', "Downloads skipped because measurements file wasn't changed", ['device'])
+PARSE_SECONDS = REGISTRY.histogram(
+    'iqair_parse_seconds', "Time of IQAir measurements parsing")
+POLL_SECONDS = REGISTRY.histogram(
+    'iqair_poll_seconds', "Time of the whole poll of IQAir, from fetch to publish", ['device'])
+POLL_FAILURES = REGISTRY.counter(
+    'iqair_poll_failures_total', "Polls of IQAir which failed", ['device'])
+MEASUREMENTS_SUPPRESSED = REGISTRY.counter(
+    'iqair_measurements_suppressed_total', "Measurements not published because they didn't change", ['device'])
+POLL_WORKER_RESTARTS = REGISTRY.counter(
+    'poll_worker_restarts_total', "Times a dead poll worker process was restarted", ['worker'])
+MQTT_PUBLISH_SECONDS = REGISTRY.histogram(
+    'mqtt_publish_seconds', "Time of handing a message to MQTT client")
+MQTT_PUBLISHED = REGISTRY.counter(
+    'mqtt_published_total', "Messages handed to MQTT client")
+MQTT_PUBLISH_FAILURES = REGISTRY.counter(
+    'mqtt_publish_failures_total', "Messages which couldn't be published right away")
+MQTT_QUEUED = REGISTRY.counter(
+    'mqtt_queued_total', "Messages stored in the disk queue because broker wasn't available")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics request: " + format, *args)
+
+
+def start_http_server(port: int, address: str = '', registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """
+    Serves metrics in Prometheus text format on 'http://<address>:<port>/metrics'
+    in a background thread
+    """
+    server = http_server.start_http_server(_MetricsHandler, port, address, 'metrics-http', registry=registry)
+    logger.info("Serving metrics on port %d", server.server_address[1])
+    return server
+
@@ -1,7 +1,8 @@
-import json
 from datetime import datetime
-from typing import Union, List, NamedTuple
+from functools import lru_cache
+from typing import Union, List, NamedTuple, Optional
 
+from iqair2mqtt.json_encoder import STDLIB_ENCODER, JSONEncoder, get_encoder
 from iqair2mqtt.models.device import IQAirDevice
 
 
@@ -12,8 +13,27 @@ class IQAirMeasurement(NamedTuple):
     unit: str
 
 
+@lru_cache(maxsize=1024)
+def _encode_header(encoder: JSONEncoder, device: IQAirDevice) -> bytes:
+    """
+    Returns encoded beginning of measurements document, up to the measurements list
+    """
+    header = encoder.dumps({
+        'location': device.location,
+        'device_type': 'iqair',
+        'device_name': device.name,
+        'external': device.external,
+        'placement': device.placement,
+        'measurements': [],
+    })
+    # cut the empty list and closing brace, measurements are put there
+    return header[:header.rindex(b'[')]
+
+
 class IQAirMeasurements:
 
+    __slots__ = ('revision', 'device', 'measurements')
+
     def __init__(self, revision: int, device: IQAirDevice, measurements: List[IQAirMeasurement]):
 
         # just in case check and fall early
@@ -24,27 +44,33 @@ class IQAirMeasurements:
         self.device = device
 
     def to_json(self) -> str:
+        return self.to_json_bytes(STDLIB_ENCODER).decode()
+
+    def to_json_bytes(self, encoder: Optional[JSONEncoder] = None) -> bytes:
+        """
+        Serializes measurements with 'encoder', by default the fastest available one.
+        Device part of the document doesn't change between polls, so it's encoded once
+        and only measurements are encoded every time.
+        """
+        if encoder is None:
+            encoder = get_encoder()
         measurements = []
+        measured_at, measured_at_iso = None, None
         for measurement in self.measurements:
+            # all measurements of one poll usually share time, format it once
+            if measurement.measured_at is not measured_at:
+                measured_at = measurement.measured_at
+                measured_at_iso = measured_at.isoformat()
             measurements.append(
                 {
-                    'measered_at': measurement.measured_at.isoformat(),
+                    'measered_at': measured_at_iso,
                     'type': measurement.name,
                     'value': measurement.value,
                     'unit': measurement.unit,
                 }
             )
 
-        data = {
-            'location': self.device.location,
-            'device_type': 'iqair',
-            'device_name': self.device.name,
-            'external': self.device.external,
-            'placement': self.device.placement,
-            'measurements': measurements
-        }
-
-        return json.dumps(data)
+        return b''.join((_encode_header(encoder, self.device), encoder.dumps(measurements), b'}'))
 
     def __lt__(self, other):
         if not isinstance(other, self.__class__):
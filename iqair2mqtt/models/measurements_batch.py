@@ -0,0 +1,97 @@
+from array import array
+from datetime import datetime, timedelta, tzinfo
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from iqair2mqtt.models.device import IQAirDevice
+from iqair2mqtt.models.iqair_measurement import IQAirMeasurement, IQAirMeasurements
+
+EPOCH = datetime(1970, 1, 1)
+# values are stored as doubles, ints are marked to be restored as ints
+VALUE_FLOAT = 0
+VALUE_INT = 1
+
+
+class IQAirMeasurementsBatch:
+    """
+    Compact storage for many 'IQAirMeasurements' of one device, to keep hours of readings in memory.
+
+    Instead of an object per measurement, data is stored by columns in typed arrays:
+    one timestamp per sample, as all measurements of a sample share it, and for
+    every measurement an id of its (name, unit) pair and a value. Names and units
+    are stored once per batch.
+    Iterating the batch gives back 'IQAirMeasurements' equal to the appended ones,
+    so they serialize exactly the same.
+    """
+
+    __slots__ = (
+        'device', '_tzinfo', '_revisions', '_timestamps', '_offsets',
+        '_keys', '_key_ids', '_key_index', '_values', '_value_types',
+    )
+
+    def __init__(self, device: IQAirDevice, samples: Iterable[IQAirMeasurements] = ()):
+        self.device = device
+        self._tzinfo: Optional[tzinfo] = None
+        self._revisions = array('q')
+        self._timestamps = array('q')  # microseconds since epoch of wall clock in '_tzinfo'
+        # sample 'i' measurements are in value columns from '_offsets[i]' to '_offsets[i + 1]'
+        self._offsets = array('L', [0])
+        self._keys: List[Tuple[str, str]] = []
+        self._key_index: Dict[Tuple[str, str], int] = {}
+        self._key_ids = array('H')
+        self._values = array('d')
+        self._value_types = array('b')
+        for sample in samples:
+            self.append(sample)
+
+    def append(self, sample: IQAirMeasurements):
+        if sample.device != self.device:
+            raise ValueError(f"Batch is for device {self.device.name}, not {sample.device.name}")
+        measurements = sample.measurements
+        measured_at = measurements[0].measured_at if measurements else None
+        if measured_at is not None:
+            if any(measurement.measured_at != measured_at for measurement in measurements):
+                raise ValueError("All measurements of a sample must have the same time")
+            if not len(self._values):
+                # the first sample with measurements, empty ones have no time
+                self._tzinfo = measured_at.tzinfo
+            elif measured_at.tzinfo is not self._tzinfo:
+                raise ValueError(f"Batch is for timezone {self._tzinfo}, not {measured_at.tzinfo}")
+            timestamp = (measured_at.replace(tzinfo=None) - EPOCH) // timedelta(microseconds=1)
+        else:
+            timestamp = 0
+
+        for measurement in measurements:
+            key = (measurement.name, measurement.unit)
+            key_id = self._key_index.get(key)
+            if key_id is None:
+                key_id = self._key_index[key] = len(self._keys)
+                self._keys.append(key)
+            self._key_ids.append(key_id)
+            self._values.append(measurement.value)
+            self._value_types.append(VALUE_INT if isinstance(measurement.value, int) else VALUE_FLOAT)
+        self._revisions.append(sample.revision)
+        self._timestamps.append(timestamp)
+        self._offsets.append(len(self._values))
+
+    def __len__(self) -> int:
+        return len(self._revisions)
+
+    def __getitem__(self, index: int) -> IQAirMeasurements:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Batch index out of range")
+        measured_at = (EPOCH + timedelta(microseconds=self._timestamps[index])).replace(tzinfo=self._tzinfo)
+        keys, key_ids, values, value_types = self._keys, self._key_ids, self._values, self._value_types
+        measurements = []
+        for position in range(self._offsets[index], self._offsets[index + 1]):
+            name, unit = keys[key_ids[position]]
+            value = values[position]
+            if value_types[position] == VALUE_INT:
+                value = int(value)
+            measurements.append(IQAirMeasurement(measured_at=measured_at, name=name, value=value, unit=unit))
+        return IQAirMeasurements(self._revisions[index], self.device, measurements)
+
+    def __iter__(self) -> Iterator[IQAirMeasurements]:
+        for index in range(len(self)):
+            yield self[index]
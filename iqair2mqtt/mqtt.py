@@ -1,16 +1,95 @@
 import logging
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple, Union
+
 import paho.mqtt.client as mqtt
 
+from iqair2mqtt import metrics
+from iqair2mqtt.aggregation import Aggregate, format_window
 from iqair2mqtt.errors import MQTTBrokerNotConnected
+from iqair2mqtt.json_encoder import JSONEncoder
+from iqair2mqtt.models.device import IQAirDevice
+from iqair2mqtt.models.iqair_measurement import IQAirMeasurements
+from iqair2mqtt.mqtt_queue import DiskQueue, QueuedMessage
+from iqair2mqtt.topics import MeasurementTopics
 
 logger = logging.getLogger(__name__)
 
+QOS = 2  # we are not limited for energy
+REPLAY_WINDOW = 20
+REPLAY_ACK_TIMEOUT = 30
+# how long 'close' waits until broker acknowledges messages in flight
+FLUSH_TIMEOUT = 10
+DEFAULT_PORT = 1883
 
-class MQTTPublisher:
+_publish_seconds = metrics.MQTT_PUBLISH_SECONDS.labels()
+_published = metrics.MQTT_PUBLISHED.labels()
+_publish_failures = metrics.MQTT_PUBLISH_FAILURES.labels()
+_queued = metrics.MQTT_QUEUED.labels()
 
-    def __init__(self, hostname: str, login: str, password: str, topic: str):
-        self._hostname = hostname
+
+class BasePublisher:
+    """
+    Publishing of measurements and aggregates to their own topics,
+    on top of 'publish' which subclasses implement
+    """
+
+    def __init__(self, topic: str):
         self._topic = topic
+        # topic prefix -> topics of measurements, devices can have own prefix
+        self._measurement_topics: Dict[str, MeasurementTopics] = {}
+
+    def publish(self, data: Union[str, bytes], topic: Optional[str] = None, retain: bool = False):
+        raise NotImplementedError
+
+    def publish_per_measurement(self, iqair_measurements: IQAirMeasurements, topic: Optional[str] = None):
+        """
+        Publishes every measurement value to its own retained topic
+        '<topic>/<location>/<device>/<type>', so consumers can subscribe only to values they need
+        """
+        device = iqair_measurements.device
+        measurement_topics = self._get_measurement_topics(topic)
+        for measurement in iqair_measurements.measurements:
+            self.publish(
+                str(measurement.value),
+                topic=measurement_topics.get(device, measurement),
+                retain=True,
+            )
+
+    def publish_aggregates(self, device: IQAirDevice, aggregates: Dict[Tuple[str, str], List[Aggregate]],
+                           encoder: JSONEncoder, topic: Optional[str] = None):
+        """
+        Publishes aggregates of every measurement type and window to own retained
+        topic '<topic>/<location>/<device>/<type>/<window>', like '.../pm25_ugm3/5m'
+        """
+        measurement_topics = self._get_measurement_topics(topic)
+        for (name, unit), measurement_aggregates in aggregates.items():
+            for aggregate in measurement_aggregates:
+                self.publish(
+                    encoder.dumps(aggregate._asdict()),
+                    topic=measurement_topics.get_by_type(device, name, unit, format_window(aggregate.window)),
+                    retain=True,
+                )
+
+    def _get_measurement_topics(self, prefix: Optional[str]) -> MeasurementTopics:
+        if prefix is None:
+            prefix = self._topic
+        measurement_topics = self._measurement_topics.get(prefix)
+        if measurement_topics is None:
+            measurement_topics = self._measurement_topics[prefix] = MeasurementTopics(prefix)
+        return measurement_topics
+
+
+class MQTTPublisher(BasePublisher):
+
+    def __init__(self, hostname: str, login: str, password: str, topic: str,
+                 queue: Optional[DiskQueue] = None, replay_window: int = REPLAY_WINDOW,
+                 port: int = DEFAULT_PORT):
+        super().__init__(topic)
+        self._hostname = hostname
+        self._port = port
         self._connected = False
         self._client = mqtt.Client(client_id='iqair2mqtt')
         # TODO certificates
@@ -18,16 +97,87 @@ class MQTTPublisher:
         self._client.on_connect = self._on_connect_callback
         self._client.on_disconnect = self._on_disconnect_callback
 
+        # messages which can't be sent are stored in the queue, and replayed
+        # by 'replay_window' messages at once when connection is back
+        self._queue = queue
+        self._replay_window = replay_window
+        self._state_changed = threading.Condition()
+        self._replay_thread: Optional[threading.Thread] = None
+        self._closed = False
+
+        # published messages which broker didn't acknowledge yet, they are flushed on close
+        self._in_flight: Deque[Tuple[mqtt.MQTTMessageInfo, str, Union[str, bytes], bool]] = deque()
+        self._in_flight_lock = threading.Lock()
+
         logger.debug("Starting MQTT client loop")
 
     def connect(self):
-        self._client.connect(self._hostname)
-        self._client.loop_start()  # Add loop stop, on exit
+        self._client.connect(self._hostname, self._port)
+        self._client.loop_start()
+        if self._queue is not None and self._replay_thread is None:
+            self._replay_thread = threading.Thread(target=self._replay_queue, name='mqtt-replay', daemon=True)
+            self._replay_thread.start()
+
+    def wait_for_connection(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until broker is connected, returns False on timeout
+        """
+        with self._state_changed:
+            return self._state_changed.wait_for(lambda: self._connected, timeout=timeout)
+
+    def disconnect(self):
+        self._client.disconnect()
+        self._client.loop_stop()
+
+    def flush(self, timeout: float = FLUSH_TIMEOUT) -> int:
+        """
+        Waits until broker acknowledges all published messages, returns
+        number of messages which weren't acknowledged in 'timeout' seconds
+        """
+        deadline = time.monotonic() + timeout
+        with self._in_flight_lock:
+            in_flight = list(self._in_flight)
+        not_acknowledged = 0
+        for message_info, _, _, _ in in_flight:
+            # messages published while connection was lost wait for reconnect
+            if message_info.rc == mqtt.MQTT_ERR_SUCCESS:
+                message_info.wait_for_publish(timeout=max(deadline - time.monotonic(), 0))
+            if not message_info.is_published():
+                not_acknowledged += 1
+        self._prune_in_flight()
+        return not_acknowledged
+
+    def close(self, timeout: float = FLUSH_TIMEOUT):
+        """
+        Flushes messages in flight and disconnects from broker. Messages which
+        broker didn't acknowledge are stored in the queue, so they are sent after
+        restart, without a queue they are lost.
+        """
+        not_acknowledged = self.flush(timeout)
+        with self._state_changed:
+            self._closed = True
+            self._state_changed.notify_all()
+        self.disconnect()
+        if not_acknowledged:
+            with self._in_flight_lock:
+                in_flight = list(self._in_flight)
+                self._in_flight.clear()
+            if self._queue is None:
+                logger.warning("%d messages weren't acknowledged by MQTT broker and are lost", not_acknowledged)
+            else:
+                for _, topic, data, retain in in_flight:
+                    self._enqueue(data, topic, retain)
+                logger.info("%d messages weren't acknowledged by MQTT broker, stored them in the queue",
+                            not_acknowledged)
+        if self._replay_thread is not None:
+            self._replay_thread.join(timeout)
 
     def _on_connect_callback(self, client, userdata, flags, rc):
         if rc == 0:
             logger.debug("Connected to MQTT broker on host %s", self._hostname)
-            self._connected = True
+            with self._state_changed:
+                self._connected = True
+                self._state_changed.notify_all()
         else:
             logger.warning(
                 "Can't connect to MQTT broker on host %s, rc is %d",
@@ -35,18 +185,104 @@ class MQTTPublisher:
                 rc,
             )
 
-    def _on_disconnect_callback(self, client, userdata, flags, rc):
-        self._connected = False
+    def _on_disconnect_callback(self, client, userdata, rc):
+        with self._state_changed:
+            self._connected = False
+            self._state_changed.notify_all()
         logger.info("Disconnected from MQTT broker on host %s", self._hostname)
 
-    def publish(self, data: str):
+    def publish(self, data: Union[str, bytes], topic: Optional[str] = None, retain: bool = False):
+        """
+        Publishes data to the topic, by default it's publisher's topic. If broker isn't
+        connected and there is a queue, data is stored in the queue and will be published
+        after reconnect. Otherwise 'MQTTBrokerNotConnected' is raised.
+        """
+        if topic is None:
+            topic = self._topic
         if not self._connected:
-            # TODO consider change this to warning and store last N message, trying to send them again
-            raise MQTTBrokerNotConnected()
+            _publish_failures.inc()
+            self._enqueue(data, topic, retain)
+            return
 
+        started_at = time.perf_counter()
         # TODO check that message was published
-        self._client.publish(
-            topic=self._topic,
+        message_info = self._client.publish(
+            topic=topic,
             payload=data,
-            qos=2,  # we are not limited for energy
+            qos=QOS,
+            retain=retain,
         )
+        _publish_seconds.observe(time.perf_counter() - started_at)
+        _published.inc()
+        # if connection was lost right now, paho keeps the message and sends it after
+        # reconnect, we only need to take care about messages paho refused to keep
+        if message_info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+            _publish_failures.inc()
+            self._enqueue(data, topic, retain)
+            return
+        self._prune_in_flight()
+        with self._in_flight_lock:
+            self._in_flight.append((message_info, topic, data, retain))
+
+    def _prune_in_flight(self):
+        """
+        Forgets messages which broker acknowledged, they are acknowledged in order
+        """
+        with self._in_flight_lock:
+            while self._in_flight and self._in_flight[0][0].is_published():
+                self._in_flight.popleft()
+
+    def _enqueue(self, data: Union[str, bytes], topic: str, retain: bool):
+        if self._queue is None:
+            raise MQTTBrokerNotConnected()
+        payload = data.encode() if isinstance(data, str) else data
+        self._queue.append(QueuedMessage(time.time(), topic, payload, QOS, retain))
+        _queued.inc()
+        with self._state_changed:
+            self._state_changed.notify_all()
+        logger.info("MQTT broker isn't connected, message is stored in the queue")
+
+    def _replay_queue(self):
+        """
+        Sends messages from the queue while broker is connected. At most 'replay_window'
+        messages are in flight at once, so the broker isn't flooded and live messages
+        published in the meantime don't wait for the whole backlog.
+        Messages are removed from the queue only after broker acknowledged them,
+        if connection is lost in the middle of a window, the window is sent again.
+        """
+        while True:
+            with self._state_changed:
+                self._state_changed.wait_for(lambda: self._closed or (self._connected and len(self._queue) > 0))
+                if self._closed:
+                    return
+            batch = self._queue.read(self._replay_window)
+            if not batch:
+                # only expired or corrupted messages were left, don't spin on them
+                with self._state_changed:
+                    self._state_changed.wait(REPLAY_ACK_TIMEOUT)
+                continue
+
+            logger.info("Replaying %d messages from the queue", len(batch))
+            messages_info = [
+                self._client.publish(
+                    topic=message.topic,
+                    payload=message.payload,
+                    qos=message.qos,
+                    retain=message.retain,
+                )
+                for _, message in batch
+            ]
+            deadline = time.monotonic() + REPLAY_ACK_TIMEOUT
+            for message_info in messages_info:
+                if message_info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    break
+                message_info.wait_for_publish(timeout=max(deadline - time.monotonic(), 0))
+                if not message_info.is_published():
+                    break
+            else:
+                self._queue.ack(batch[-1][0])
+                continue
+
+            logger.warning("Replay of the queue is interrupted, will continue after reconnect")
+            with self._state_changed:
+                self._state_changed.wait_for(lambda: not self._connected, timeout=REPLAY_ACK_TIMEOUT)
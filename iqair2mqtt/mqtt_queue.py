@@ -0,0 +1,246 @@
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.seg'
+CURSOR_FILE = 'cursor'
+SEGMENT_SIZE = 1024 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+
+# payload length, queued at, qos, retain, topic length
+RECORD_HEADER = struct.Struct('<IdBBH')
+RECORD_CRC = struct.Struct('<I')
+# segment number, offset in segment
+CURSOR = struct.Struct('<QQ')
+
+
+class QueuedMessage(NamedTuple):
+    queued_at: float
+    topic: str
+    payload: bytes
+    qos: int
+    retain: bool
+
+
+class QueuePosition(NamedTuple):
+    """
+    Position right after a record in the queue
+    """
+    segment: int
+    offset: int
+
+
+class DiskQueue:
+    """
+    Bounded append-only on-disk queue for MQTT messages, which weren't sent to the broker.
+
+    Messages are appended to segment files in 'directory', position of the first
+    not acknowledged message is stored in a cursor file, so queue survives restarts.
+    Every record has a checksum, a record torn by crash is dropped on next start.
+    When queue grows over 'max_bytes' the oldest segments are dropped, messages
+    older than 'max_age' seconds are skipped on read.
+    Queue is thread safe.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_age: float,
+                 segment_size: int = SEGMENT_SIZE, fsync: bool = True):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._segment_size = segment_size
+        self._fsync = fsync
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        self._segments: List[int] = sorted(
+            int(file_name[:-len(SEGMENT_SUFFIX)])
+            for file_name in os.listdir(directory)
+            if file_name.endswith(SEGMENT_SUFFIX)
+        )
+        self._size = sum(os.path.getsize(self._segment_path(segment)) for segment in self._segments)
+        self._cursor = self._load_cursor()
+        if not self._segments or self._cursor.segment > self._segments[-1]:
+            # everything was consumed, continue with an empty segment
+            self._segments.append(self._cursor.segment)
+            self._save_cursor(QueuePosition(self._cursor.segment, 0))
+        self._delete_consumed_segments()
+        self._write_fh = open(self._segment_path(self._segments[-1]), 'ab')
+        self._truncate_torn_record()
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        """
+        Approximate size of not acknowledged messages in bytes
+        """
+        with self._lock:
+            return self._size - self._cursor.offset
+
+    def close(self):
+        with self._lock:
+            self._write_fh.close()
+
+    def append(self, message: QueuedMessage):
+        topic = message.topic.encode()
+        record = b''.join((
+            RECORD_HEADER.pack(len(message.payload), message.queued_at, message.qos, message.retain, len(topic)),
+            topic,
+            message.payload,
+        ))
+        record += RECORD_CRC.pack(zlib.crc32(record))
+        with self._lock:
+            if self._write_fh.tell() >= self._segment_size:
+                self._rotate()
+            self._write_fh.write(record)
+            self._write_fh.flush()
+            if self._fsync:
+                os.fsync(self._write_fh.fileno())
+            self._size += len(record)
+            self._enforce_max_bytes()
+
+    def read(self, limit: int) -> List[Tuple[QueuePosition, QueuedMessage]]:
+        """
+        Returns up to 'limit' oldest not acknowledged messages with positions
+        which should be passed to 'ack' after messages are delivered.
+        Expired messages are skipped and acknowledged right away.
+        """
+        result: List[Tuple[QueuePosition, QueuedMessage]] = []
+        expired_position = None
+        oldest_allowed = time.time() - self._max_age
+        with self._lock:
+            cursor = self._cursor
+            for segment in self._segments:
+                if segment < cursor.segment:
+                    continue
+                offset = cursor.offset if segment == cursor.segment else 0
+                for position, message in self._read_segment(segment, offset):
+                    if message.queued_at < oldest_allowed:
+                        expired_position = position
+                        continue
+                    result.append((position, message))
+                    if len(result) >= limit:
+                        break
+                if len(result) >= limit:
+                    break
+        if not result and expired_position is not None:
+            logger.info("Skipped expired messages in queue %s", self._directory)
+            self.ack(expired_position)
+        return result
+
+    def ack(self, position: QueuePosition):
+        """
+        Acknowledges all messages up to 'position' inclusive
+        """
+        with self._lock:
+            if position <= self._cursor:
+                return
+            self._save_cursor(position)
+            self._delete_consumed_segments()
+
+    def _read_segment(self, segment: int, offset: int) -> Iterator[Tuple[QueuePosition, QueuedMessage]]:
+        """
+        Yields valid records of a segment starting from 'offset', segment is read by chunks
+        """
+        # make sure everything appended is visible for reading
+        self._write_fh.flush()
+        with open(self._segment_path(segment), 'rb') as read_fh:
+            read_fh.seek(offset)
+            data = b''
+            while True:
+                chunk = read_fh.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    return
+                data += chunk
+                position = 0
+                while position + RECORD_HEADER.size <= len(data):
+                    payload_length, queued_at, qos, retain, topic_length = RECORD_HEADER.unpack_from(data, position)
+                    end = position + RECORD_HEADER.size + topic_length + payload_length
+                    if end + RECORD_CRC.size > len(data):
+                        break  # record continues in next chunk
+                    (crc,) = RECORD_CRC.unpack_from(data, end)
+                    if crc != zlib.crc32(data[position:end]):
+                        logger.warning("Queue segment %d is corrupted at offset %d", segment, offset + position)
+                        return
+                    topic_start = position + RECORD_HEADER.size
+                    message = QueuedMessage(
+                        queued_at=queued_at,
+                        topic=data[topic_start:topic_start + topic_length].decode(),
+                        payload=data[topic_start + topic_length:end],
+                        qos=qos,
+                        retain=bool(retain),
+                    )
+                    position = end + RECORD_CRC.size
+                    yield QueuePosition(segment, offset + position), message
+                data = data[position:]
+                offset += position
+
+    def _rotate(self):
+        self._write_fh.close()
+        self._segments.append(self._segments[-1] + 1)
+        self._write_fh = open(self._segment_path(self._segments[-1]), 'ab')
+
+    def _enforce_max_bytes(self):
+        while self._size > self._max_bytes and len(self._segments) > 1:
+            segment = self._segments[0]
+            logger.warning("MQTT queue %s is full, dropping oldest segment %d", self._directory, segment)
+            self.dropped += 1
+            self._save_cursor(max(self._cursor, QueuePosition(segment + 1, 0)))
+            self._delete_consumed_segments()
+
+    def _delete_consumed_segments(self):
+        while len(self._segments) > 1 and self._segments[0] < self._cursor.segment:
+            segment = self._segments.pop(0)
+            path = self._segment_path(segment)
+            self._size -= os.path.getsize(path)
+            os.remove(path)
+        # last segment is consumed completely, start a new one to free space
+        if (len(self._segments) > 1 and self._segments[0] == self._cursor.segment
+                and self._cursor.offset >= os.path.getsize(self._segment_path(self._segments[0]))):
+            self._save_cursor(QueuePosition(self._segments[1], 0))
+            self._delete_consumed_segments()
+
+    def _truncate_torn_record(self):
+        segment = self._segments[-1]
+        offset = self._cursor.offset if segment == self._cursor.segment else 0
+        valid_end = offset
+        for position, _ in self._read_segment(segment, offset):
+            valid_end = position.offset
+        if valid_end < self._write_fh.tell():
+            logger.warning("Dropping torn record at the end of queue segment %d", segment)
+            self._write_fh.truncate(valid_end)
+            self._write_fh.seek(valid_end)
+
+    def _load_cursor(self) -> QueuePosition:
+        try:
+            with open(os.path.join(self._directory, CURSOR_FILE), 'rb') as cursor_fh:
+                return QueuePosition(*CURSOR.unpack(cursor_fh.read(CURSOR.size)))
+        except (FileNotFoundError, struct.error):
+            return QueuePosition(self._segments[0] if self._segments else 0, 0)
+
+    def _save_cursor(self, position: QueuePosition):
+        # write and rename, to never have half written cursor
+        path = os.path.join(self._directory, CURSOR_FILE)
+        with open(path + '.tmp', 'wb') as cursor_fh:
+            cursor_fh.write(CURSOR.pack(*position))
+            if self._fsync:
+                cursor_fh.flush()
+                os.fsync(cursor_fh.fileno())
+        os.replace(path + '.tmp', path)
+        self._cursor = position
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self._directory, f'{segment:020d}{SEGMENT_SUFFIX}')
+
+
+def open_queue(directory: Optional[str], max_bytes: int, max_age: float) -> Optional[DiskQueue]:
+    """
+    Opens disk queue in 'directory', if it's set
+    """
+    if not directory:
+        return None
+    return DiskQueue(directory, max_bytes, max_age)
@@ -0,0 +1,228 @@
+import logging
+import time
+from time import perf_counter
+from typing import Callable, Optional
+
+from iqair2mqtt import errors, metrics
+from iqair2mqtt.aggregation import DeviceAggregator
+from iqair2mqtt.archive import MeasurementArchive
+from iqair2mqtt.circuit_breaker import CircuitBreaker, STATE_OPEN
+
+from iqair2mqtt.config import Config, DeviceConfig, PUBLISH_MODE_JSON, PUBLISH_MODE_PER_MEASUREMENT
+from iqair2mqtt.deadband import DeadbandFilter
+from iqair2mqtt.discovery import HomeAssistantDiscovery
+from iqair2mqtt.iqair_parser import parse_measurements
+from iqair2mqtt.iqair import IQAir
+from iqair2mqtt.json_encoder import get_encoder
+from iqair2mqtt.latest_api import LatestMeasurementsCache
+from iqair2mqtt.local_source import LocalDirectorySource
+from iqair2mqtt.models.iqair_measurement import IQAirMeasurements
+from iqair2mqtt.mqtt import BasePublisher
+from iqair2mqtt.scheduler import PollScheduler
+from iqair2mqtt.source import MeasurementSource
+from iqair2mqtt.topics import availability_topic
+
+logger = logging.getLogger(__name__)
+
+AVAILABILITY_ONLINE = 'online'
+AVAILABILITY_OFFLINE = 'offline'
+
+
+class DevicePoller:
+    """
+    Polls one IQAir device and publishes its measurements,
+    if they weren't published yet.
+    If there is a circuit breaker, device availability is published to a retained topic
+    when it changes, and offline device isn't polled until the breaker lets a probe through.
+    """
+
+    def __init__(self, config: Config, iqair: MeasurementSource, publisher: BasePublisher, name: str,
+                 scheduler: Optional[PollScheduler] = None, discovery: Optional[HomeAssistantDiscovery] = None,
+                 device_config: Optional[DeviceConfig] = None, latest_cache: Optional[LatestMeasurementsCache] = None,
+                 breaker: Optional[CircuitBreaker] = None, archive: Optional[MeasurementArchive] = None):
+        self._config = config
+        # location, placement, topic and interval of the device
+        self.device_config = device_config if device_config is not None else config.device(name)
+        self._iqair = iqair
+        self._publisher = publisher
+        self._encoder = get_encoder(config.json_encoder)
+        self.name = name
+        self.last_measurements: Optional[IQAirMeasurements] = None
+        self.scheduler = scheduler if scheduler is not None else PollScheduler(self.device_config.interval)
+        self._discovery = discovery
+        self._latest_cache = latest_cache
+        self._archive = archive
+        self._breaker = breaker  # the same one IQAir uses for connections
+        self.availability_topic = availability_topic(self.device_config.topic, name)
+        self._available: Optional[bool] = None  # last published availability
+        self._poll_seconds = metrics.POLL_SECONDS.labels(name)
+        self._poll_failures = metrics.POLL_FAILURES.labels(name)
+        self._suppressed = metrics.MEASUREMENTS_SUPPRESSED.labels(name)
+        deadbands = config.deadbands
+        self._deadband_filter = DeadbandFilter(deadbands, config.deadband_heartbeat) if deadbands else None
+        windows = config.aggregation_windows
+        self._aggregator = DeviceAggregator(windows, config.aggregation_publish_interval) if windows else None
+
+    def poll(self) -> bool:
+        """
+        Fetches latest measurements from the device and publishes them if they are new.
+        Returns True if measurements were published.
+
+        Can raise the same exceptions as 'IQAir.get_changed_measurements',
+        'parse_measurements' and 'MQTTPublisher.publish'
+        """
+        started_at = perf_counter()
+        try:
+            return self._poll()
+        except Exception:
+            self._poll_failures.inc()
+            self.scheduler.on_error()
+            # measurements weren't published, file must be read again even if it isn't changed
+            self._iqair.forget_version()
+            raise
+        finally:
+            self._poll_seconds.observe(perf_counter() - started_at)
+            if self._breaker is not None:
+                self._update_availability()
+
+    def next_poll_delay(self) -> float:
+        """
+        Seconds until the device should be polled again
+        """
+        delay = self.scheduler.next_delay(time.time())
+        if self._breaker is not None:
+            # there is no sense to poll before the breaker lets a probe through
+            delay = max(delay, self._breaker.retry_in())
+        return delay
+
+    def aggregates_delay(self) -> Optional[float]:
+        """
+        Seconds until aggregates should be published, None if there is nothing to aggregate
+        """
+        if self._aggregator is None or self.last_measurements is None:
+            return None
+        return self._aggregator.due_in()
+
+    def publish_aggregates(self) -> bool:
+        """
+        Publishes aggregates if they are due, even if device didn't send new measurements
+        for a while. Returns True if they were published.
+        Can raise the same exceptions as 'MQTTPublisher.publish', then they are due until published.
+        """
+        if self._aggregator is None or self.last_measurements is None or not self._aggregator.is_due():
+            return False
+        aggregates = self._aggregator.collect()
+        if aggregates:
+            self._publisher.publish_aggregates(
+                self.last_measurements.device, aggregates, self._encoder, topic=self.device_config.topic)
+        self._aggregator.mark_published()
+        return True
+
+    def watch(self, on_change: Callable[[], None]) -> bool:
+        """
+        Asks the source to call 'on_change' when device writes new measurements,
+        returns False if the source can only be polled
+        """
+        return self._iqair.watch(on_change)
+
+    def _update_availability(self):
+        health = self._breaker.health()
+        available = health['state'] != STATE_OPEN
+        if self._latest_cache is not None:
+            self._latest_cache.set_health(self.name, dict(health, available=available))
+        if available == self._available:
+            return
+        try:
+            self._publisher.publish(
+                AVAILABILITY_ONLINE if available else AVAILABILITY_OFFLINE,
+                topic=self.availability_topic,
+                retain=True,
+            )
+        except errors.MQTTBrokerNotConnected as exc:
+            # will try again after the next poll, error of the poll itself is more important
+            logger.warning("Can't publish availability of IQAir %s. Err %s", self.name, exc)
+            return
+        self._available = available
+
+    def _poll(self) -> bool:
+        raw_iqair_measurements = self._iqair.get_changed_measurements()
+        if raw_iqair_measurements is None:
+            logger.debug("Measurements file on IQAir %s wasn't changed, will not publish", self.name)
+            self.scheduler.on_success(None)
+            return False
+        iqair_measurements = parse_measurements(self.device_config, raw_iqair_measurements)
+        self.scheduler.on_success(iqair_measurements)
+
+        # check measurements we got from IQAir are new compare to ones
+        # we published last time
+        if self.last_measurements is not None and self.last_measurements >= iqair_measurements:
+            logger.info(
+                "Measurements '%s' from IQAir %s were already published, will not publish",
+                iqair_measurements,
+                self.name
+            )
+            return False
+
+        logger.debug(
+            "Got fresh IQAir measurements '%s' from %s, going to publish them",
+            iqair_measurements,
+            self.name
+        )
+        if self._latest_cache is not None:
+            self._latest_cache.update(self.name, iqair_measurements)
+        if self._archive is not None:
+            # everything is archived, even what deadband doesn't publish
+            self._archive.append(self.name, iqair_measurements)
+        if self._discovery is not None:
+            # Home Assistant should know sensors before their values come
+            self._discovery.announce(
+                iqair_measurements,
+                self.device_config.topic,
+                self.availability_topic if self._breaker is not None else None,
+            )
+        to_publish = self._filter_unchanged(iqair_measurements)
+        if to_publish is not None:
+            publish_mode = self._config.mqtt_publish_mode
+            if publish_mode != PUBLISH_MODE_PER_MEASUREMENT:
+                self._publisher.publish(to_publish.to_json_bytes(self._encoder), topic=self.device_config.topic)
+            if publish_mode != PUBLISH_MODE_JSON:
+                self._publisher.publish_per_measurement(to_publish, topic=self.device_config.topic)
+            if self._deadband_filter is not None:
+                self._deadband_filter.mark_published(to_publish)
+        self.last_measurements = iqair_measurements  # save last published measurements
+
+        if self._aggregator is not None:
+            # aggregates are published by 'publish_aggregates' on own schedule
+            self._aggregator.add(iqair_measurements)
+        return to_publish is not None
+
+    def _filter_unchanged(self, iqair_measurements: IQAirMeasurements) -> Optional[IQAirMeasurements]:
+        """
+        Returns measurements which changed over deadband, None if nothing changed
+        """
+        if self._deadband_filter is None:
+            return iqair_measurements
+        to_publish = self._deadband_filter.filter(iqair_measurements)
+        published = len(to_publish.measurements) if to_publish is not None else 0
+        self._suppressed.inc(len(iqair_measurements.measurements) - published)
+        if to_publish is None:
+            logger.debug("Measurements from IQAir %s didn't change, will not publish", self.name)
+        return to_publish
+
+    def close(self):
+        self._iqair.close()
+
+
+def make_source(config: Config, device_config: DeviceConfig) -> MeasurementSource:
+    """
+    Source of device measurements: its local directory if it's set, otherwise the device itself over SMB
+    """
+    if device_config.directory:
+        return LocalDirectorySource(device_config.directory, device_config.ip)
+    breaker = CircuitBreaker(
+        device_config.ip,
+        config.breaker_failure_threshold,
+        config.breaker_open_timeout,
+        config.breaker_max_open_timeout,
+    )
+    return IQAir(device_config.ip, device_config.login, device_config.password, breaker=breaker)
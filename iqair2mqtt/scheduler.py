@@ -0,0 +1,88 @@
+import logging
+import random
+import statistics
+from collections import deque
+from typing import Callable, Deque, Optional
+
+from iqair2mqtt.models.iqair_measurement import IQAirMeasurements
+
+logger = logging.getLogger(__name__)
+
+# poll this long after expected device update, to give it time to write the file
+UPDATE_MARGIN = 1.0
+# don't poll more often than this, even if device is late with an update
+MIN_INTERVAL = 2.0
+MAX_BACKOFF = 300.0
+# how many last update intervals are used to learn device update interval
+LEARN_WINDOW = 8
+
+
+class PollScheduler:
+    """
+    Decides when IQAir device should be polled next.
+
+    Device update interval is learned from 'timestamp' of measurements, as median
+    of the last intervals, so a missed update doesn't break it. Polls are scheduled
+    right after the expected next update. If device is late, it's polled every
+    'min_interval' seconds for half of update interval, after that the scheduler
+    falls back to default 'interval' until next update is seen.
+    On errors polls are delayed with jittered exponential backoff.
+    """
+
+    def __init__(self, interval: float, min_interval: float = MIN_INTERVAL, max_backoff: float = MAX_BACKOFF,
+                 margin: float = UPDATE_MARGIN, jitter: Callable[[], float] = random.random):
+        self._interval = interval
+        self._min_interval = min_interval
+        self._max_backoff = max_backoff
+        self._margin = margin
+        self._jitter = jitter
+        self._update_intervals: Deque[int] = deque(maxlen=LEARN_WINDOW)
+        self._last_revision: Optional[int] = None
+        self._last_update_at: Optional[float] = None  # device update time, seconds since epoch
+        self.failures = 0
+
+    @property
+    def device_interval(self) -> Optional[float]:
+        """
+        Learned interval between device updates, None if it isn't known yet
+        """
+        if not self._update_intervals:
+            return None
+        return statistics.median(self._update_intervals)
+
+    def on_success(self, measurements: Optional[IQAirMeasurements]):
+        """
+        Registers successful poll, 'measurements' are None if device had no new data
+        """
+        self.failures = 0
+        if measurements is None or measurements.revision == self._last_revision:
+            return
+        if self._last_revision is not None and measurements.revision > self._last_revision:
+            self._update_intervals.append(measurements.revision - self._last_revision)
+        self._last_revision = measurements.revision
+        if measurements.measurements:
+            self._last_update_at = measurements.measurements[0].measured_at.timestamp()
+
+    def on_error(self):
+        self.failures += 1
+
+    def next_delay(self, now: float) -> float:
+        """
+        Returns delay in seconds until next poll, 'now' is current time in seconds since epoch
+        """
+        if self.failures:
+            backoff = min(self._interval * 2 ** (self.failures - 1), self._max_backoff)
+            # equal jitter, so devices which failed together don't retry together
+            return backoff / 2 + backoff / 2 * self._jitter()
+
+        device_interval = self.device_interval
+        if device_interval is None or self._last_update_at is None:
+            return self._interval
+
+        expected_update_at = self._last_update_at + device_interval + self._margin
+        if now < expected_update_at:
+            # device clock can be ahead of ours, never wait longer than one update interval
+            return min(max(expected_update_at - now, self._min_interval), device_interval + self._margin)
+        if now < expected_update_at + device_interval / 2:
+            return self._min_interval  # device is late, check again soon
+        return self._interval
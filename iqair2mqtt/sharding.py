@@ -0,0 +1,472 @@
+import asyncio
+import heapq
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from multiprocessing.connection import Connection, wait
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from iqair2mqtt import errors, metrics
+from iqair2mqtt.archive import open_archive
+from iqair2mqtt.config import Config, DeviceConfig, PUBLISH_MODE_JSON
+from iqair2mqtt.discovery import AnnouncedState, HomeAssistantDiscovery
+from iqair2mqtt.fleet import FleetPoller, SHUTDOWN_TIMEOUT
+from iqair2mqtt.json_encoder import get_encoder
+from iqair2mqtt.mqtt import BasePublisher
+from iqair2mqtt.poller import DevicePoller, make_source
+
+logger = logging.getLogger(__name__)
+
+# commands from the main process to a worker
+COMMAND_ADD = 'add'
+COMMAND_REMOVE = 'remove'
+COMMAND_STOP = 'stop'
+# results from a worker to the main process
+RESULT_PUBLISH = 'publish'
+# worker doesn't poll the device anymore and closed its archive
+RESULT_RELEASED = 'released'
+
+# how often the main process checks workers are alive
+CHECK_INTERVAL = 0.5
+# first delay before a dead worker is restarted, it doubles while the worker keeps dying
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+# how long a stopped worker can take to exit after its polls finished
+EXIT_GRACE = 5
+
+# topic, payload and retain flag of a message
+Message = Tuple[Optional[str], Union[str, bytes], bool]
+
+
+class ShardPublisher(BasePublisher):
+    """
+    Publisher of a worker process. Messages aren't published, but collected
+    and sent to the main process by 'flush' in one batch, after every poll.
+    """
+
+    def __init__(self, topic: str, connection: Connection):
+        super().__init__(topic)
+        self._connection = connection
+        self._pending: List[Message] = []
+        self._lock = threading.Lock()
+
+    def publish(self, data: Union[str, bytes], topic: Optional[str] = None, retain: bool = False):
+        with self._lock:
+            self._pending.append((topic, data, retain))
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            messages, self._pending = self._pending, []
+            # under the lock, so batches come in the order they were published
+            self._connection.send((RESULT_PUBLISH, messages))
+
+    def send_released(self, name: str):
+        with self._lock:
+            self._connection.send((RESULT_RELEASED, name))
+
+
+class ShardDevicePoller(DevicePoller):
+    """
+    Device poller of a worker process, which sends what poll published to the main process.
+    'on_close' is called after the last poll of the device.
+    """
+
+    _publisher: ShardPublisher
+
+    def __init__(self, *args, on_close: Optional[Callable[['ShardDevicePoller'], None]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._on_close = on_close
+
+    def poll(self) -> bool:
+        try:
+            return super().poll()
+        finally:
+            self._publisher.flush()
+
+    def publish_aggregates(self) -> bool:
+        try:
+            return super().publish_aggregates()
+        finally:
+            self._publisher.flush()
+
+    def close(self):
+        super().close()
+        if self._on_close is not None:
+            self._on_close(self)
+
+
+def plan_assignment(names: Iterable[str], loads: Dict[int, int]) -> Dict[str, int]:
+    """
+    Assigns every device to the worker with the fewest devices, 'loads' is number
+    of devices every worker which can take them already polls. Returns device -> worker.
+    """
+    if not loads:
+        return {}
+    heap = [(load, index) for index, load in loads.items()]
+    heapq.heapify(heap)
+    assignment = {}
+    for name in names:
+        load, index = heapq.heappop(heap)
+        assignment[name] = index
+        heapq.heappush(heap, (load + 1, index))
+    return assignment
+
+
+class _Worker:
+    """
+    Slot of a worker process, it keeps the index when the process is restarted
+    """
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process: Optional[multiprocessing.process.BaseProcess] = None
+        self.connection: Optional[Connection] = None
+        self.started_at = 0.0
+        self.restart_at = 0.0
+        self.restart_delay = 0.0
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+
+class ShardedPoller:
+    """
+    Polls devices in 'workers' processes, so fetching, JSON decoding and parsing
+    of hundreds of devices isn't limited by one interpreter. Every worker polls
+    its shard of devices with own 'FleetPoller' and sends messages to publish back
+    to this process, which owns the only MQTT connection.
+
+    Devices of a dead worker are handed to other live workers right away and the
+    worker is restarted after a delay, which grows while it keeps dying. Restarted
+    worker takes new devices. Every device is polled by one worker at a time,
+    so workers can share the measurements archive.
+
+    Published messages can't be confirmed to workers, so without MQTT queue
+    measurements which come while the broker is disconnected are lost.
+    """
+
+    def __init__(self, config: Config, devices: List[DeviceConfig], publisher: BasePublisher, workers: int,
+                 shutdown_timeout: float = SHUTDOWN_TIMEOUT, restart_delay: float = RESTART_DELAY,
+                 max_restart_delay: float = MAX_RESTART_DELAY):
+        if workers < 1:
+            raise ValueError("There must be at least 1 worker")
+        self._config = config
+        self._publisher = publisher
+        self._shutdown_timeout = shutdown_timeout
+        self._restart_delay = restart_delay
+        self._max_restart_delay = max_restart_delay
+        self._context = multiprocessing.get_context('spawn')
+        self._workers = [_Worker(index) for index in range(workers)]
+        self._devices: Dict[str, DeviceConfig] = {device.ip: device for device in devices}
+        self._assignments: Dict[str, int] = {}
+        # devices waiting for a live worker
+        self._unassigned: Set[str] = set(self._devices)
+        # removed devices which worker still polls or archives, device -> worker,
+        # they aren't given to another worker until it's done, so two workers never write one archive
+        self._releasing: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._restarts = metrics.POLL_WORKER_RESTARTS
+
+    @property
+    def assignments(self) -> Dict[str, int]:
+        """
+        Device -> index of the worker which polls it
+        """
+        with self._lock:
+            return dict(self._assignments)
+
+    @property
+    def worker_pids(self) -> List[Optional[int]]:
+        return [worker.process.pid if worker.process is not None else None for worker in self._workers]
+
+    def run(self):
+        """
+        Starts workers and publishes what they send until 'stop' is called or the process is asked to terminate
+        """
+        previous_handlers = self._add_signal_handlers()
+        try:
+            with self._lock:
+                for worker in self._workers:
+                    self._start_worker(worker)
+                self._assign_unassigned()
+            while not self._stop_event.is_set():
+                self._forward_results(CHECK_INTERVAL)
+                self._check_workers()
+        finally:
+            for signal_number, handler in previous_handlers.items():
+                signal.signal(signal_number, handler)
+            self._stop_workers()
+
+    def stop(self):
+        """
+        Stops polling, can be called from any thread
+        """
+        self._stop_event.set()
+
+    def sync_devices(self, devices: List[DeviceConfig]):
+        """
+        Applies changed list of devices: removed ones aren't polled anymore, changed ones
+        get new pollers in the same worker and new ones go to the least busy worker
+        """
+        new = {device.ip: device for device in devices}
+        with self._lock:
+            for ip in self._devices.keys() - new.keys():
+                logger.info("IQAir %s was removed from config", ip)
+                self._unassigned.discard(ip)
+                index = self._assignments.pop(ip, None)
+                if index is not None:
+                    self._releasing[ip] = index
+                    self._send(self._workers[index], (COMMAND_REMOVE, ip))
+            added = []
+            for ip, device in new.items():
+                if self._devices.get(ip) == device:
+                    continue
+                logger.info("IQAir %s was %s config", ip, 'changed in' if ip in self._devices else 'added to')
+                index = self._assignments.get(ip)
+                if index is not None:
+                    self._send(self._workers[index], (COMMAND_ADD, device))
+                elif ip not in self._unassigned:
+                    added.append(ip)
+            self._devices = new
+            self._unassigned.update(added)
+            if not self._stop_event.is_set():
+                self._assign_unassigned()
+
+    def _start_worker(self, worker: _Worker):
+        connection, worker_connection = self._context.Pipe()
+        process = self._context.Process(
+            target=run_worker,
+            args=(worker.index, self._config, worker_connection, logging.getLogger().level, self._shutdown_timeout),
+            name=f'iqair2mqtt-worker-{worker.index}',
+            daemon=True,
+        )
+        process.start()
+        # only the worker writes to its end, so its death closes the pipe
+        worker_connection.close()
+        worker.process = process
+        worker.connection = connection
+        worker.started_at = time.monotonic()
+        logger.info("Started poll worker %d, pid %s", worker.index, process.pid)
+
+    def _check_workers(self):
+        """
+        Hands devices of dead workers to live ones and restarts workers which waited long enough
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._stop_event.is_set():
+                return
+            for worker in self._workers:
+                if worker.process is not None and not worker.process.is_alive():
+                    self._on_worker_died(worker, now)
+            # restarted workers don't get devices of the dead ones right away, they might die again
+            self._assign_unassigned()
+            for worker in self._workers:
+                if worker.process is None and now >= worker.restart_at:
+                    self._restarts.labels(str(worker.index)).inc()
+                    self._start_worker(worker)
+            # unless there is no other worker
+            self._assign_unassigned()
+
+    def _on_worker_died(self, worker: _Worker, now: float):
+        orphans = [ip for ip, index in self._assignments.items() if index == worker.index]
+        logger.error("Poll worker %d died with exit code %s, its %d devices are handed to other workers",
+                     worker.index, worker.process.exitcode, len(orphans))
+        for ip in orphans:
+            del self._assignments[ip]
+        for ip in [ip for ip, index in self._releasing.items() if index == worker.index]:
+            del self._releasing[ip]
+        self._unassigned.update(orphans)
+        worker.process.join()
+        worker.process = None
+        if worker.connection is not None:
+            worker.connection.close()
+            worker.connection = None
+        if now - worker.started_at >= self._max_restart_delay:
+            worker.restart_delay = self._restart_delay  # it worked for a while
+        else:
+            worker.restart_delay = min(max(worker.restart_delay * 2, self._restart_delay), self._max_restart_delay)
+        worker.restart_at = now + worker.restart_delay
+
+    def _assign_unassigned(self):
+        ready = sorted(ip for ip in self._unassigned if ip not in self._releasing)
+        if not ready:
+            return
+        loads = {worker.index: 0 for worker in self._workers if worker.alive}
+        for index in self._assignments.values():
+            if index in loads:
+                loads[index] += 1
+        for ip, index in plan_assignment(ready, loads).items():
+            self._unassigned.discard(ip)
+            self._assignments[ip] = index
+            self._send(self._workers[index], (COMMAND_ADD, self._devices[ip]))
+            logger.debug("IQAir %s is polled by worker %d", ip, index)
+
+    @staticmethod
+    def _send(worker: _Worker, command: Tuple[str, object]):
+        if worker.connection is None:
+            return
+        try:
+            worker.connection.send(command)
+        except OSError as exc:
+            # worker is dead, its devices will be handed over on the next check
+            logger.debug("Can't send %s to poll worker %d. Err %s", command[0], worker.index, exc)
+
+    def _forward_results(self, timeout: float):
+        connections = {worker.connection: worker for worker in self._workers if worker.connection is not None}
+        if not connections:
+            self._stop_event.wait(timeout)
+            return
+        for connection in wait(list(connections), timeout):
+            worker = connections[connection]
+            try:
+                kind, payload = connection.recv()
+            except (EOFError, OSError):
+                # worker exited, it's handled by the next check
+                with self._lock:
+                    connection.close()
+                    worker.connection = None
+                continue
+            if kind == RESULT_PUBLISH:
+                self._publish(payload)
+            elif kind == RESULT_RELEASED:
+                self._on_released(worker, payload)
+
+    def _on_released(self, worker: _Worker, name: str):
+        with self._lock:
+            if self._releasing.get(name) == worker.index:
+                del self._releasing[name]
+                if not self._stop_event.is_set():
+                    self._assign_unassigned()
+
+    def _publish(self, messages: List[Message]):
+        for topic, data, retain in messages:
+            try:
+                self._publisher.publish(data, topic=topic, retain=retain)
+            except errors.MQTTBrokerNotConnected as exc:
+                logger.warning("Can't publish %d messages from poll worker. Err %s", len(messages), exc)
+                return
+
+    def _stop_workers(self):
+        with self._lock:
+            for worker in self._workers:
+                self._send(worker, (COMMAND_STOP, None))
+        # workers finish running polls, their results are still published
+        deadline = time.monotonic() + self._shutdown_timeout + EXIT_GRACE
+        while any(worker.connection is not None for worker in self._workers) and time.monotonic() < deadline:
+            self._forward_results(CHECK_INTERVAL)
+        for worker in self._workers:
+            if worker.process is None:
+                continue
+            if worker.alive:
+                logger.warning("Poll worker %d didn't stop in time, terminating it", worker.index)
+                worker.process.terminate()
+            worker.process.join()
+            worker.process = None
+            if worker.connection is not None:
+                worker.connection.close()
+                worker.connection = None
+
+    def _add_signal_handlers(self) -> Dict[int, Callable]:
+        """
+        Stops polling on termination signals, returns replaced handlers.
+        Signals can be handled only in the main thread.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return {}
+        previous_handlers = {}
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            previous_handlers[signal_number] = signal.signal(signal_number, self._on_signal)
+        return previous_handlers
+
+    def _on_signal(self, signal_number: int, frame):
+        logger.info("Got signal %s, stopping", signal.Signals(signal_number).name)
+        self._stop_event.set()
+
+
+def run_worker(index: int, config: Config, connection: Connection, log_level: int,
+               shutdown_timeout: float = SHUTDOWN_TIMEOUT):
+    """
+    Entry point of a worker process, polls devices which the main process sends
+    """
+    logging.basicConfig(level=log_level)
+    logging.getLogger('SMB').setLevel(logging.WARNING)
+
+    publisher = ShardPublisher(config.get_topic, connection)
+    archive = open_archive(config.archive_dir, config.archive_retention)
+    discovery = None
+    if config.ha_discovery_prefix:
+        discovery = HomeAssistantDiscovery(
+            publisher,
+            get_encoder(config.json_encoder),
+            config.ha_discovery_prefix,
+            config.get_topic,
+            per_measurement=config.mqtt_publish_mode != PUBLISH_MODE_JSON,
+            # workers can't share the file, device announced by another worker is announced again
+            state=AnnouncedState(f'{config.ha_discovery_state_file}.{index}'),
+        )
+
+    fleet_poller = FleetPoller([], config.iqair_concurrency, shutdown_timeout)
+
+    def make_poller(device_config: DeviceConfig) -> DevicePoller:
+        if archive is not None and device_config.ip not in fleet_poller.pollers:
+            # device might have been archived by another worker since it was polled here
+            archive.release(device_config.ip)
+        source = make_source(config, device_config)
+        return ShardDevicePoller(config, source, publisher, device_config.ip, discovery=discovery,
+                                 device_config=device_config, breaker=source.breaker, archive=archive,
+                                 on_close=on_poller_closed)
+
+    def on_poller_closed(poller: DevicePoller):
+        if fleet_poller.pollers.get(poller.name) is not None:
+            return  # poller was replaced by a new one for changed device
+        if archive is not None:
+            archive.release(poller.name)
+        try:
+            publisher.send_released(poller.name)
+        except OSError:
+            pass  # main process is gone
+    try:
+        asyncio.run(_serve(fleet_poller, connection, make_poller))
+    finally:
+        if archive is not None:
+            archive.close()
+        connection.close()
+
+
+async def _serve(fleet_poller: FleetPoller, connection: Connection,
+                 make_poller: Callable[[DeviceConfig], DevicePoller]):
+    fleet_task = asyncio.ensure_future(fleet_poller.run_async())
+    # lets fleet poller start, after that pollers can be added from another thread
+    await asyncio.sleep(0)
+    threading.Thread(
+        target=_read_commands,
+        args=(connection, fleet_poller, make_poller),
+        name='commands',
+        daemon=True,
+    ).start()
+    await fleet_task
+
+
+def _read_commands(connection: Connection, fleet_poller: FleetPoller,
+                   make_poller: Callable[[DeviceConfig], DevicePoller]):
+    while True:
+        try:
+            command, argument = connection.recv()
+        except (EOFError, OSError):
+            logger.warning("Lost connection to the main process, stopping")
+            fleet_poller.stop()
+            return
+        if command == COMMAND_ADD:
+            fleet_poller.add_poller(make_poller(argument))
+        elif command == COMMAND_REMOVE:
+            fleet_poller.remove_poller(argument)
+        elif command == COMMAND_STOP:
+            fleet_poller.stop()
+            return
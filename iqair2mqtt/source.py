@@ -0,0 +1,72 @@
+import logging
+from typing import Callable, Dict, Iterator, List, Optional
+
+from iqair2mqtt.circuit_breaker import CircuitBreaker
+
+logger = logging.getLogger(__name__)
+
+MEASUREMENTS_FILE = '/latest_config_measurements.json'
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class MeasurementSource:
+    """
+    Where files of one AirVisual device are read from: 'IQAir' reads them from
+    the device over SMB, 'LocalDirectorySource' from a mounted or synced directory.
+    Paths are relative to the root of the device share, like '/latest_config_measurements.json'.
+    """
+
+    @property
+    def breaker(self) -> Optional[CircuitBreaker]:
+        """
+        Circuit breaker of connections to the source, None if it has none
+        """
+        return None
+
+    def noop(self):
+        """
+        Checks source is reachable, raises an error if it isn't
+        """
+        raise NotImplementedError
+
+    def get_latest_measurements(self) -> Dict:
+        """
+        Returns parsed 'latest_config_measurements.json'
+        """
+        raise NotImplementedError
+
+    def get_changed_measurements(self) -> Optional[Dict]:
+        """
+        Same as 'get_latest_measurements', but returns None if the file wasn't changed since the previous call
+        """
+        raise NotImplementedError
+
+    def forget_version(self):
+        """
+        Forgets version of measurements file seen by 'get_changed_measurements', so it's returned
+        on the next call even if it wasn't changed, like when it couldn't be published
+        """
+        pass
+
+    def list_files(self, suffix: str = '') -> List[str]:
+        """
+        Returns sorted paths of files in the root folder, which names end with 'suffix'
+        """
+        raise NotImplementedError
+
+    def stream_file(self, file_path: str, offset: int = 0, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+        """
+        Yields content of a file by chunks starting from 'offset', raises 'FileNotFoundError' if there is no file
+        """
+        raise NotImplementedError
+
+    def watch(self, on_change: Callable[[], None]) -> bool:
+        """
+        Calls 'on_change' from a background thread when measurements file changes,
+        so it can be read right away instead of waiting for the next poll.
+        Returns False if source can't notify about changes and has to be polled.
+        """
+        return False
+
+    def close(self):
+        pass
@@ -0,0 +1,57 @@
+import logging
+from typing import Dict, Tuple
+
+from iqair2mqtt.models.device import IQAirDevice
+from iqair2mqtt.models.iqair_measurement import IQAirMeasurement
+
+logger = logging.getLogger(__name__)
+
+# characters which can't be used inside of MQTT topic level
+TOPIC_LEVEL_TRANSLATION = str.maketrans({'/': '_', '+': '_', '#': '_'})
+
+
+def availability_topic(prefix: str, device_id: str) -> str:
+    """
+    Retained topic with 'online' or 'offline' state of the device, '<prefix>/availability/<device id>'
+    """
+    return f'{prefix}/availability/{device_id.translate(TOPIC_LEVEL_TRANSLATION)}'
+
+
+class MeasurementTopics:
+    """
+    Topics for per measurement publishing, '<prefix>/<location>/<device>/<type>'
+    where type is '<measurement>_<unit>'. Every topic is built once per device and
+    measurement type and cached, so publishing doesn't build strings.
+    """
+
+    def __init__(self, prefix: str):
+        self._prefix = prefix
+        self._topics: Dict[IQAirDevice, Dict[Tuple[str, str, str], str]] = {}
+
+    def device_prefix(self, device: IQAirDevice) -> str:
+        return '/'.join((
+            self._prefix,
+            device.location.translate(TOPIC_LEVEL_TRANSLATION),
+            device.name.translate(TOPIC_LEVEL_TRANSLATION),
+        ))
+
+    def get(self, device: IQAirDevice, measurement: IQAirMeasurement) -> str:
+        return self.get_by_type(device, measurement.name, measurement.unit)
+
+    def get_by_type(self, device: IQAirDevice, name: str, unit: str, suffix: str = '') -> str:
+        """
+        Returns topic of measurement type, 'suffix' is added as one more topic level
+        """
+        device_topics = self._topics.get(device)
+        if device_topics is None:
+            device_topics = self._topics[device] = {}
+        key = (name, unit, suffix)
+        topic = device_topics.get(key)
+        if topic is None:
+            measurement_type = f'{name}_{unit}'.translate(TOPIC_LEVEL_TRANSLATION)
+            topic = f'{self.device_prefix(device)}/{measurement_type}'
+            if suffix:
+                topic = f'{topic}/{suffix}'
+            device_topics[key] = topic
+            logger.debug("New measurement topic %s", topic)
+        return topic
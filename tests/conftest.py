@@ -0,0 +1,39 @@
+from datetime import datetime
+
+import pytest
+from dateutil.tz import UTC
+
+from iqair2mqtt.models.device import IQAirDevice
+from iqair2mqtt.models.iqair_measurement import IQAirMeasurement, IQAirMeasurements
+
+MEASURED_AT = datetime(2020, 12, 19, tzinfo=UTC)
+
+
+@pytest.fixture
+def device(request):
+    """
+    Generates 'iqair2mqtt.models.device.IQAirDevice'
+    """
+    return IQAirDevice(
+        name="test_device",
+        placement="test_pacement",
+        location="test_location",
+        external=False
+    )
+
+
+@pytest.fixture
+def make_measurements(device):
+    """
+    Factory of 'iqair2mqtt.models.iqair_measurement.IQAirMeasurements' of 'device',
+    values are passed as '<name>_<unit>=<value>'
+    """
+    def make(revision: int, measured_at: datetime = MEASURED_AT, device: IQAirDevice = device,
+             **values) -> IQAirMeasurements:
+        measurements = []
+        for key, value in values.items():
+            name, unit = key.split('_')
+            measurements.append(IQAirMeasurement(measured_at, name, value, unit))
+        return IQAirMeasurements(revision, device, measurements)
+
+    return make
@@ -4,21 +4,8 @@ from random import randint
 from datetime import datetime, timedelta
 
 
-from iqair2mqtt.models.device import IQAirDevice
-from iqair2mqtt.models.iqair_measurement import IQAirMeasurements, IQAirMeasurement
-
-
-@pytest.fixture
-def device(request):
-    """
-    Generates 'iqair2mqtt.models.device.IQAirDevice'
-    """
-    return IQAirDevice(
-        name="test_device",
-        placement="test_pacement",
-        location="test_location",
-        external=False
-    )
+from iqair2mqtt import json_encoder
+from iqair2mqtt.models.iqair_measurement import IQAirMeasurements, IQAirMeasurement, _encode_header
 
 
 @pytest.fixture
@@ -81,3 +68,29 @@ def test_iqair_measurements_comparsions(device, measurements):
 def test_iqair_measurements_error_on_not_int_revision(device, measurements):
     with pytest.raises(TypeError):
         IQAirMeasurements('23', device, measurements)
+
+
+@pytest.mark.parametrize('encoder_name', ['json', 'orjson'])
+@pytest.mark.parametrize('measurements', [3], indirect=['measurements'])
+def test_iqair_measurements_to_json_bytes(device, measurements, encoder_name):
+    if encoder_name == 'orjson':
+        pytest.importorskip('orjson')
+    encoder = json_encoder.get_encoder(encoder_name)
+    iqair_measurements = IQAirMeasurements(23, device, measurements)
+
+    payload = iqair_measurements.to_json_bytes(encoder)
+
+    assert isinstance(payload, bytes)
+    assert json.loads(payload) == json.loads(iqair_measurements.to_json())
+    # device part is encoded once and reused
+    assert iqair_measurements.to_json_bytes(encoder) == payload
+    assert _encode_header.cache_info().hits >= 1
+
+
+def test_get_encoder_falls_back_to_stdlib(monkeypatch):
+    monkeypatch.setattr(json_encoder, 'ORJSON_ENCODER', None)
+
+    assert json_encoder.get_encoder('auto') is json_encoder.STDLIB_ENCODER
+    assert json_encoder.get_encoder('orjson') is json_encoder.STDLIB_ENCODER
+    with pytest.raises(ValueError):
+        json_encoder.get_encoder('yaml')
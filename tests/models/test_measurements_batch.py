@@ -0,0 +1,78 @@
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+from dateutil.tz import UTC
+
+from iqair2mqtt.models.iqair_measurement import IQAirMeasurement, IQAirMeasurements
+from iqair2mqtt.models.measurements_batch import IQAirMeasurementsBatch
+
+
+@pytest.fixture
+def make_sample(make_measurements):
+    return lambda revision, measured_at: make_measurements(
+        revision, measured_at, pm25_ugm3=revision % 50, temperature_c=20.5 + revision / 10, co2_ppm=400 + revision)
+
+
+@pytest.mark.parametrize('start', [datetime(2020, 12, 19, 11, 2, 3, tzinfo=UTC), datetime(2020, 12, 19, 11, 2, 3, 5)])
+def test_batch_iterates_and_serializes_like_samples(start, make_sample, device):
+    samples = [make_sample(1608375600 + i * 15, start + timedelta(seconds=i * 15)) for i in range(100)]
+    batch = IQAirMeasurementsBatch(device, samples)
+
+    assert len(batch) == 100
+    restored = list(batch)
+    assert [sample.to_json() for sample in restored] == [sample.to_json() for sample in samples]
+    assert [sample.measurements for sample in restored] == [sample.measurements for sample in samples]
+    assert batch[-1].revision == samples[-1].revision
+    assert isinstance(batch[0].measurements[0].value, int)
+
+
+def test_batch_empty_sample(make_measurements, device):
+    batch = IQAirMeasurementsBatch(device, [make_measurements(1)])
+
+    assert batch[0].measurements == []
+    with pytest.raises(IndexError):
+        batch[1]
+
+
+def test_batch_empty_first_sample(make_sample, make_measurements, device):
+    """
+    Time zone of the batch is taken from the first sample which has measurements
+    """
+    start = datetime(2020, 12, 19, tzinfo=UTC)
+    samples = [make_measurements(1), make_sample(2, start), make_sample(3, start + timedelta(seconds=15))]
+    batch = IQAirMeasurementsBatch(device, samples)
+
+    assert [sample.to_json() for sample in batch] == [sample.to_json() for sample in samples]
+
+
+def test_batch_rejects_other_device_and_mixed_times(device):
+    batch = IQAirMeasurementsBatch(device)
+    other_device = device._replace(name='other')
+    measured_at = datetime(2020, 12, 19, tzinfo=UTC)
+
+    with pytest.raises(ValueError):
+        batch.append(IQAirMeasurements(1, other_device, []))
+    with pytest.raises(ValueError):
+        batch.append(IQAirMeasurements(1, device, [
+            IQAirMeasurement(measured_at, 'pm25', 1, 'ugm3'),
+            IQAirMeasurement(measured_at + timedelta(seconds=1), 'co2', 400, 'ppm'),
+        ]))
+
+
+def test_batch_is_smaller_than_samples(make_sample, device):
+    start = datetime(2020, 12, 19, tzinfo=UTC)
+    samples = [make_sample(i, start + timedelta(seconds=i * 15)) for i in range(240)]
+    batch = IQAirMeasurementsBatch(device, samples)
+
+    samples_size = sum(
+        sys.getsizeof(sample) + sys.getsizeof(sample.measurements)
+        + sum(sys.getsizeof(measurement) + sys.getsizeof(measurement.measured_at) + sys.getsizeof(measurement.value)
+              for measurement in sample.measurements)
+        for sample in samples
+    )
+    batch_size = sum(
+        sys.getsizeof(getattr(batch, slot))
+        for slot in IQAirMeasurementsBatch.__slots__
+    )
+    assert batch_size * 4 < samples_size
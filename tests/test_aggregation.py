@@ -0,0 +1,70 @@
+import pytest
+
+from iqair2mqtt.aggregation import EMA, DeviceAggregator, WindowStats, format_window, parse_windows
+
+
+def test_parse_windows():
+    assert parse_windows('1h, 1m,300,5m,') == [60, 300, 3600]
+    assert [format_window(window) for window in (45, 60, 300, 3600, 5400)] == ['45s', '1m', '5m', '1h', '90m']
+
+
+@pytest.mark.parametrize('spec', ['1d', 'm', '0', '-5m'])
+def test_parse_wrong_windows(spec):
+    with pytest.raises(ValueError):
+        parse_windows(spec)
+
+
+def test_window_stats_slide():
+    stats = WindowStats(60, buckets=6)
+    for second, value in ((0, 5), (15, 1), (30, 9), (45, 3)):
+        stats.add(second, value)
+
+    assert stats.stats(50) == (4, 1, 9, 4.5)
+    # first bucket [0, 10) is out of window
+    assert stats.stats(65) == (3, 1, 9, 13 / 3)
+    assert stats.stats(95) == (1, 3, 3, 3)
+    assert stats.stats(200) is None
+
+
+def test_window_stats_memory_doesnt_grow():
+    stats = WindowStats(3600)
+    buckets = len(stats._bucket_ids)
+    for second in range(0, 100000, 5):
+        stats.add(second, second)
+
+    assert len(stats._bucket_ids) == len(stats._counts) == buckets
+    count, minimum, maximum, _ = stats.stats(99995)
+    assert maximum == 99995
+    assert 3600 - 3600 / buckets <= 99995 - minimum < 3600
+
+
+def test_ema():
+    ema = EMA(60)
+    assert ema.value is None
+    ema.add(0, 10)
+    assert ema.value == 10
+    ema.add(60, 20)
+    assert ema.value == pytest.approx(10 + 10 * (1 - 1 / 2.718281828))
+
+
+def test_device_aggregator(make_measurements):
+    now = [0.0]
+    aggregator = DeviceAggregator([60, 300], publish_interval=60, clock=lambda: now[0])
+    assert aggregator.is_due()
+    for revision, pm25 in enumerate((10, 20, 30)):
+        now[0] = revision * 20
+        aggregator.add(make_measurements(revision, pm25_ugm3=pm25))
+
+    aggregates = aggregator.collect()
+    # still due until published
+    assert aggregator.is_due()
+    aggregator.mark_published()
+
+    minute, five_minutes = aggregates[('pm25', 'ugm3')]
+    assert (minute.window, minute.count, minute.min, minute.max, minute.mean) == (60, 3, 10, 30, 20)
+    assert five_minutes.window == 300 and five_minutes.count == 3
+    assert 10 < minute.ema < five_minutes.ema or 10 < five_minutes.ema < minute.ema
+    assert not aggregator.is_due()
+    assert aggregator.due_in() == 60
+    now[0] = 120
+    assert aggregator.is_due()
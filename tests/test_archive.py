@@ -0,0 +1,115 @@
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+
+import pytest
+from dateutil.tz import UTC
+from mock import MagicMock
+
+from iqair2mqtt.archive import DeviceArchive, MeasurementArchive, replay
+from iqair2mqtt.models.device import IQAirDevice
+from iqair2mqtt.models.iqair_measurement import IQAirMeasurements
+from iqair2mqtt.mqtt import MQTTPublisher
+
+START = datetime(2020, 12, 19, tzinfo=UTC)
+
+
+@pytest.fixture
+def make_sample(make_measurements, device):
+    """
+    Factory of measurements taken 'minute' minutes after START, revision is the minute
+    """
+    def make(minute: int, sample_device: Optional[IQAirDevice] = None, **values) -> IQAirMeasurements:
+        values = values or {'pm25_ugm3': minute, 'co2_ppm': 400.5 + minute}
+        return make_measurements(minute, START + timedelta(minutes=minute), sample_device or device, **values)
+
+    return make
+
+
+def test_query_range(tmpdir, make_sample):
+    archive = DeviceArchive(str(tmpdir), segment_size=2048, index_interval=4)
+    for minute in range(100):
+        assert archive.append(make_sample(minute))
+    # already archived
+    assert archive.append(make_sample(50)) is False
+
+    result = list(archive.query(START + timedelta(minutes=10), START + timedelta(minutes=60)))
+    assert [m.revision for m in result] == list(range(10, 60))
+    assert result[0].to_json() == make_sample(10).to_json()
+    assert isinstance(result[0].measurements[0].value, int)
+    assert len([name for name in os.listdir(str(tmpdir)) if name.endswith('.seg')]) > 1
+    # naive datetimes are UTC
+    assert len(list(archive.query(datetime(2020, 12, 19, 1), datetime(2020, 12, 20)))) == 40
+
+
+def test_new_segment_on_device_or_measurement_change(tmpdir, make_sample, device):
+    archive = DeviceArchive(str(tmpdir))
+    archive.append(make_sample(0))
+    archive.append(make_sample(1, voc_ppm=3))
+    moved = device._replace(location='other_location')
+    archive.append(make_sample(2, moved))
+
+    result = list(archive.query(START, START + timedelta(hours=1)))
+    assert [m.to_json() for m in result] == [
+        make_sample(0).to_json(),
+        make_sample(1, voc_ppm=3).to_json(),
+        make_sample(2, moved).to_json(),
+    ]
+
+
+def test_survives_restart_and_torn_record(tmpdir, make_sample):
+    archive = DeviceArchive(str(tmpdir))
+    for minute in range(3):
+        archive.append(make_sample(minute))
+    archive.close()
+    segment = [name for name in os.listdir(str(tmpdir)) if name.endswith('.seg')][0]
+    with open(os.path.join(str(tmpdir), segment), 'ab') as segment_fh:
+        segment_fh.write(b'\x03\x10\x00')  # crashed in the middle of a record
+
+    archive = DeviceArchive(str(tmpdir))
+    assert archive.append(make_sample(2)) is False
+    assert archive.append(make_sample(3))
+    assert [m.revision for m in archive.query(START, START + timedelta(hours=1))] == [0, 1, 2, 3]
+
+
+def test_release_between_writers(tmpdir, make_sample):
+    """
+    Device moved between workers, each one reads what the other appended after release
+    """
+    first, second = MeasurementArchive(str(tmpdir)), MeasurementArchive(str(tmpdir))
+    first.append('device', make_sample(0))
+    first.release('device')
+    second.append('device', make_sample(1))
+    second.release('device')
+    first.append('device', make_sample(2))
+    first.release('device')
+
+    result = list(second.query('device', START, START + timedelta(hours=1)))
+    assert [m.revision for m in result] == [0, 1, 2]
+    first.release('not_archived')
+
+
+def test_retention(tmpdir, make_sample):
+    now = (START + timedelta(days=3)).timestamp()
+    archive = MeasurementArchive(str(tmpdir), retention=36 * 3600, segment_duration=3600, clock=lambda: now)
+    for hour in range(72):
+        archive.append('10.0.0.1', make_sample(hour * 60))
+
+    # segments which have only older samples are deleted
+    revisions = [m.revision for m in archive.query('10.0.0.1', START, START + timedelta(days=4))]
+    assert revisions[0] == 36 * 60
+    assert archive.names() == ['10.0.0.1']
+
+
+@pytest.mark.parametrize('batch_size', [1, 100])
+def test_replay(tmpdir, monkeypatch, batch_size, make_sample):
+    archive = MeasurementArchive(str(tmpdir))
+    for minute in range(5):
+        archive.append('10.0.0.1', make_sample(minute))
+    publisher = MagicMock(spec=MQTTPublisher)
+    config = MagicMock(json_encoder='json', backfill_batch_size=batch_size, backfill_batch_interval=0)
+    config.device.return_value.topic = 'iqair2mqtt/other'
+
+    assert replay(archive, publisher, config, START + timedelta(minutes=1), START + timedelta(minutes=3)) == 2
+    assert [call.kwargs['topic'] for call in publisher.publish.call_args_list] == ['iqair2mqtt/other'] * 2
+    assert publisher.publish.call_args_list[0].args[0] == make_sample(1).to_json().encode()
@@ -0,0 +1,101 @@
+import json
+from datetime import datetime
+
+import pytest
+from dateutil.tz import gettz
+from mock import MagicMock
+
+from iqair2mqtt import backfill
+from iqair2mqtt.iqair import IQAir
+from iqair2mqtt.mqtt import MQTTPublisher
+
+HISTORY = (
+    'Date;Time;Timestamp;PM2_5(ug/m3);AQI(US);AQI(CN);PM10(ug/m3);Outdoor AQI(US);Outdoor AQI(CN);'
+    'Temperature(C);Temperature(F);Humidity(%RH);CO2(ppm);VOC(ppb)\r\n'
+    '2020/12/27;15:55:01;1609084501;2.0;8;3;2;-1;-1;20.6;69.0;22;429;-1\r\n'
+    '2020/12/27;16:00:01;1609084801;3.0;12;4;3;-1;-1;20.8;69.4;23;431;-1\r\n'
+    'broken line\r\n'
+    '2020/12/27;16:05:01;1609085101;4.0;16;5;4;-1;-1;21.0;69.8;23;433;-1\r\n'
+).encode()
+
+
+def chunks(data: bytes, size: int):
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1024])
+def test_history_parser(chunk_size, device):
+    parser = backfill.HistoryParser(device, 'America/New_York')
+
+    parsed = [measurements for chunk in chunks(HISTORY, chunk_size) for _, measurements in parser.feed(chunk)]
+
+    assert [measurements.revision for measurements in parsed] == [1609084501, 1609084801, 1609085101]
+    first = parsed[0]
+    assert first.device == device
+    assert [(measurement.name, measurement.value, measurement.unit) for measurement in first.measurements] == [
+        ('pm25', 2.0, 'ugm3'),
+        ('pm25', 8, 'aqius'),
+        ('pm25', 3, 'aqicn'),
+        ('pm10', 2, 'ugm3'),
+        ('temperature', 20.6, 'c'),
+        ('temperature', 69.0, 'f'),
+        ('humidity', 22, 'rh'),
+        ('co2', 429, 'ppm'),
+        ('voc', -1, 'ppb'),
+    ]
+    assert first.measurements[0].measured_at == datetime(2020, 12, 27, 20, 55, 1, tzinfo=gettz('UTC'))
+
+
+def test_history_parser_keeps_not_finished_line(device):
+    parser = backfill.HistoryParser(device, 'UTC')
+    unfinished = HISTORY + b'2020/12/27;16:10:01;16090'
+
+    offsets = [offset for offset, _ in parser.feed(unfinished)]
+
+    assert offsets[-1] == len(HISTORY)
+
+
+@pytest.fixture
+def history_file():
+    # content of history file on the device, can be changed by a test
+    return bytearray(HISTORY)
+
+
+@pytest.fixture
+def iqair(history_file):
+    iqair = MagicMock(spec=IQAir)
+    iqair.get_latest_measurements.return_value = {'settings': {'timezone': 'America/New_York'}}
+    iqair.list_files.return_value = ['/202012_AirVisual_values.txt']
+    iqair.stream_file.side_effect = lambda path, offset: chunks(bytes(history_file[offset:]), 16)
+    return iqair
+
+
+@pytest.fixture
+def history_backfill(monkeypatch, tmp_path, device):
+    parsed = MagicMock()
+    parsed.device = device
+    monkeypatch.setattr(backfill, 'parse_measurements', lambda config, raw: parsed)
+    monkeypatch.setattr(backfill.time, 'sleep', lambda seconds: None)
+    publisher = MagicMock(spec=MQTTPublisher)
+    state = backfill.BackfillState(str(tmp_path / 'state.json'))
+    return backfill.Backfill(
+        MagicMock(json_encoder='auto'), publisher, state, batch_size=2, batch_interval=1), publisher
+
+
+def test_backfill_publishes_only_new_data(history_backfill, iqair, history_file, tmp_path):
+    history, publisher = history_backfill
+
+    assert history.run(iqair, 'test') == 3
+    assert publisher.publish.call_count == 3
+    assert json.loads(publisher.publish.call_args_list[0][0][0])['measurements'][0]['value'] == 2.0
+
+    # device wrote a new line, only it is published on rerun
+    history_file.extend(b'2020/12/27;16:10:01;1609085401;5.0;20;6;5;-1;-1;21.2;70.2;24;435;-1\r\n')
+    state = backfill.BackfillState(str(tmp_path / 'state.json'))
+    rerun = backfill.Backfill(MagicMock(json_encoder='auto'), publisher, state, batch_size=2, batch_interval=1)
+    assert rerun.run(iqair, 'test') == 1
+
+    mark = state.get('test')
+    assert mark.timestamp == 1609085401
+    # rerun continued from the saved offset, instead of streaming the file again
+    assert iqair.stream_file.call_args_list[-1][0] == ('/202012_AirVisual_values.txt', len(HISTORY))
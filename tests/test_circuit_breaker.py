@@ -0,0 +1,72 @@
+import pytest
+
+from iqair2mqtt import errors
+from iqair2mqtt.circuit_breaker import CircuitBreaker, STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_breaker(clock: FakeClock) -> CircuitBreaker:
+    return CircuitBreaker('10.0.0.1', failure_threshold=2, open_timeout=10, max_open_timeout=25, clock=clock)
+
+
+def test_opens_after_failures_in_a_row():
+    breaker = make_breaker(FakeClock())
+    breaker.on_failure('timeout')
+    breaker.on_success()
+    breaker.on_failure('timeout')
+    assert breaker.state == STATE_CLOSED
+    breaker.before_call()
+
+    breaker.on_failure('timeout')
+    assert breaker.state == STATE_OPEN
+    with pytest.raises(errors.IQAirCircuitOpen):
+        breaker.before_call()
+    assert breaker.retry_in() == 10
+
+
+def test_half_open_probe_backs_off_exponentially():
+    clock = FakeClock()
+    breaker = make_breaker(clock)
+    breaker.on_failure('timeout')
+    breaker.on_failure('timeout')
+
+    clock.now = 10
+    breaker.before_call()  # probe
+    assert breaker.state == STATE_HALF_OPEN
+    # only one probe at a time
+    with pytest.raises(errors.IQAirCircuitOpen):
+        breaker.before_call()
+
+    breaker.on_failure('timeout')
+    assert breaker.retry_in() == 20
+    clock.now = 30
+    breaker.before_call()
+    breaker.on_failure('timeout')
+    assert breaker.retry_in() == 25  # capped
+
+    clock.now = 55
+    breaker.before_call()
+    breaker.on_success()
+    assert breaker.state == STATE_CLOSED
+    # timeout is reset after recovery
+    breaker.on_failure('timeout')
+    breaker.on_failure('timeout')
+    assert breaker.retry_in() == 10
+
+
+def test_health():
+    breaker = make_breaker(FakeClock())
+    breaker.on_failure(ConnectionError('refused'))
+    health = breaker.health()
+    assert health['state'] == STATE_CLOSED
+    assert health['consecutive_failures'] == 1
+    assert health['last_error'] == 'refused'
+    assert health['last_success_at'] is None
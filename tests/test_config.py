@@ -0,0 +1,137 @@
+import json
+
+import pytest
+
+from iqair2mqtt import errors
+from iqair2mqtt.config import Config, DeviceConfig
+from iqair2mqtt.config_watcher import ConfigWatcher
+
+ENVIRONMENT = {
+    'IQAIR_IP': '10.0.0.1, 10.0.0.2',
+    'IQAIR_LOGIN': 'iqair_login',
+    'IQAIR_PASSWORD': 'iqair_password',
+    'MQTT_HOSTNAME': 'broker',
+    'MQTT_LOGIN': 'mqtt_login',
+    'MQTT_PASSWORD': 'mqtt_password',
+}
+
+
+@pytest.fixture
+def environment(monkeypatch):
+    for variable in Config.required_variables + list(Config.optional_variables):
+        monkeypatch.delenv(variable, raising=False)
+
+    def set_environment(**variables):
+        for variable, value in variables.items():
+            monkeypatch.setenv(variable, value)
+    return set_environment
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    path = tmp_path / 'config.json'
+
+    def write_config(content):
+        path.write_text(json.dumps(content))
+        return str(path)
+    return write_config
+
+
+def test_config_from_environment(environment):
+    environment(**ENVIRONMENT)
+
+    config = Config(None)
+
+    assert config.devices == [
+        DeviceConfig('10.0.0.1', 'iqair_login', 'iqair_password', 15, 'iqair2mqtt', 'some_location', 'some_placement'),
+        DeviceConfig('10.0.0.2', 'iqair_login', 'iqair_password', 15, 'iqair2mqtt', 'some_location', 'some_placement'),
+    ]
+
+
+def test_config_missing_variable(environment):
+    environment(**{variable: value for variable, value in ENVIRONMENT.items() if variable != 'MQTT_HOSTNAME'})
+
+    with pytest.raises(errors.ConfigVariableMissing):
+        Config(None)
+
+
+def test_config_file_with_devices(environment, config_file):
+    environment(MQTT_LOGIN='env_login', MQTT_PASSWORD='mqtt_password')
+    path = config_file({
+        'settings': {'MQTT_HOSTNAME': 'broker', 'MQTT_LOGIN': 'file_login', 'IQAIR_LOGIN': 'default_login',
+                     'IQAIR_PASSWORD': 'default_password', 'LOCATION': 'home', 'UPDATE_INTERVAL': 30},
+        'devices': [
+            {'ip': '10.0.0.1', 'placement': 'kitchen'},
+            {'ip': '10.0.0.2', 'login': 'own', 'password': 'secret', 'interval': '60', 'topic': 'garden',
+             'location': 'outside'},
+        ],
+    })
+
+    config = Config(path)
+
+    # environment wins over file
+    assert config.mqtt_login == 'env_login'
+    assert config.mqtt_hostname == 'broker'
+    assert config.devices == [
+        DeviceConfig('10.0.0.1', 'default_login', 'default_password', 30, 'iqair2mqtt', 'home', 'kitchen'),
+        DeviceConfig('10.0.0.2', 'own', 'secret', 60, 'garden', 'outside', 'some_placement'),
+    ]
+    assert config.device('10.0.0.2').get_topic == 'garden'
+    assert config.device('10.0.0.3').location == 'home'
+
+
+def test_config_file_with_local_directory_device(environment, config_file):
+    environment(MQTT_HOSTNAME='broker', MQTT_LOGIN='login', MQTT_PASSWORD='password')
+
+    config = Config(config_file({'devices': [{'ip': 'living_room', 'directory': '/mnt/airvisual'}]}))
+
+    # credentials aren't needed to read a directory
+    assert config.devices[0].directory == '/mnt/airvisual'
+    assert config.devices[0].login == ''
+
+
+@pytest.mark.parametrize('variables', [
+    {'MQTT_PORT': 'mqtt'},
+    {'POLL_WORKERS': '1.5'},
+    {'IQAIR_CONCURRENCY': '0'},
+    {'UPDATE_INTERVAL': ''},
+    {'METRICS_PORT': 'metrics'},
+])
+def test_config_numeric_variable_wrong(environment, variables):
+    environment(**ENVIRONMENT, **variables)
+
+    with pytest.raises(errors.ConfigVariableWrong):
+        Config(None)
+
+
+@pytest.mark.parametrize('content, error', [
+    ({'devices': [{'ip': '10.0.0.1'}]}, errors.ConfigVariableMissing),
+    ({'devices': [{'ip': '10.0.0.1', 'login': 'l', 'password': 'p', 'interval': [15]}]}, errors.ConfigFileWrong),
+    ({'devices': [{'ip': '10.0.0.1', 'login': 'l', 'password': 'p', 'interval': 0}]}, errors.ConfigFileWrong),
+    ({'devices': [{'ip': '10.0.0.1', 'login': 'l', 'password': 'p', 'color': 'red'}]}, errors.ConfigFileWrong),
+    ({'devices': [{'login': 'l', 'password': 'p'}]}, errors.ConfigFileWrong),
+    ({'devices': [{'ip': '10.0.0.1', 'login': 'l', 'password': 'p'}] * 2}, errors.ConfigFileWrong),
+    ({'devices': {'ip': '10.0.0.1'}}, errors.ConfigFileWrong),
+    ([], errors.ConfigFileWrong),
+])
+def test_config_file_wrong(environment, config_file, content, error):
+    environment(MQTT_HOSTNAME='broker', MQTT_LOGIN='login', MQTT_PASSWORD='password')
+
+    with pytest.raises(error):
+        Config(config_file(content))
+
+
+def test_config_watcher_applies_only_valid_changes(environment, config_file):
+    environment(MQTT_HOSTNAME='broker', MQTT_LOGIN='login', MQTT_PASSWORD='password')
+    device = {'ip': '10.0.0.1', 'login': 'l', 'password': 'p'}
+    path = config_file({'devices': [device]})
+    applied = []
+    watcher = ConfigWatcher(path, applied.append, interval=60)
+
+    assert watcher.check() is False
+    config_file({'devices': [device, {**device, 'ip': '10.0.0.2'}]})
+    assert watcher.check() is True
+    config_file({'devices': [{'ip': '10.0.0.3'}]})
+    assert watcher.check() is False
+
+    assert [[device.ip for device in config.devices] for config in applied] == [['10.0.0.1', '10.0.0.2']]
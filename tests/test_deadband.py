@@ -0,0 +1,52 @@
+import pytest
+
+from iqair2mqtt.deadband import Deadband, DeadbandFilter, parse_deadbands
+
+
+def test_parse_deadbands():
+    assert parse_deadbands('*=1%, pm25=2,temperature_c=0.2,') == {
+        '*': Deadband(relative=0.01),
+        'pm25': Deadband(absolute=2),
+        'temperature_c': Deadband(absolute=0.2),
+    }
+
+
+@pytest.mark.parametrize('spec', ['pm25', 'pm25=', '=1', 'pm25=a', 'pm25=-1'])
+def test_parse_wrong_deadbands(spec):
+    with pytest.raises(ValueError):
+        parse_deadbands(spec)
+
+
+def test_filter_publishes_only_changes_over_deadband(make_measurements):
+    now = [0.0]
+    deadband_filter = DeadbandFilter(parse_deadbands('*=10%,pm25=2'), heartbeat=60, clock=lambda: now[0])
+
+    def publish(revision, **values):
+        measurements = deadband_filter.filter(make_measurements(revision, **values))
+        if measurements is not None:
+            deadband_filter.mark_published(measurements)
+            return {measurement.name: measurement.value for measurement in measurements.measurements}
+
+    assert publish(1, pm25_ugm3=10, co2_ppm=400) == {'pm25': 10, 'co2': 400}
+    assert publish(2, pm25_ugm3=11, co2_ppm=430) is None
+    # compared with the last published value, so slow drift is published
+    assert publish(3, pm25_ugm3=12.5, co2_ppm=441) == {'pm25': 12.5, 'co2': 441}
+    now[0] = 30
+    assert publish(4, pm25_ugm3=12, co2_ppm=441) is None
+    now[0] = 61
+    assert publish(5, pm25_ugm3=12, co2_ppm=441) == {'pm25': 12, 'co2': 441}
+
+
+def test_filter_without_deadband_publishes_any_change(make_measurements):
+    deadband_filter = DeadbandFilter({}, heartbeat=60, clock=lambda: 0)
+    deadband_filter.mark_published(make_measurements(1, humidity_rh=40))
+
+    assert deadband_filter.filter(make_measurements(2, humidity_rh=40)) is None
+    assert deadband_filter.filter(make_measurements(3, humidity_rh=41)) is not None
+
+
+def test_filter_not_marked_measurements_are_published_again(make_measurements):
+    deadband_filter = DeadbandFilter({}, heartbeat=60, clock=lambda: 0)
+
+    assert deadband_filter.filter(make_measurements(1, humidity_rh=40)) is not None
+    assert deadband_filter.filter(make_measurements(1, humidity_rh=40)) is not None
@@ -0,0 +1,89 @@
+import json
+
+import pytest
+from mock import MagicMock
+
+from iqair2mqtt.discovery import AnnouncedState, HomeAssistantDiscovery
+from iqair2mqtt.errors import MQTTBrokerNotConnected
+from iqair2mqtt.json_encoder import STDLIB_ENCODER
+from iqair2mqtt.models.device import IQAirDevice
+from iqair2mqtt.mqtt import MQTTPublisher
+
+
+@pytest.fixture
+def device():
+    return IQAirDevice(name='living room', placement='Living Room', location='home', external=False)
+
+
+@pytest.fixture
+def state_file(tmp_path):
+    return str(tmp_path / 'discovery.json')
+
+
+def make_discovery(publisher, state_file, per_measurement=True) -> HomeAssistantDiscovery:
+    return HomeAssistantDiscovery(
+        publisher, STDLIB_ENCODER, 'homeassistant', 'iqair2mqtt', per_measurement, AnnouncedState(state_file))
+
+
+def test_announce_once_per_measurement_type(state_file, make_measurements):
+    publisher = MagicMock(spec=MQTTPublisher)
+    discovery = make_discovery(publisher, state_file)
+
+    assert discovery.announce(make_measurements(1, pm25_ugm3=1, co2_ppm=1)) == 2
+    assert discovery.announce(make_measurements(1, pm25_ugm3=1, co2_ppm=1)) == 0
+    assert discovery.announce(make_measurements(1, pm25_ugm3=1, humidity_rh=1)) == 1
+    # restart doesn't announce again
+    assert make_discovery(publisher, state_file).announce(make_measurements(1, co2_ppm=1)) == 0
+
+    topics = [call.kwargs['topic'] for call in publisher.publish.call_args_list]
+    assert topics == [
+        'homeassistant/sensor/iqair2mqtt_home_living_room/pm25_ugm3/config',
+        'homeassistant/sensor/iqair2mqtt_home_living_room/co2_ppm/config',
+        'homeassistant/sensor/iqair2mqtt_home_living_room/humidity_rh/config',
+    ]
+    assert all(call.kwargs['retain'] for call in publisher.publish.call_args_list)
+    config = json.loads(publisher.publish.call_args_list[0].args[0])
+    assert config['state_topic'] == 'iqair2mqtt/home/living room/pm25_ugm3'
+    assert config['device_class'] == 'pm25'
+    assert config['unit_of_measurement'] == 'µg/m³'
+    assert config['unique_id'] == 'iqair2mqtt_home_living_room_pm25_ugm3'
+    assert config['device']['identifiers'] == ['iqair2mqtt_home_living_room']
+
+
+def test_announce_json_mode_uses_value_template(state_file, make_measurements):
+    publisher = MagicMock(spec=MQTTPublisher)
+    make_discovery(publisher, state_file, per_measurement=False).announce(make_measurements(1, voc_ppb=1))
+
+    config = json.loads(publisher.publish.call_args.args[0])
+    assert config['state_topic'] == 'iqair2mqtt'
+    assert 'm.type == "voc" and m.unit == "ppb"' in config['value_template']
+    assert 'availability_topic' not in config
+
+
+def test_value_template_escapes_quotes(state_file, make_measurements, device):
+    publisher = MagicMock(spec=MQTTPublisher)
+    kids_room = device._replace(name='Kid\'s "blue" room')
+    discovery = make_discovery(publisher, state_file, per_measurement=False)
+    discovery.announce(make_measurements(1, device=kids_room, co2_ppm=1))
+
+    config = json.loads(publisher.publish.call_args.args[0])
+    assert '{% if value_json.device_name == "Kid\'s \\"blue\\" room" %}' in config['value_template']
+
+
+def test_announce_with_availability_topic(state_file, make_measurements):
+    publisher = MagicMock(spec=MQTTPublisher)
+    make_discovery(publisher, state_file).announce(
+        make_measurements(1, co2_ppm=1), 'iqair2mqtt', 'iqair2mqtt/availability/10.0.0.1')
+
+    config = json.loads(publisher.publish.call_args.args[0])
+    assert config['availability_topic'] == 'iqair2mqtt/availability/10.0.0.1'
+
+
+def test_announce_retried_if_not_published(state_file, make_measurements):
+    publisher = MagicMock(spec=MQTTPublisher)
+    publisher.publish.side_effect = [MQTTBrokerNotConnected(), None]
+    discovery = make_discovery(publisher, state_file)
+
+    with pytest.raises(MQTTBrokerNotConnected):
+        discovery.announce(make_measurements(1, co2_ppm=1))
+    assert discovery.announce(make_measurements(1, co2_ppm=1)) == 1
@@ -0,0 +1,189 @@
+import os
+import signal
+import threading
+import time
+
+from mock import MagicMock
+
+from iqair2mqtt import errors
+from iqair2mqtt.config import DeviceConfig
+from iqair2mqtt.fleet import FleetPoller, sync_pollers
+from iqair2mqtt.poller import DevicePoller
+
+
+def make_poller(name, poll, interval=0.05):
+    poller = MagicMock(spec=DevicePoller)
+    poller.name = name
+    poller.poll.side_effect = poll
+    poller.next_poll_delay.return_value = interval
+    poller.aggregates_delay.return_value = None
+    return poller
+
+
+def run_for(fleet_poller: FleetPoller, seconds: float):
+    timer = threading.Timer(seconds, fleet_poller.stop)
+    timer.start()
+    fleet_poller.run()
+    timer.cancel()
+
+
+def test_slow_device_does_not_delay_others():
+    """
+    One hanging device must not stop polls of other devices
+    """
+    stop_slow = threading.Event()
+    slow_poller = make_poller('slow', lambda: stop_slow.wait(5))
+    fast_poller = make_poller('fast', lambda: True)
+
+    fleet_poller = FleetPoller([slow_poller, fast_poller], concurrency=2)
+    threading.Timer(0.5, stop_slow.set).start()
+    run_for(fleet_poller, 0.4)
+
+    assert slow_poller.poll.call_count == 1
+    assert fast_poller.poll.call_count >= 5
+
+
+def test_errors_do_not_stop_polling():
+    """
+    Expected and unexpected errors of one device are logged, polling continues
+    """
+    def connection_error():
+        raise errors.IQAirConnectionError('ip')
+
+    def unexpected_error():
+        raise RuntimeError('test error')
+
+    failing_poller = make_poller('failing', connection_error)
+    broken_poller = make_poller('broken', unexpected_error)
+
+    fleet_poller = FleetPoller([failing_poller, broken_poller], concurrency=1)
+    run_for(fleet_poller, 0.3)
+
+    assert failing_poller.poll.call_count >= 3
+    assert broken_poller.poll.call_count >= 3
+    failing_poller.close.assert_called_once_with()
+    broken_poller.close.assert_called_once_with()
+
+
+def test_device_polled_once_per_interval():
+    poller = make_poller('device', lambda: True, interval=10)
+    fleet_poller = FleetPoller([poller], concurrency=1)
+    run_for(fleet_poller, 0.2)
+
+    assert poller.poll.call_count == 1
+
+
+def test_stop_without_running_polls():
+    started_at = time.monotonic()
+    fleet_poller = FleetPoller([], concurrency=1)
+    run_for(fleet_poller, 0.1)
+
+    assert time.monotonic() - started_at < 1
+
+
+def test_stop_on_sigterm():
+    """
+    SIGTERM lets the running poll finish, then polling stops and pollers are closed
+    """
+    poll_finished = threading.Event()
+
+    def poll():
+        time.sleep(0.2)
+        poll_finished.set()
+
+    poller = make_poller('device', poll, interval=10)
+    fleet_poller = FleetPoller([poller], concurrency=1)
+    threading.Timer(0.1, os.kill, (os.getpid(), signal.SIGTERM)).start()
+    started_at = time.monotonic()
+    fleet_poller.run()
+
+    assert poll_finished.is_set()
+    assert time.monotonic() - started_at < 1
+    poller.close.assert_called_once_with()
+
+
+def test_abandoned_poll_closed_after_it_finishes():
+    """
+    Poll which misses shutdown timeout keeps running in its thread, its source is closed only after it
+    """
+    finish_poll = threading.Event()
+    poll_finished = threading.Event()
+    closed = threading.Event()
+
+    def poll():
+        finish_poll.wait(5)
+        poll_finished.set()
+
+    def close():
+        assert poll_finished.is_set()
+        closed.set()
+
+    poller = make_poller('device', poll, interval=10)
+    poller.close.side_effect = close
+    fleet_poller = FleetPoller([poller], concurrency=1, shutdown_timeout=0.1)
+    run_for(fleet_poller, 0.1)
+
+    assert not closed.is_set()
+    finish_poll.set()
+    assert closed.wait(5)
+    poller.close.assert_called_once_with()
+
+
+def test_pollers_added_and_removed_while_running():
+    fleet_poller = FleetPoller([make_poller('kept', lambda: True), make_poller('removed', lambda: True)], concurrency=2)
+    added_poller = make_poller('added', lambda: True)
+    removed_poller = fleet_poller.pollers['removed']
+    threading.Timer(0.1, fleet_poller.remove_poller, ('removed',)).start()
+    threading.Timer(0.1, fleet_poller.add_poller, (added_poller,)).start()
+    run_for(fleet_poller, 0.3)
+
+    removed_poller.close.assert_called_once_with()
+    assert added_poller.poll.call_count >= 2
+    added_poller.close.assert_called_once_with()
+
+
+def test_sync_pollers():
+    fleet_poller = MagicMock(spec=FleetPoller)
+    device = DeviceConfig('10.0.0.1', 'login', 'password', 15, 'topic', 'location', 'placement')
+    old_devices = [device, device._replace(ip='10.0.0.2'), device._replace(ip='10.0.0.3')]
+    new_devices = [device, device._replace(ip='10.0.0.2', interval=60), device._replace(ip='10.0.0.4')]
+
+    sync_pollers(fleet_poller, old_devices, new_devices, lambda device_config: device_config.ip)
+
+    fleet_poller.remove_poller.assert_called_once_with('10.0.0.3')
+    assert [call.args[0] for call in fleet_poller.add_poller.call_args_list] == ['10.0.0.2', '10.0.0.4']
+
+
+def test_watched_device_polled_on_change():
+    """
+    Device which notifies about new measurements is polled right away, not after poll delay
+    """
+    polled = []
+    watched_poller = make_poller('watched', lambda: polled.append(time.monotonic()), interval=60)
+    callbacks = []
+    watched_poller.watch.side_effect = lambda on_change: callbacks.append(on_change) or True
+
+    fleet_poller = FleetPoller([watched_poller], concurrency=1)
+    threading.Timer(0.2, lambda: callbacks[0]()).start()
+    run_for(fleet_poller, 0.5)
+
+    # the first poll and the one after change
+    assert len(polled) == 2
+
+
+def test_aggregates_published_while_device_is_silent():
+    """
+    Aggregates are published on own schedule between polls, failed publish is tried again after the next poll
+    """
+    silent_poller = make_poller('silent', lambda: False, interval=60)
+    silent_poller.aggregates_delay.return_value = 0.05
+    failing_poller = make_poller('failing', lambda: False, interval=60)
+    failing_poller.aggregates_delay.return_value = 0
+    failing_poller.publish_aggregates.side_effect = errors.MQTTBrokerNotConnected()
+
+    fleet_poller = FleetPoller([silent_poller, failing_poller], concurrency=2)
+    run_for(fleet_poller, 0.4)
+
+    assert silent_poller.poll.call_count == 1
+    assert silent_poller.publish_aggregates.call_count >= 4
+    assert failing_poller.publish_aggregates.call_count == 1
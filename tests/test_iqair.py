@@ -1,10 +1,30 @@
+import errno
+import json
 import pytest
 from socket import timeout
 from mock import MagicMock, call
 
-from smb.smb_structs import OperationFailure
+from smb.base import SMBTimeout
+from smb.smb2_structs import SMB2Message
+from smb.smb_structs import OperationFailure, SMBMessage
 
 from iqair2mqtt import iqair, errors
+from iqair2mqtt.circuit_breaker import CircuitBreaker, STATE_CLOSED, STATE_OPEN
+
+STATUS_ACCESS_DENIED = 0xC0000022
+STATUS_OBJECT_NAME_NOT_FOUND = 0xC0000034
+
+
+def smb1_message(status: int) -> SMBMessage:
+    message = SMBMessage()
+    message.status.internal_value = status
+    return message
+
+
+def smb2_message(status: int) -> SMB2Message:
+    message = SMB2Message()
+    message.status = status
+    return message
 
 
 class TestIqAir:
@@ -130,3 +150,295 @@ class TestIqAir:
 
         with pytest.raises(errors.IQAirMeasurementsFileNotFoundOrWrong):
             iqair_instance.get_latest_measurements()
+
+    def test_session_reused_between_fetches(self, monkeypatch):
+        """
+        Test that SMB session is opened once and reused for next fetches
+        """
+        smb_connection = MagicMock(spec='smb.SMBConnection.SMBConnection')
+        monkeypatch.setattr(iqair, 'SMBConnection', smb_connection)
+
+        def mock_retrieve_file(_, __, temp_fh):
+            temp_fh.write(b'{}')
+            return (None, 2)
+
+        smb_connection.return_value.retrieveFile.side_effect = mock_retrieve_file
+        iqair_instance = iqair.IQAir(self.test_ip, self.test_login, self.test_password)
+
+        for _ in range(3):
+            iqair_instance.get_latest_measurements()
+
+        assert smb_connection.return_value.connect.call_count == 1
+        assert smb_connection.return_value.close.call_count == 0
+        assert iqair_instance.session_reuses == 2
+        assert iqair_instance.session_reconnects == 0
+
+    def test_session_reconnect_when_dropped(self, monkeypatch):
+        """
+        Test that dead session is detected by echo and new session is opened
+        """
+        smb_connection = MagicMock(spec='smb.SMBConnection.SMBConnection')
+        monkeypatch.setattr(iqair, 'SMBConnection', smb_connection)
+
+        def mock_retrieve_file(_, __, temp_fh):
+            temp_fh.write(b'{}')
+            return (None, 2)
+
+        smb_connection.return_value.retrieveFile.side_effect = mock_retrieve_file
+        smb_connection.return_value.echo.side_effect = ConnectionResetError("test error")
+        iqair_instance = iqair.IQAir(self.test_ip, self.test_login, self.test_password)
+
+        iqair_instance.get_latest_measurements()
+        iqair_instance.get_latest_measurements()
+
+        assert smb_connection.return_value.connect.call_count == 2
+        assert iqair_instance.session_reuses == 0
+        assert iqair_instance.session_reconnects == 1
+
+    def test_session_retry_when_dropped_during_fetch(self, monkeypatch):
+        """
+        Test that fetch is retried on a new session if IQAir drops session in the middle of it
+        """
+        smb_connection = MagicMock(spec='smb.SMBConnection.SMBConnection')
+        monkeypatch.setattr(iqair, 'SMBConnection', smb_connection)
+
+        calls = 0
+
+        def mock_retrieve_file(_, __, temp_fh):
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                temp_fh.write(b'{"broken": ')
+                raise iqair.NotConnectedError("test error")
+            temp_fh.write(b'{"test_key": "test_value"}')
+            return (None, 26)
+
+        smb_connection.return_value.retrieveFile.side_effect = mock_retrieve_file
+        iqair_instance = iqair.IQAir(self.test_ip, self.test_login, self.test_password)
+
+        assert iqair_instance.get_latest_measurements() == {"test_key": "test_value"}
+        assert iqair_instance.session_reconnects == 1
+
+    def test_no_session_keeping(self, monkeypatch):
+        """
+        Test that with disabled session keeping every fetch opens and closes connection
+        """
+        smb_connection = MagicMock(spec='smb.SMBConnection.SMBConnection')
+        monkeypatch.setattr(iqair, 'SMBConnection', smb_connection)
+
+        def mock_retrieve_file(_, __, temp_fh):
+            temp_fh.write(b'{}')
+            return (None, 2)
+
+        smb_connection.return_value.retrieveFile.side_effect = mock_retrieve_file
+        iqair_instance = iqair.IQAir(self.test_ip, self.test_login, self.test_password, keep_session=False)
+
+        iqair_instance.get_latest_measurements()
+        iqair_instance.get_latest_measurements()
+
+        assert smb_connection.return_value.connect.call_count == 2
+        assert smb_connection.return_value.close.call_count == 2
+
+    @pytest.mark.parametrize('in_memory', [True, False])
+    def test_get_last_measurements_bigger_than_buffer(self, monkeypatch, in_memory):
+        """
+        Test that file bigger than preallocated buffer is read completely,
+        and buffer is reused for next fetch
+        """
+        smb_connection = MagicMock(spec='smb.SMBConnection.SMBConnection')
+        monkeypatch.setattr(iqair, 'SMBConnection', smb_connection)
+        content = {"test_key": "x" * iqair.FILE_BUFFER_SIZE * 2}
+
+        def mock_retrieve_file(_, __, temp_fh):
+            raw = json.dumps(content).encode()
+            for chunk_start in range(0, len(raw), 4096):
+                temp_fh.write(raw[chunk_start:chunk_start + 4096])
+            return (None, len(raw))
+
+        smb_connection.return_value.retrieveFile.side_effect = mock_retrieve_file
+        iqair_instance = iqair.IQAir(self.test_ip, self.test_login, self.test_password, in_memory=in_memory)
+
+        assert iqair_instance.get_latest_measurements() == content
+        content = {"test_key": "test_value"}
+        assert iqair_instance.get_latest_measurements() == content
+
+    def test_get_changed_measurements_skips_unchanged_file(self, monkeypatch):
+        """
+        Test that file is downloaded only when its last write time or size changes
+        """
+        smb_connection = MagicMock(spec='smb.SMBConnection.SMBConnection')
+        monkeypatch.setattr(iqair, 'SMBConnection', smb_connection)
+
+        def mock_retrieve_file(_, __, temp_fh):
+            temp_fh.write(b'{"test_key": "test_value"}')
+            return (None, 26)
+
+        smb_connection.return_value.retrieveFile.side_effect = mock_retrieve_file
+        attributes = smb_connection.return_value.getAttributes.return_value
+        attributes.last_write_time = 1609084501.0
+        attributes.file_size = 26
+        iqair_instance = iqair.IQAir(self.test_ip, self.test_login, self.test_password)
+
+        assert iqair_instance.get_changed_measurements() == {"test_key": "test_value"}
+        assert iqair_instance.get_changed_measurements() is None
+        attributes.last_write_time = 1609084516.0
+        assert iqair_instance.get_changed_measurements() == {"test_key": "test_value"}
+        iqair_instance.forget_version()
+        assert iqair_instance.get_changed_measurements() == {"test_key": "test_value"}
+
+        assert smb_connection.return_value.getAttributes.call_args_list[0] \
+            == call('airvisual', '/latest_config_measurements.json')
+        assert smb_connection.return_value.retrieveFile.call_count == 3
+        assert iqair_instance.fetches_skipped == 1
+
+    @pytest.mark.parametrize('message, smb_message', [
+        (
+            "Failed to get attributes for /latest_config_measurements.json on airvisual: "
+            "Unable to open remote file object",
+            smb2_message(STATUS_OBJECT_NAME_NOT_FOUND),
+        ),
+        (
+            "Failed to get attributes for /latest_config_measurements.json on airvisual: Read failed",
+            smb1_message(STATUS_OBJECT_NAME_NOT_FOUND),
+        ),
+    ], ids=['smb2', 'smb1'])
+    def test_get_changed_measurements_no_file_found(self, monkeypatch, message, smb_message):
+        smb_connection = MagicMock(spec='smb.SMBConnection.SMBConnection')
+        monkeypatch.setattr(iqair, 'SMBConnection', smb_connection)
+
+        smb_connection.return_value.getAttributes.side_effect = OperationFailure(message, [smb_message])
+
+        iqair_instance = iqair.IQAir(self.test_ip, self.test_login, self.test_password)
+
+        with pytest.raises(errors.IQAirMeasurementsFileNotFoundOrWrong):
+            iqair_instance.get_changed_measurements()
+
+    @pytest.mark.parametrize('smb_message', [
+        smb2_message(STATUS_ACCESS_DENIED),
+        smb1_message(STATUS_ACCESS_DENIED),
+    ], ids=['smb2', 'smb1'])
+    def test_get_changed_measurements_access_denied(self, monkeypatch, smb_message):
+        """
+        Test that only missing file is reported as missing, other failures are raised as they are
+        """
+        smb_connection = MagicMock(spec='smb.SMBConnection.SMBConnection')
+        monkeypatch.setattr(iqair, 'SMBConnection', smb_connection)
+
+        smb_connection.return_value.getAttributes.side_effect = OperationFailure(
+            "Failed to get attributes for /latest_config_measurements.json on airvisual: "
+            "Unable to open remote file object",
+            [smb_message],
+        )
+
+        iqair_instance = iqair.IQAir(self.test_ip, self.test_login, self.test_password)
+
+        with pytest.raises(OperationFailure):
+            iqair_instance.get_changed_measurements()
+
+    def test_stream_file(self, monkeypatch):
+        """
+        Test that file is streamed by chunks, starting from offset
+        """
+        smb_connection = MagicMock(spec='smb.SMBConnection.SMBConnection')
+        monkeypatch.setattr(iqair, 'SMBConnection', smb_connection)
+        content = b'0123456789' * 3
+
+        def mock_retrieve_file_from_offset(share, file_path, file_obj, offset, max_length):
+            assert (share, file_path) == ('airvisual', '/history.txt')
+            data = content[offset:offset + max_length]
+            file_obj.write(data)
+            return (None, len(data))
+
+        smb_connection.return_value.retrieveFileFromOffset.side_effect = mock_retrieve_file_from_offset
+        iqair_instance = iqair.IQAir(self.test_ip, self.test_login, self.test_password)
+
+        assert list(iqair_instance.stream_file('/history.txt', offset=5, chunk_size=10)) \
+            == [b'5678901234', b'5678901234', b'56789']
+        assert len(list(iqair_instance.stream_file('/history.txt', chunk_size=10))) == 3
+        # session is checked before every file, not before every chunk
+        assert smb_connection.return_value.echo.call_count == 1
+
+    def test_circuit_breaker_stops_connections(self, monkeypatch):
+        """
+        After device is offline few times in a row, connections aren't tried until breaker timeout
+        """
+        smb_connection = MagicMock(spec='smb.SMBConnection.SMBConnection')
+        monkeypatch.setattr(iqair, 'SMBConnection', smb_connection)
+        smb_connection.return_value.connect.side_effect = ConnectionError("test error")
+        breaker = CircuitBreaker(self.test_ip, failure_threshold=2, open_timeout=60)
+        iqair_instance = iqair.IQAir(self.test_ip, self.test_login, self.test_password, breaker=breaker)
+
+        for _ in range(2):
+            with pytest.raises(errors.IQAirConnectionError):
+                iqair_instance.noop()
+        with pytest.raises(errors.IQAirCircuitOpen):
+            iqair_instance.noop()
+
+        assert smb_connection.return_value.connect.call_count == 2 * iqair.CONNECTION_ATTEMPTS
+        assert breaker.health()['last_error'] == 'test error'
+
+    def test_circuit_breaker_counts_unreachable_host(self, monkeypatch):
+        """
+        Errors other than 'ConnectionError', like no route to host, trip the breaker too
+        """
+        smb_connection = MagicMock(spec='smb.SMBConnection.SMBConnection')
+        monkeypatch.setattr(iqair, 'SMBConnection', smb_connection)
+        smb_connection.return_value.connect.side_effect = OSError(errno.EHOSTUNREACH, "No route to host")
+        breaker = CircuitBreaker(self.test_ip, failure_threshold=2, open_timeout=60)
+        iqair_instance = iqair.IQAir(self.test_ip, self.test_login, self.test_password, breaker=breaker)
+
+        for _ in range(2):
+            with pytest.raises(errors.IQAirConnectionError):
+                iqair_instance.noop()
+        with pytest.raises(errors.IQAirCircuitOpen):
+            iqair_instance.noop()
+
+        assert breaker.state == STATE_OPEN
+
+    @pytest.mark.parametrize('probe_error, raised', [
+        (SMBTimeout(), errors.IQAirConnectionError),
+        (RuntimeError("unexpected"), RuntimeError),
+    ])
+    def test_circuit_breaker_failed_probe_opens_breaker(self, monkeypatch, probe_error, raised):
+        """
+        Any failure of half open probe opens the breaker again, and device is probed again later
+        """
+        smb_connection = MagicMock(spec='smb.SMBConnection.SMBConnection')
+        monkeypatch.setattr(iqair, 'SMBConnection', smb_connection)
+        now = [0.0]
+        breaker = CircuitBreaker(self.test_ip, failure_threshold=1, open_timeout=10, clock=lambda: now[0])
+        iqair_instance = iqair.IQAir(
+            self.test_ip, self.test_login, self.test_password, keep_session=False, breaker=breaker)
+
+        smb_connection.return_value.connect.side_effect = ConnectionError("offline")
+        with pytest.raises(errors.IQAirConnectionError):
+            iqair_instance.noop()
+
+        now[0] = 11
+        smb_connection.return_value.connect.side_effect = probe_error
+        with pytest.raises(raised):
+            iqair_instance.noop()
+        assert breaker.state == STATE_OPEN
+
+        # device is back
+        now[0] = 40
+        smb_connection.return_value.connect.side_effect = None
+        smb_connection.return_value.connect.return_value = True
+        iqair_instance.noop()
+        assert breaker.state == STATE_CLOSED
+
+    def test_connection_factory(self, monkeypatch):
+        """
+        Connections are created by the passed factory instead of SMBConnection
+        """
+        smb_connection = MagicMock(spec='smb.SMBConnection.SMBConnection')
+        monkeypatch.setattr(iqair, 'SMBConnection', smb_connection)
+        connection_factory = MagicMock()
+        iqair_instance = iqair.IQAir(
+            self.test_ip, self.test_login, self.test_password, connection_factory=connection_factory)
+
+        iqair_instance.noop()
+
+        assert connection_factory.call_args_list == [
+            call(self.test_login, self.test_password, "iqair2mqtt", "airvisual")]
+        smb_connection.assert_not_called()
@@ -5,6 +5,7 @@ from dateutil.tz import gettz
 
 from iqair2mqtt import iqair_parser
 from iqair2mqtt.config import Config
+from iqair2mqtt.errors import IQAirDataCorrupted
 from iqair2mqtt.models.iqair_measurement import IQAirMeasurements, IQAirMeasurement, IQAirDevice
 
 
@@ -123,3 +124,58 @@ def test_parser(iqair_data, config, monkeypatch):
 
     assert parsed_data == measurements.return_value
     assert measurements.call_args_list == [call(1609084501, expected_device_info, expected_measurements)]
+
+
+@pytest.mark.parametrize('timezone, expected_hour', [
+    ('America/New_York', 20),
+    ('Europe/Berlin', 14),
+    ('UTC', 15),
+    ('Not/Existing', 15),
+])
+def test_convert_to_utc_datetime(timezone, expected_hour):
+    expected_datetime = datetime(2020, 12, 27, expected_hour, 55, 1, tzinfo=gettz('UTC'))
+
+    from_timestamp = iqair_parser.convert_to_utc_datetime('2020/12/27', '15:55:01', timezone, 1609084501)
+    from_date_and_time = iqair_parser.convert_to_utc_datetime('2020/12/27', '15:55:01', timezone)
+
+    assert from_timestamp == expected_datetime
+    assert from_date_and_time == expected_datetime
+
+
+def test_parser_uses_device_timezone(iqair_data, config, monkeypatch):
+    measurements = MagicMock(spec=IQAirMeasurements, return_value='test')
+    monkeypatch.setattr(iqair_parser, 'IQAirMeasurements', measurements)
+    iqair_data['settings']['timezone'] = 'Europe/Berlin'
+
+    iqair_parser.parse_measurements(config, iqair_data)
+
+    parsed_measurements = measurements.call_args[0][2]
+    assert parsed_measurements[0].measured_at == datetime(2020, 12, 27, 14, 55, 1, tzinfo=gettz('UTC'))
+
+
+def test_parser_wrong_date(iqair_data, config):
+    iqair_data['date_and_time']['timestamp'] = 'not_a_timestamp'
+
+    with pytest.raises(IQAirDataCorrupted):
+        iqair_parser.parse_measurements(config, iqair_data)
+
+
+def test_parser_skips_wrong_measurements(iqair_data, config):
+    iqair_data['measurements'][0] = {
+        'co2_ppm': '429', 'pm25': '1', 'pm25_ug_m3': '1', 'pm25_ugm3': 'n/a', 'voc_ppb': None,
+    }
+
+    parsed = iqair_parser.parse_measurements(config, iqair_data)
+
+    assert [(m.name, m.value, m.unit) for m in parsed.measurements] == [('co2', 429, 'ppm')]
+
+
+def test_parser_caches_key_table(iqair_data, config):
+    iqair_parser._get_key_table.cache_clear()
+
+    iqair_parser.parse_measurements(config, iqair_data)
+    iqair_data['measurements'][0]['co2_ppm'] = '500'
+    parsed = iqair_parser.parse_measurements(config, iqair_data)
+
+    assert iqair_parser._get_key_table.cache_info().hits == 1
+    assert parsed.measurements[0].value == 500
@@ -0,0 +1,75 @@
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from iqair2mqtt.json_encoder import STDLIB_ENCODER
+from iqair2mqtt.latest_api import LatestMeasurementsCache, start_http_server
+
+
+@pytest.fixture
+def api():
+    cache = LatestMeasurementsCache(STDLIB_ENCODER)
+    server = start_http_server(cache, 0, '127.0.0.1')
+    yield cache, f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def request(url: str, etag: str = None):
+    http_request = urllib.request.Request(url, headers={'If-None-Match': etag} if etag else {})
+    try:
+        with urllib.request.urlopen(http_request) as response:
+            return response.status, response.headers.get('ETag'), response.read()
+    except urllib.error.HTTPError as exc:
+        return exc.code, exc.headers.get('ETag'), b''
+
+
+def test_latest_measurements_of_device(api, make_measurements):
+    cache, url = api
+    assert request(url + '/measurements/10.0.0.1')[0] == 404
+
+    cache.update('10.0.0.1', make_measurements(1, co2_ppm=400))
+    status, etag, body = request(url + '/measurements/10.0.0.1')
+    assert status == 200
+    assert json.loads(body)['measurements'][0]['value'] == 400
+
+    # not changed, client can use what it has
+    assert request(url + '/measurements/10.0.0.1', etag)[:2] == (304, etag)
+    assert request(url + '/measurements/10.0.0.1', f'"other", W/{etag}')[0] == 304
+
+    cache.update('10.0.0.1', make_measurements(2, co2_ppm=410))
+    status, new_etag, body = request(url + '/measurements/10.0.0.1', etag)
+    assert status == 200 and new_etag != etag
+    assert json.loads(body)['measurements'][0]['value'] == 410
+
+
+def test_latest_measurements_of_all_devices(api, make_measurements):
+    cache, url = api
+    cache.update('10.0.0.1', make_measurements(1, co2_ppm=400))
+    cache.update('10.0.0.2', make_measurements(1, co2_ppm=500))
+
+    status, etag, body = request(url + '/measurements')
+    assert status == 200
+    assert {name: document['measurements'][0]['value'] for name, document in json.loads(body).items()} == {
+        '10.0.0.1': 400, '10.0.0.2': 500}
+    assert request(url + '/measurements/', etag)[0] == 304
+
+    cache.remove('10.0.0.2')
+    status, _, body = request(url + '/measurements', etag)
+    assert status == 200
+    assert list(json.loads(body)) == ['10.0.0.1']
+    assert request(url + '/other')[0] == 404
+
+
+def test_health(api):
+    cache, url = api
+    cache.set_health('10.0.0.1', {'state': 'open', 'available': False})
+    cache.set_health('10.0.0.2', {'state': 'closed', 'available': True})
+    cache.remove('10.0.0.2')
+
+    status, etag, body = request(url + '/health')
+    assert status == 200
+    assert etag is None
+    assert json.loads(body) == {'10.0.0.1': {'state': 'open', 'available': False}}
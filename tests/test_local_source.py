@@ -0,0 +1,75 @@
+import json
+import os
+import threading
+
+import pytest
+
+from iqair2mqtt import errors, inotify
+from iqair2mqtt.local_source import LocalDirectorySource
+
+
+def write_measurements(directory, timestamp: int):
+    # like sync tools do, write to a temporary file and move it in place
+    path = os.path.join(str(directory), 'latest_config_measurements.json')
+    with open(path + '.tmp', 'w') as measurements_fh:
+        json.dump({'date_and_time': {'timestamp': str(timestamp)}}, measurements_fh)
+    os.replace(path + '.tmp', path)
+
+
+def test_get_changed_measurements(tmpdir):
+    source = LocalDirectorySource(str(tmpdir), 'local')
+    source.noop()
+    with pytest.raises(errors.IQAirMeasurementsFileNotFoundOrWrong):
+        source.get_changed_measurements()
+
+    write_measurements(tmpdir, 1)
+    assert source.get_changed_measurements()['date_and_time']['timestamp'] == '1'
+    assert source.get_changed_measurements() is None
+    assert source.fetches_skipped == 1
+    source.forget_version()
+    assert source.get_changed_measurements()['date_and_time']['timestamp'] == '1'
+
+    write_measurements(tmpdir, 20)
+    assert source.get_changed_measurements()['date_and_time']['timestamp'] == '20'
+
+
+def test_noop_fails_without_directory(tmpdir):
+    with pytest.raises(errors.IQAirConnectionError):
+        LocalDirectorySource(os.path.join(str(tmpdir), 'missing'), 'local').noop()
+
+
+def test_list_and_stream_files(tmpdir):
+    tmpdir.join('2020_12_history.txt').write('header\nline 1\n')
+    tmpdir.join('2020_11_history.txt').write('header\n')
+    tmpdir.mkdir('sub_history.txt')
+    source = LocalDirectorySource(str(tmpdir), 'local')
+
+    assert source.list_files('_history.txt') == ['/2020_11_history.txt', '/2020_12_history.txt']
+    assert list(source.stream_file('/2020_12_history.txt', offset=7, chunk_size=4)) == [b'line', b' 1\n']
+    with pytest.raises(FileNotFoundError):
+        list(source.stream_file('/missing.txt'))
+
+
+@pytest.mark.skipif(not inotify.is_available(), reason="inotify isn't available")
+def test_watch_notifies_about_new_measurements(tmpdir):
+    source = LocalDirectorySource(str(tmpdir), 'local')
+    changed = threading.Event()
+    assert source.watch(changed.set)
+
+    tmpdir.join('other.txt').write('not measurements')
+    assert not changed.wait(0.2)
+    write_measurements(tmpdir, 1)
+    assert changed.wait(2)
+
+    source.close()
+    changed.clear()
+    write_measurements(tmpdir, 2)
+    assert not changed.wait(0.2)
+
+
+def test_watch_unavailable(tmpdir, monkeypatch):
+    def no_inotify():
+        raise OSError("inotify isn't available on this system")
+
+    monkeypatch.setattr(inotify, '_get_libc', no_inotify)
+    assert LocalDirectorySource(str(tmpdir), 'local').watch(lambda: None) is False
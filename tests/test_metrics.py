@@ -0,0 +1,68 @@
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import pytest
+
+from iqair2mqtt import metrics
+
+
+@pytest.fixture
+def registry():
+    return metrics.Registry()
+
+
+def test_counter_render(registry):
+    counter = registry.counter('test_total', "Test counter", ['device'])
+    counter.labels('first').inc()
+    counter.labels('first').inc(2)
+    counter.labels('sec"ond').inc()
+
+    assert registry.render() == (
+        '# HELP test_total Test counter\n'
+        '# TYPE test_total counter\n'
+        'test_total{device="first"} 3.0\n'
+        'test_total{device="sec\\"ond"} 1.0\n'
+    )
+
+
+def test_histogram_render(registry):
+    histogram = registry.histogram('test_seconds', "Test histogram", buckets=[0.1, 1])
+    value = histogram.labels()
+    value.observe(0.05)
+    value.observe(0.1)
+    value.observe(0.5)
+    value.observe(5)
+
+    assert registry.render() == (
+        '# HELP test_seconds Test histogram\n'
+        '# TYPE test_seconds histogram\n'
+        'test_seconds_bucket{le="0.1"} 2\n'
+        'test_seconds_bucket{le="1"} 3\n'
+        'test_seconds_bucket{le="+Inf"} 4\n'
+        'test_seconds_sum 5.65\n'
+        'test_seconds_count 4\n'
+    )
+
+
+def test_wrong_labels(registry):
+    counter = registry.counter('test_total', "Test counter", ['device'])
+
+    with pytest.raises(ValueError):
+        counter.labels()
+    with pytest.raises(ValueError):
+        registry.counter('test_total', "Test counter")
+
+
+def test_http_server(registry):
+    registry.counter('test_total', "Test counter").labels().inc()
+    server = metrics.start_http_server(0, '127.0.0.1', registry)
+    try:
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+        with urlopen(f'{url}/metrics') as response:
+            assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+            assert b'test_total 1.0' in response.read()
+        with pytest.raises(HTTPError):
+            urlopen(f'{url}/other')
+    finally:
+        server.shutdown()
+        server.server_close()
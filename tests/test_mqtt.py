@@ -0,0 +1,128 @@
+import json
+import threading
+import time
+
+import pytest
+from mock import MagicMock
+
+from iqair2mqtt import mqtt, errors
+from iqair2mqtt.aggregation import Aggregate
+from iqair2mqtt.json_encoder import STDLIB_ENCODER
+from iqair2mqtt.models.device import IQAirDevice
+from iqair2mqtt.models.iqair_measurement import IQAirMeasurements, IQAirMeasurement
+from iqair2mqtt.mqtt_queue import DiskQueue
+
+
+@pytest.fixture
+def mqtt_client(monkeypatch):
+    client = MagicMock()
+    monkeypatch.setattr(mqtt.mqtt, 'Client', MagicMock(return_value=client))
+    client.publish.return_value.rc = mqtt.mqtt.MQTT_ERR_SUCCESS
+    return client
+
+
+def test_publish_not_connected_without_queue(mqtt_client):
+    publisher = mqtt.MQTTPublisher('host', 'login', 'password', 'topic')
+
+    with pytest.raises(errors.MQTTBrokerNotConnected):
+        publisher.publish('data')
+
+
+def test_publish_connected(mqtt_client):
+    publisher = mqtt.MQTTPublisher('host', 'login', 'password', 'topic')
+    publisher._on_connect_callback(mqtt_client, None, {}, 0)
+
+    publisher.publish('data')
+
+    mqtt_client.publish.assert_called_once_with(topic='topic', payload='data', qos=2, retain=False)
+
+
+def test_publish_per_measurement(mqtt_client):
+    publisher = mqtt.MQTTPublisher('host', 'login', 'password', 'iqair2mqtt')
+    publisher._on_connect_callback(mqtt_client, None, {}, 0)
+    device = IQAirDevice(name='living/room', placement='test_placement', location='home', external=False)
+    measurements = IQAirMeasurements(1, device, [
+        IQAirMeasurement(measured_at=None, name='pm25', value=8, unit='aqius'),
+        IQAirMeasurement(measured_at=None, name='temperature', value=20.6, unit='c'),
+    ])
+
+    publisher.publish_per_measurement(measurements)
+    publisher.publish_per_measurement(measurements)
+
+    calls = [(call.kwargs['topic'], call.kwargs['payload'], call.kwargs['retain'])
+             for call in mqtt_client.publish.call_args_list]
+    assert calls == [
+        ('iqair2mqtt/home/living_room/pm25_aqius', '8', True),
+        ('iqair2mqtt/home/living_room/temperature_c', '20.6', True),
+    ] * 2
+    # topics are built once and reused
+    assert calls[0][0] is calls[2][0]
+
+
+def test_queued_messages_replayed_after_reconnect(mqtt_client, tmp_path):
+    queue = DiskQueue(str(tmp_path), max_bytes=1024 * 1024, max_age=60, fsync=False)
+    publisher = mqtt.MQTTPublisher('host', 'login', 'password', 'topic', queue=queue, replay_window=2)
+    replayed = threading.Event()
+    published = []
+
+    def mock_publish(topic, payload, qos, retain=False):
+        published.append(payload)
+        if len(published) == 5:
+            replayed.set()
+        return MagicMock(rc=mqtt.mqtt.MQTT_ERR_SUCCESS)
+
+    mqtt_client.publish.side_effect = mock_publish
+    publisher.connect()
+    for i in range(5):
+        publisher.publish('data %d' % i)
+    assert published == []
+
+    publisher._on_connect_callback(mqtt_client, None, {}, 0)
+
+    assert replayed.wait(5)
+    assert published == [b'data %d' % i for i in range(5)]
+    for _ in range(50):
+        if len(queue) == 0:
+            break
+        time.sleep(0.01)
+    assert len(queue) == 0
+
+
+def test_publish_aggregates(mqtt_client):
+    publisher = mqtt.MQTTPublisher('host', 'login', 'password', 'iqair2mqtt')
+    publisher._on_connect_callback(mqtt_client, None, {}, 0)
+    device = IQAirDevice(name='living_room', placement='test_placement', location='home', external=False)
+    aggregates = {('pm25', 'ugm3'): [Aggregate(60, 4, 1, 9, 4.5, 4.0), Aggregate(3600, 4, 1, 9, 4.5, 5.0)]}
+
+    publisher.publish_aggregates(device, aggregates, STDLIB_ENCODER)
+
+    calls = [(call.kwargs['topic'], json.loads(call.kwargs['payload']), call.kwargs['retain'])
+             for call in mqtt_client.publish.call_args_list]
+    assert calls == [
+        ('iqair2mqtt/home/living_room/pm25_ugm3/1m',
+         {'window': 60, 'count': 4, 'min': 1, 'max': 9, 'mean': 4.5, 'ema': 4.0}, True),
+        ('iqair2mqtt/home/living_room/pm25_ugm3/1h',
+         {'window': 3600, 'count': 4, 'min': 1, 'max': 9, 'mean': 4.5, 'ema': 5.0}, True),
+    ]
+
+
+def test_close_stores_not_acknowledged_messages_in_queue(mqtt_client, tmp_path):
+    queue = DiskQueue(str(tmp_path), max_bytes=1024 * 1024, max_age=60, fsync=False)
+    publisher = mqtt.MQTTPublisher('host', 'login', 'password', 'topic', queue=queue)
+    publisher._on_connect_callback(mqtt_client, None, {}, 0)
+    acknowledged = MagicMock(rc=mqtt.mqtt.MQTT_ERR_SUCCESS)
+    acknowledged.is_published.return_value = True
+    not_acknowledged = MagicMock(rc=mqtt.mqtt.MQTT_ERR_SUCCESS)
+    not_acknowledged.is_published.return_value = False
+    mqtt_client.publish.side_effect = [acknowledged, not_acknowledged]
+
+    publisher.publish(b'acknowledged')
+    publisher.publish(b'in flight', topic='other', retain=True)
+    publisher.close(timeout=0.1)
+
+    not_acknowledged.wait_for_publish.assert_called_once()
+    mqtt_client.disconnect.assert_called_once_with()
+    mqtt_client.loop_stop.assert_called_once_with()
+    assert [(message.topic, message.payload, message.retain) for _, message in queue.read(10)] == [
+        ('other', b'in flight', True),
+    ]
@@ -0,0 +1,87 @@
+import os
+import time
+
+import pytest
+
+from iqair2mqtt.mqtt_queue import DiskQueue, QueuedMessage
+
+
+def message(payload: bytes, queued_at: float = None) -> QueuedMessage:
+    return QueuedMessage(
+        queued_at=time.time() if queued_at is None else queued_at,
+        topic='iqair2mqtt',
+        payload=payload,
+        qos=2,
+        retain=False,
+    )
+
+
+@pytest.fixture
+def queue_dir(tmp_path):
+    return str(tmp_path / 'queue')
+
+
+def test_read_and_ack(queue_dir):
+    queue = DiskQueue(queue_dir, max_bytes=1024 * 1024, max_age=60, fsync=False)
+    for i in range(5):
+        queue.append(message(b'payload %d' % i))
+
+    batch = queue.read(3)
+    assert [queued.payload for _, queued in batch] == [b'payload 0', b'payload 1', b'payload 2']
+    # not acknowledged messages are read again
+    assert queue.read(3) == batch
+
+    queue.ack(batch[-1][0])
+    assert [queued.payload for _, queued in queue.read(10)] == [b'payload 3', b'payload 4']
+    queue.ack(queue.read(10)[-1][0])
+    assert queue.read(10) == []
+    assert len(queue) == 0
+
+
+def test_durable_across_restarts(queue_dir):
+    queue = DiskQueue(queue_dir, max_bytes=1024 * 1024, max_age=60, segment_size=64, fsync=False)
+    for i in range(10):
+        queue.append(message(b'payload %d' % i))
+    queue.ack(queue.read(4)[-1][0])
+    queue.close()
+
+    queue = DiskQueue(queue_dir, max_bytes=1024 * 1024, max_age=60, segment_size=64, fsync=False)
+    assert [queued.payload for _, queued in queue.read(10)] == [b'payload %d' % i for i in range(4, 10)]
+
+
+def test_torn_record_is_dropped(queue_dir):
+    queue = DiskQueue(queue_dir, max_bytes=1024 * 1024, max_age=60, fsync=False)
+    queue.append(message(b'complete'))
+    queue.append(message(b'torn'))
+    queue.close()
+    segment = os.path.join(queue_dir, sorted(name for name in os.listdir(queue_dir) if name.endswith('.seg'))[-1])
+    os.truncate(segment, os.path.getsize(segment) - 3)
+
+    queue = DiskQueue(queue_dir, max_bytes=1024 * 1024, max_age=60, fsync=False)
+    queue.append(message(b'after restart'))
+    assert [queued.payload for _, queued in queue.read(10)] == [b'complete', b'after restart']
+
+
+def test_oldest_segments_dropped_when_full(queue_dir):
+    queue = DiskQueue(queue_dir, max_bytes=400, max_age=60, segment_size=100, fsync=False)
+    for i in range(20):
+        queue.append(message(b'payload %02d' % i))
+
+    payloads = [queued.payload for _, queued in queue.read(100)]
+    assert payloads[-1] == b'payload 19'
+    assert b'payload 00' not in payloads
+    assert queue.dropped > 0
+    assert len(os.listdir(queue_dir)) <= 6
+
+
+def test_expired_messages_skipped(queue_dir):
+    queue = DiskQueue(queue_dir, max_bytes=1024 * 1024, max_age=60, fsync=False)
+    queue.append(message(b'expired', queued_at=time.time() - 120))
+    queue.append(message(b'fresh'))
+
+    assert [queued.payload for _, queued in queue.read(10)] == [b'fresh']
+
+    queue.ack(queue.read(10)[-1][0])
+    queue.append(message(b'expired', queued_at=time.time() - 120))
+    assert queue.read(10) == []
+    assert len(queue) == 0
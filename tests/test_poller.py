@@ -0,0 +1,195 @@
+from datetime import datetime
+
+import pytest
+from dateutil.tz import UTC
+from mock import MagicMock
+
+from iqair2mqtt import errors, poller
+from iqair2mqtt.archive import MeasurementArchive
+from iqair2mqtt.circuit_breaker import CircuitBreaker
+from iqair2mqtt.config import DeviceConfig
+from iqair2mqtt.deadband import parse_deadbands
+from iqair2mqtt.iqair import IQAir
+from iqair2mqtt.latest_api import LatestMeasurementsCache
+from iqair2mqtt.local_source import LocalDirectorySource
+from iqair2mqtt.models.iqair_measurement import IQAirMeasurement, IQAirMeasurements
+from iqair2mqtt.mqtt import MQTTPublisher
+
+
+def make_config(**kwargs) -> MagicMock:
+    settings = dict(
+        mqtt_publish_mode='json', json_encoder='auto', deadbands=None, deadband_heartbeat=300,
+        aggregation_windows=[], aggregation_publish_interval=60,
+    )
+    settings.update(kwargs)
+    return MagicMock(**settings)
+
+
+def test_poll_publishes_only_new_measurements(monkeypatch, device):
+    iqair = MagicMock(spec=IQAir)
+    publisher = MagicMock(spec=MQTTPublisher)
+    revisions = iter([1, 1, 2])
+    monkeypatch.setattr(
+        poller,
+        'parse_measurements',
+        lambda config, raw: IQAirMeasurements(next(revisions), device, [])
+    )
+    device_poller = poller.DevicePoller(make_config(), iqair, publisher, 'test')
+
+    assert device_poller.poll() is True
+    assert device_poller.poll() is False
+    assert device_poller.poll() is True
+    assert publisher.publish.call_count == 2
+    assert device_poller.last_measurements.revision == 2
+
+
+def test_poll_republishes_unchanged_file_after_failed_publish(monkeypatch, tmpdir, device):
+    tmpdir.join('latest_config_measurements.json').write('{}')
+    publisher = MagicMock(spec=MQTTPublisher)
+    publisher.publish.side_effect = [errors.MQTTBrokerNotConnected(), None]
+    monkeypatch.setattr(poller, 'parse_measurements', lambda config, raw: IQAirMeasurements(1, device, []))
+    device_poller = poller.DevicePoller(make_config(), LocalDirectorySource(str(tmpdir), 'test'), publisher, 'test')
+
+    with pytest.raises(errors.MQTTBrokerNotConnected):
+        device_poller.poll()
+    # broker is back, the same file is published
+    assert device_poller.poll() is True
+    assert device_poller.poll() is False
+    assert publisher.publish.call_count == 2
+    assert device_poller.last_measurements.revision == 1
+
+
+@pytest.mark.parametrize('publish_mode, json_published, per_measurement_published', [
+    ('json', True, False),
+    ('per_measurement', False, True),
+    ('both', True, True),
+])
+def test_poll_publish_modes(monkeypatch, publish_mode, json_published, per_measurement_published, device):
+    publisher = MagicMock(spec=MQTTPublisher)
+    monkeypatch.setattr(poller, 'parse_measurements', lambda config, raw: IQAirMeasurements(1, device, []))
+    device_poller = poller.DevicePoller(
+        make_config(mqtt_publish_mode=publish_mode), MagicMock(spec=IQAir), publisher, 'test')
+
+    device_poller.poll()
+
+    assert publisher.publish.called == json_published
+    assert publisher.publish_per_measurement.called == per_measurement_published
+
+
+def test_poll_publishes_only_changed_measurements(monkeypatch, device):
+    publisher = MagicMock(spec=MQTTPublisher)
+    measured_at = datetime(2020, 12, 19, tzinfo=UTC)
+    samples = iter([
+        IQAirMeasurements(1, device, [IQAirMeasurement(measured_at, 'pm25', 10, 'ugm3'),
+                                      IQAirMeasurement(measured_at, 'co2', 400, 'ppm')]),
+        IQAirMeasurements(2, device, [IQAirMeasurement(measured_at, 'pm25', 11, 'ugm3'),
+                                      IQAirMeasurement(measured_at, 'co2', 400, 'ppm')]),
+        IQAirMeasurements(3, device, [IQAirMeasurement(measured_at, 'pm25', 14, 'ugm3'),
+                                      IQAirMeasurement(measured_at, 'co2', 401, 'ppm')]),
+    ])
+    monkeypatch.setattr(poller, 'parse_measurements', lambda config, raw: next(samples))
+    config = make_config(mqtt_publish_mode='per_measurement', deadbands=parse_deadbands('pm25=2'))
+    device_poller = poller.DevicePoller(config, MagicMock(spec=IQAir), publisher, 'test')
+
+    assert device_poller.poll() is True
+    assert device_poller.poll() is False
+    assert device_poller.last_measurements.revision == 2
+    assert device_poller.poll() is True
+
+    published = [call.args[0].measurements for call in publisher.publish_per_measurement.call_args_list]
+    assert [[(m.name, m.value) for m in measurements] for measurements in published] == [
+        [('pm25', 10), ('co2', 400)],
+        [('pm25', 14), ('co2', 401)],
+    ]
+
+
+def test_publish_aggregates(monkeypatch, device):
+    publisher = MagicMock(spec=MQTTPublisher)
+    measured_at = datetime(2020, 12, 19, tzinfo=UTC)
+    revisions = iter([1, 2])
+    monkeypatch.setattr(
+        poller,
+        'parse_measurements',
+        lambda config, raw: IQAirMeasurements(
+            next(revisions), device, [IQAirMeasurement(measured_at, 'co2', 400, 'ppm')])
+    )
+    config = make_config(aggregation_windows=[60, 300], aggregation_publish_interval=3600)
+    device_poller = poller.DevicePoller(config, MagicMock(spec=IQAir), publisher, 'test')
+    assert device_poller.aggregates_delay() is None  # nothing to aggregate yet
+
+    device_poller.poll()
+    publisher.publish_aggregates.assert_not_called()
+    assert device_poller.aggregates_delay() == 0
+
+    # failed publish is tried again
+    publisher.publish_aggregates.side_effect = errors.MQTTBrokerNotConnected()
+    with pytest.raises(errors.MQTTBrokerNotConnected):
+        device_poller.publish_aggregates()
+    assert device_poller.aggregates_delay() == 0
+    publisher.publish_aggregates.side_effect = None
+    assert device_poller.publish_aggregates() is True
+
+    # the next time only after publish interval
+    device_poller.poll()
+    assert device_poller.publish_aggregates() is False
+    assert device_poller.aggregates_delay() > 3500
+    published_device, aggregates, _ = publisher.publish_aggregates.call_args.args
+    assert published_device == device
+    assert [aggregate.window for aggregate in aggregates[('co2', 'ppm')]] == [60, 300]
+
+
+def test_poll_updates_latest_cache(monkeypatch, device):
+    monkeypatch.setattr(poller, 'parse_measurements', lambda config, raw: IQAirMeasurements(1, device, []))
+    latest_cache = MagicMock(spec=LatestMeasurementsCache)
+    device_poller = poller.DevicePoller(
+        make_config(), MagicMock(spec=IQAir), MagicMock(spec=MQTTPublisher), 'test', latest_cache=latest_cache)
+
+    device_poller.poll()
+    device_poller.poll()
+
+    latest_cache.update.assert_called_once()
+    assert latest_cache.update.call_args.args[0] == 'test'
+
+
+def test_poll_publishes_availability_on_change(monkeypatch, device):
+    monkeypatch.setattr(poller, 'parse_measurements', lambda config, raw: IQAirMeasurements(1, device, []))
+    iqair = MagicMock(spec=IQAir)
+    publisher = MagicMock(spec=MQTTPublisher)
+    breaker = CircuitBreaker('test', failure_threshold=1, open_timeout=60)
+    device_config = DeviceConfig('test', 'login', 'password', 15, 'iqair2mqtt', 'location', 'placement')
+    device_poller = poller.DevicePoller(
+        make_config(), iqair, publisher, 'test', device_config=device_config, breaker=breaker)
+
+    def fail_connection():
+        breaker.on_failure('timeout')
+        raise errors.IQAirConnectionError('test')
+
+    iqair.get_changed_measurements.side_effect = fail_connection
+    with pytest.raises(errors.IQAirConnectionError):
+        device_poller.poll()
+    assert device_poller.next_poll_delay() > 59  # no polls until the breaker lets a probe through
+
+    iqair.get_changed_measurements.side_effect = None
+    breaker.on_success()
+    device_poller.poll()
+    device_poller.poll()
+
+    availability = [
+        (call.args[0], call.kwargs['retain']) for call in publisher.publish.call_args_list
+        if call.kwargs.get('topic') == device_poller.availability_topic
+    ]
+    assert device_poller.availability_topic == 'iqair2mqtt/availability/test'
+    assert availability == [('offline', True), ('online', True)]
+
+
+def test_poll_archives_measurements(monkeypatch, device):
+    monkeypatch.setattr(poller, 'parse_measurements', lambda config, raw: IQAirMeasurements(1, device, []))
+    archive = MagicMock(spec=MeasurementArchive)
+    device_poller = poller.DevicePoller(
+        make_config(), MagicMock(spec=IQAir), MagicMock(spec=MQTTPublisher), 'test', archive=archive)
+
+    device_poller.poll()
+    device_poller.poll()
+
+    archive.append.assert_called_once()
+    assert archive.append.call_args.args[0] == 'test'
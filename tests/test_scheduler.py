@@ -0,0 +1,65 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from iqair2mqtt.scheduler import PollScheduler
+
+# device 'timestamp' is local time, measured at is UTC, here device is in UTC
+START = 1609084500
+
+
+@pytest.fixture
+def measurements(make_measurements):
+    return lambda revision: make_measurements(revision, datetime.fromtimestamp(revision, tz=timezone.utc), co2_ppm=400)
+
+
+@pytest.fixture
+def scheduler():
+    return PollScheduler(interval=15, min_interval=2, max_backoff=120, margin=1, jitter=lambda: 1.0)
+
+
+def test_default_interval_until_learned(scheduler, measurements):
+    assert scheduler.next_delay(START) == 15
+    scheduler.on_success(measurements(START))
+    assert scheduler.device_interval is None
+    assert scheduler.next_delay(START + 5) == 15
+
+
+def test_poll_right_after_expected_update(scheduler, measurements):
+    for revision in range(START, START + 3 * 60, 60):
+        scheduler.on_success(measurements(revision))
+        scheduler.on_success(None)
+
+    assert scheduler.device_interval == 60
+    # last update was at START + 120, next one is expected at START + 180
+    assert scheduler.next_delay(START + 125) == 56
+    # device is late, check soon
+    assert scheduler.next_delay(START + 185) == 2
+    # device is very late, fall back to default interval
+    assert scheduler.next_delay(START + 240) == 15
+
+
+def test_missed_update_does_not_break_interval(scheduler, measurements):
+    for revision in (START, START + 60, START + 180, START + 240, START + 300):
+        scheduler.on_success(measurements(revision))
+
+    assert scheduler.device_interval == 60
+
+
+def test_backoff_on_errors(scheduler):
+    delays = []
+    for _ in range(6):
+        scheduler.on_error()
+        delays.append(scheduler.next_delay(START))
+
+    assert delays == [15, 30, 60, 120, 120, 120]
+
+    scheduler.on_success(None)
+    assert scheduler.next_delay(START) == 15
+
+
+def test_backoff_is_jittered():
+    scheduler = PollScheduler(interval=16, jitter=lambda: 0.0)
+    scheduler.on_error()
+
+    assert scheduler.next_delay(START) == 8
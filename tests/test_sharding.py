@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+from mock import MagicMock
+
+from iqair2mqtt.archive import MeasurementArchive
+from iqair2mqtt.config import DeviceConfig
+from iqair2mqtt.mqtt import MQTTPublisher
+from iqair2mqtt.sharding import RESULT_PUBLISH, ShardedPoller, ShardPublisher, plan_assignment
+
+CONFIG = SimpleNamespace(
+    get_topic='iqair2mqtt',
+    iqair_concurrency=2,
+    mqtt_publish_mode='json',
+    json_encoder='auto',
+    deadbands=None,
+    deadband_heartbeat=300,
+    aggregation_windows=[],
+    aggregation_publish_interval=60,
+    archive_dir='',
+    archive_retention=60,
+    ha_discovery_prefix='',
+    ha_discovery_state_file='',
+)
+
+
+def write_measurements(directory: str, node_name: str, timestamp: int):
+    measurements = {
+        'date_and_time': {'date': '2020/12/27', 'time': '15:55:01', 'timestamp': str(timestamp)},
+        'measurements': [{'co2_ppm': '429', 'pm25_ugm3': '2.0'}],
+        'settings': {'node_name': node_name, 'is_indoor': True, 'timezone': 'UTC'},
+    }
+    path = os.path.join(directory, 'latest_config_measurements.json')
+    with open(path + '.tmp', 'w') as measurements_fh:
+        json.dump(measurements, measurements_fh)
+    os.replace(path + '.tmp', path)
+
+
+def wait_for(condition, timeout: float = 20) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_shard_publisher_sends_batches():
+    connection = MagicMock()
+    publisher = ShardPublisher('iqair2mqtt', connection)
+
+    publisher.flush()
+    connection.send.assert_not_called()
+
+    publisher.publish(b'{}', topic='iqair2mqtt/device')
+    publisher.publish('online', topic='iqair2mqtt/availability/device', retain=True)
+    publisher.publish(b'{}')
+    publisher.flush()
+    publisher.flush()
+
+    connection.send.assert_called_once_with((RESULT_PUBLISH, [
+        ('iqair2mqtt/device', b'{}', False),
+        ('iqair2mqtt/availability/device', 'online', True),
+        (None, b'{}', False),
+    ]))
+
+
+def test_plan_assignment_prefers_least_busy_workers():
+    assert plan_assignment(['a', 'b', 'c', 'd'], {0: 0, 1: 0}) == {'a': 0, 'b': 1, 'c': 0, 'd': 1}
+    assert plan_assignment(['a', 'b', 'c'], {0: 5, 2: 1}) == {'a': 2, 'b': 2, 'c': 2}
+    assert plan_assignment(['a'], {}) == {}
+
+
+def test_dead_worker_devices_handed_over(tmpdir):
+    """
+    Devices are polled in workers, when one dies its devices go to the other one and it's restarted
+    """
+    devices = []
+    for index in range(4):
+        directory = tmpdir.mkdir(f'device{index}')
+        write_measurements(str(directory), f'device{index}', 1)
+        devices.append(DeviceConfig(f'device{index}', '', '', 60, f'iqair2mqtt/device{index}', 'home', 'room',
+                                    directory=str(directory)))
+    publisher = MagicMock(spec=MQTTPublisher)
+
+    def published_topics():
+        return {call.kwargs['topic'] for call in publisher.publish.call_args_list}
+
+    config = SimpleNamespace(**dict(vars(CONFIG), archive_dir=str(tmpdir.mkdir('archive'))))
+    sharded_poller = ShardedPoller(config, devices, publisher, workers=2, shutdown_timeout=5, restart_delay=0.5)
+    thread = threading.Thread(target=sharded_poller.run)
+    thread.start()
+    try:
+        assert wait_for(lambda: published_topics() == {device.topic for device in devices})
+        assignments = sharded_poller.assignments
+        assert sorted(assignments.values()) == [0, 0, 1, 1]
+
+        dead_pid = sharded_poller.worker_pids[0]
+        os.kill(dead_pid, 9)
+        assert wait_for(lambda: set(sharded_poller.assignments.values()) == {1})
+        assert wait_for(lambda: sharded_poller.worker_pids[0] not in (None, dead_pid))
+
+        # device of the dead worker is polled by the other one
+        moved = next(device for device in devices if assignments[device.ip] == 0)
+        publisher.reset_mock()
+        write_measurements(moved.directory, moved.ip, 2)
+        assert wait_for(lambda: moved.topic in published_topics())
+
+        # restarted worker takes new devices
+        directory = tmpdir.mkdir('device4')
+        write_measurements(str(directory), 'device4', 1)
+        added = DeviceConfig('device4', '', '', 60, 'iqair2mqtt/device4', 'home', 'room', directory=str(directory))
+        sharded_poller.sync_devices(devices[1:] + [added])
+        assert sharded_poller.assignments[added.ip] == 0
+        assert devices[0].ip not in sharded_poller.assignments
+        assert wait_for(lambda: added.topic in published_topics())
+
+        # removed device comes back after its worker closed its archive
+        write_measurements(devices[0].directory, devices[0].ip, 3)
+        sharded_poller.sync_devices(devices + [added])
+        assert wait_for(lambda: devices[0].topic in published_topics())
+    finally:
+        sharded_poller.stop()
+        thread.join(15)
+    assert not thread.is_alive()
+    assert sharded_poller.worker_pids == [None, None]
+
+    archive = MeasurementArchive(config.archive_dir)
+    archived = archive.query(devices[0].ip, datetime(1970, 1, 1), datetime(2100, 1, 1))
+    # every poll of the device is archived once, by whichever worker polled it
+    assert [measurements.revision for measurements in archived] == ([1, 2, 3] if moved == devices[0] else [1, 3])